@@ -1,21 +1,41 @@
 import logging
 import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from datetime import datetime, timedelta
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, BasePersistence, PersistenceInput, TypeHandler
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
 import asyncio
 import os
-from flask import Flask, jsonify
+from flask import Flask, jsonify, Response, request
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import psutil
 import base64
+import hashlib
+import hmac
 import json
+import pickle
+import contextvars
+import functools
+import cProfile
+import pstats
+import traceback
+import re
+import gc
+import weakref
+import math
+from array import array
 import csv
 from io import StringIO, BytesIO
-from telegram.error import BadRequest, NetworkError
+from telegram.error import BadRequest, Forbidden, NetworkError, TelegramError
 import sys  # AGGIUNTO
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 
 # === CONFIGURAZIONE ===
 DATABASE_NAME = 'interventi_vvf.db'
@@ -23,9 +43,75 @@ BOT_TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_IDS = [1816045269, 653425963, 693843502, 6622015744]
 SUPER_ADMIN_ID = 1816045269  # ID del super admin per l'invio automatico
 
+# Invii CSV programmati: orario e fuso (default: fuso locale del server)
+ORARIO_INVII_CSV = dtime(23, 55)
+# Dopo un riavvio, gli invii scaduti da meno di queste ore vengono recuperati
+SCHEDULER_FINESTRA_RECUPERO_ORE = int(os.environ.get('SCHEDULER_FINESTRA_RECUPERO_ORE', '12'))
+SCHEDULER_RITENTA_MINUTI = 15
+FUSO_ORARIO_SCHEDULER = ZoneInfo(os.environ['SCHEDULER_TIMEZONE']) if os.environ.get('SCHEDULER_TIMEZONE') else datetime.now().astimezone().tzinfo
+
+# Endpoint HTTP di diagnostica (/sistema, /lag, /sql): solo con header X-Token-Diagnostica
+# uguale a questo valore; se non impostato gli endpoint sono disattivati
+DIAGNOSTICA_TOKEN = os.environ.get('DIAGNOSTICA_TOKEN')
+
 # Configurazione backup GitHub
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
 GIST_ID = os.environ.get('GIST_ID')
+NOME_FILE_BACKUP = 'interventi_vvf_backup.json'  # formato a file unico, solo per il restore
+NOME_FILE_INDICE = 'interventi_vvf_indice.json'
+PREFISSO_GENERAZIONE = 'interventi_vvf_'
+
+# Rotazione backup: una generazione all'ora per un giorno, una al giorno per un mese
+BACKUP_RETENTION_ORE = int(os.environ.get('BACKUP_RETENTION_ORE', '24'))
+BACKUP_RETENTION_GIORNI = int(os.environ.get('BACKUP_RETENTION_GIORNI', '30'))
+# Una generazione con meno della metà degli interventi della precedente non viene ripristinata
+BACKUP_SOGLIA_CALO_RIGHE = 0.5
+
+# Backend di backup: 'gist' (default) oppure 'locale' (directory BACKUP_DIR, per uso offline e test)
+BACKUP_BACKEND = os.environ.get('BACKUP_BACKEND', 'gist')
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backup_locali')
+
+# Chiamate HTTP esterne: timeout (connessione, lettura) in secondi e retry con backoff esponenziale
+HTTP_TIMEOUT = (10, 60)
+HTTP_MAX_RETRY = 4
+HTTP_BACKOFF = 2  # attese di 2s, 4s, 8s, 16s tra i tentativi
+
+# Il restore decodifica il backup a blocchi: la memoria di picco dipende da questo valore, non dal database
+RESTORE_DIMENSIONE_BLOCCO = 64 * 1024  # multiplo di 4 caratteri base64
+
+# Update elaborati in parallelo dall'Application (1 = in sequenza, comportamento storico)
+BOT_UPDATE_CONCORRENTI = int(os.environ.get('BOT_UPDATE_CONCORRENTI', '1'))
+
+# Registrazione degli update in JSONL (id utente anonimizzati) per tools/riproduci_update.py
+REGISTRA_UPDATE_DIR = os.environ.get('REGISTRA_UPDATE_DIR')  # non impostata = registrazione spenta
+# Con lo stesso sale gli pseudonimi restano stabili tra i riavvii; senza, ne viene generato uno per processo
+REGISTRA_UPDATE_SALE = os.environ.get('REGISTRA_UPDATE_SALE')
+
+# Stato delle conversazioni (user_data/chat_data) salvato su SQLite a intervalli, non a ogni update
+PERSISTENZA_INTERVALLO_SECONDI = int(os.environ.get('PERSISTENZA_INTERVALLO_SECONDI', '30'))
+
+# Flussi a più passaggi lasciati a metà: la fase scade dopo questi minuti senza risposte dell'utente
+FASE_SCADENZA_MINUTI = int(os.environ.get('FASE_SCADENZA_MINUTI', '60'))
+FASE_PULIZIA_INTERVALLO_SECONDI = 600
+
+# Ruoli utenti in memoria: ricaricati dal database dopo questi secondi (0 = solo scritture e restore)
+RUOLI_CACHE_TTL_SECONDI = int(os.environ.get('RUOLI_CACHE_TTL_SECONDI', '600'))
+
+# Watchdog risorse: il riavvio avviene solo se le soglie (o la crescita della RAM) vengono superate
+# I campioni sono quelli del campionatore di sistema: il watchdog li valuta ogni minuto
+WATCHDOG_INTERVALLO_SECONDI = 60
+WATCHDOG_RSS_MAX_MB = int(os.environ.get('WATCHDOG_RSS_MAX_MB', '400'))
+WATCHDOG_FD_MAX = int(os.environ.get('WATCHDOG_FD_MAX', '512'))
+WATCHDOG_THREAD_MAX = int(os.environ.get('WATCHDOG_THREAD_MAX', '50'))
+WATCHDOG_LAG_MAX_SECONDI = float(os.environ.get('WATCHDOG_LAG_MAX_SECONDI', '5'))
+WATCHDOG_CRESCITA_MB_ORA = float(os.environ.get('WATCHDOG_CRESCITA_MB_ORA', '20'))
+WATCHDOG_STORICO_MINIMO_TREND_SECONDI = 3600  # almeno un'ora di dati prima di valutare la crescita
+WATCHDOG_ATTESA_RIMEDI_MINUTI = 10
+WATCHDOG_UPTIME_MINIMO_MINUTI = 30  # evita cicli di riavvio subito dopo l'avvio
+RIAVVIO_INATTIVITA_MINUTI = 10
+RIAVVIO_ORE_TRANQUILLE = 4  # quante ore del giorno considerare "a basso traffico"
+RIAVVIO_TIMEOUT_DRAIN = 60  # secondi concessi agli handler in corso
+ATTIVITA_GIORNI_STORICO = 7
 
 # === MAPPING TIPOLOGIE CON CODICI BREVI - VERSIONE CORRETTA ===
 TIPOLOGIE_MAPPING = {
@@ -99,6 +185,9 @@ def get_callback_by_tipologia(tipologia_completa):
 # Gradi patente
 GRADI_PATENTE = ["I", "II", "III", "IIIE"]
 
+# Tabelle essenziali del database
+TABELLE_NECESSARIE = ['interventi', 'vigili', 'mezzi', 'utenti', 'partecipanti']
+
 # Tipi mezzi predefiniti
 TIPI_MEZZO_PREDEFINITI = ["APS TLF3", "ABP Daf", "A/TRID ML120E", "CA/PU Defender 110", "CA/PU Ranger Bosch.", "RI Motopompa Humbaur", "AF Polisoccorso", "FB Arimar", "AV E-Doblò", "Mezzo sostitutivo"]
 
@@ -114,17 +203,16 @@ class SistemaRobustezza:
     def verifica_integrita_database(self):
         """Verifica che il database sia integro e funzionante"""
         try:
-            conn = sqlite3.connect(DATABASE_NAME)
+            conn = connetti_db()
             c = conn.cursor()
             
             # Verifica tutte le tabelle essenziali
-            tabelle_necessarie = ['interventi', 'vigili', 'mezzi', 'utenti', 'partecipanti']
             c.execute("SELECT name FROM sqlite_master WHERE type='table'")
             tabelle_esistenti = [row[0] for row in c.fetchall()]
             
             conn.close()
             
-            for tabella in tabelle_necessarie:
+            for tabella in TABELLE_NECESSARIE:
                 if tabella not in tabelle_esistenti:
                     print(f"🚨 Tabella mancante: {tabella}")
                     return False
@@ -159,9 +247,717 @@ class SistemaRobustezza:
 # Istanza globale del sistema di robustezza
 sistema_robustezza = SistemaRobustezza()
 
+# === STATO DI AVVIO E PRONTEZZA ===
+class StatoAvvio:
+    """Stato di prontezza del servizio e durata delle fasi di avvio"""
+    def __init__(self):
+        self.stato = 'avvio'  # avvio -> restoring -> avvio_bot -> ready
+        self.inizio_processo = time.monotonic()
+        self.durate = {}
+        self._inizi = {}
+        self._lock = threading.Lock()
+        self.restore_completato = threading.Event()
+
+    def imposta_stato(self, stato):
+        with self._lock:
+            self.stato = stato
+        print(f"🚦 Stato servizio: {stato}")
+
+    def inizia_fase(self, nome):
+        with self._lock:
+            self._inizi[nome] = time.monotonic()
+
+    def termina_fase(self, nome):
+        with self._lock:
+            inizio = self._inizi.pop(nome, None)
+            if inizio is None:
+                return
+            durata = time.monotonic() - inizio
+            self.durate[nome] = round(durata, 3)
+        print(f"⏱️ Fase '{nome}' completata in {durata:.2f}s")
+
+    @contextmanager
+    def fase(self, nome):
+        self.inizia_fase(nome)
+        try:
+            yield
+        finally:
+            self.termina_fase(nome)
+
+    def pronto(self):
+        return self.stato == 'ready'
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'stato': self.stato,
+                'fasi': dict(self.durate),
+                'secondi_dall_avvio': round(time.monotonic() - self.inizio_processo, 1)
+            }
+
+    def stampa_report(self):
+        dati = self.snapshot()
+        print("📋 REPORT AVVIO:")
+        for nome, durata in dati['fasi'].items():
+            print(f"   • {nome}: {durata:.2f}s")
+        print(f"   • totale dall'avvio del processo: {dati['secondi_dall_avvio']:.1f}s")
+
+# Istanza globale dello stato di avvio
+stato_avvio = StatoAvvio()
+
+# === SUPERVISORE SERVIZI IN BACKGROUND ===
+class SupervisoreServizi:
+    """Servizi di background come task asyncio sul loop del bot, con riavvio e backoff"""
+    def __init__(self, max_thread=4):
+        self.servizi = {}
+        self.task = {}
+        self.loop = None
+        # Pool dei servizi (HTTP di keep-alive e backup, SQLite di servizio). Gli handler
+        # usano asyncio.to_thread sull'executor predefinito del loop e non competono con questi
+        self.executor = ThreadPoolExecutor(max_workers=max_thread, thread_name_prefix='servizi')
+
+    def registra(self, nome, funzione, riavvio='sempre', backoff_iniziale=5, backoff_max=300):
+        """riavvio: 'sempre' (anche se termina), 'errore' (solo se fallisce), 'mai'"""
+        self.servizi[nome] = {
+            'funzione': funzione,
+            'riavvio': riavvio,
+            'backoff_iniziale': backoff_iniziale,
+            'backoff_max': backoff_max,
+            'stato': 'registrato',
+            'avvii': 0,
+            'ultimo_avvio': None,
+            'ultimo_errore': None,
+        }
+
+    def avvia(self, loop):
+        """Crea i task: partono appena il loop viene eseguito"""
+        self.loop = loop
+        for nome in self.servizi:
+            if nome not in self.task or self.task[nome].done():
+                self.task[nome] = loop.create_task(self._supervisiona(nome), name=f"servizio:{nome}")
+        print(f"🧭 Supervisore: {len(self.servizi)} servizi registrati ({', '.join(self.servizi)})")
+
+    async def _supervisiona(self, nome):
+        servizio = self.servizi[nome]
+        backoff = servizio['backoff_iniziale']
+        while True:
+            servizio['stato'] = 'attivo'
+            servizio['avvii'] += 1
+            servizio['ultimo_avvio'] = datetime.now().isoformat()
+            inizio = time.monotonic()
+            try:
+                await servizio['funzione']()
+                servizio['stato'] = 'completato'
+                if servizio['riavvio'] != 'sempre':
+                    return
+                print(f"⚠️ Servizio '{nome}' terminato - riavvio in {backoff}s")
+            except asyncio.CancelledError:
+                servizio['stato'] = 'fermato'
+                raise
+            except Exception as e:
+                servizio['stato'] = 'errore'
+                servizio['ultimo_errore'] = f"{type(e).__name__}: {e}"
+                print(f"❌ Servizio '{nome}' in errore: {e}")
+                if servizio['riavvio'] == 'mai':
+                    return
+                print(f"🔄 Riavvio servizio '{nome}' in {backoff}s")
+            
+            # Un servizio rimasto attivo a lungo riparte dal backoff iniziale
+            if time.monotonic() - inizio > servizio['backoff_max']:
+                backoff = servizio['backoff_iniziale']
+            servizio['stato'] = 'in_riavvio'
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, servizio['backoff_max'])
+
+    async def in_thread(self, funzione, *args):
+        """Esegue lavoro bloccante nel pool condiviso"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, funzione, *args)
+
+    async def attendi_evento(self, evento, intervallo=0.5):
+        """Attende un threading.Event senza occupare un thread del pool"""
+        while not evento.is_set():
+            await asyncio.sleep(intervallo)
+
+    def snapshot(self):
+        return {
+            nome: {
+                'stato': servizio['stato'],
+                'riavvio': servizio['riavvio'],
+                'avvii': servizio['avvii'],
+                'ultimo_avvio': servizio['ultimo_avvio'],
+                'ultimo_errore': servizio['ultimo_errore'],
+            }
+            for nome, servizio in self.servizi.items()
+        }
+
+# Istanza globale del supervisore
+supervisore = SupervisoreServizi()
+
+# === BUFFER CIRCOLARE PER CAMPIONI NUMERICI ===
+class BufferCircolare:
+    """Ultimi N campioni di più grandezze numeriche, su array preallocati"""
+    def __init__(self, capacita, campi):
+        self.capacita = capacita
+        self.campi = tuple(campi)
+        self._dati = {campo: array('d', [0.0]) * capacita for campo in self.campi}
+        self._prossimo = 0
+        self._quanti = 0
+        self._lock = threading.Lock()
+
+    def aggiungi(self, **valori):
+        with self._lock:
+            for campo in self.campi:
+                self._dati[campo][self._prossimo] = float(valori.get(campo, 0.0))
+            self._prossimo = (self._prossimo + 1) % self.capacita
+            self._quanti = min(self._quanti + 1, self.capacita)
+
+    def __len__(self):
+        return self._quanti
+
+    def serie(self, campo, ultimi=None):
+        """Valori in ordine cronologico (dal più vecchio)"""
+        with self._lock:
+            quanti = self._quanti if ultimi is None else min(ultimi, self._quanti)
+            inizio = (self._prossimo - quanti) % self.capacita
+            dati = self._dati[campo]
+            return [dati[(inizio + i) % self.capacita] for i in range(quanti)]
+
+    def ultimo(self):
+        with self._lock:
+            if not self._quanti:
+                return None
+            indice = (self._prossimo - 1) % self.capacita
+            return {campo: self._dati[campo][indice] for campo in self.campi}
+
+# === METRICHE (formato Prometheus) ===
+BUCKET_DURATA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKET_QUERY = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+BUCKET_LENTI = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Handler Telegram in esecuzione nel task corrente
+contesto_handler = contextvars.ContextVar('contesto_handler', default=None)
+# task -> (handler, callback_data): leggibile anche da altri thread (monitor del lag)
+handler_in_esecuzione = {}
+
+class RegistroMetriche:
+    """Contatori, gauge e istogrammi in memoria, esposti su /metrics"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._definizioni = {}  # nome -> (tipo, descrizione, bucket)
+        self._valori = {}  # (nome, etichette) -> valore oppure [conteggi bucket, somma, conteggio]
+
+    def definisci(self, nome, tipo, descrizione, bucket=None):
+        self._definizioni[nome] = (tipo, descrizione, tuple(bucket or BUCKET_DURATA))
+
+    def incrementa(self, nome, valore=1, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + valore
+
+    def imposta(self, nome, valore, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            self._valori[chiave] = valore
+
+    def osserva(self, nome, valore, **etichette):
+        bucket = self._definizioni[nome][2]
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            dati = self._valori.get(chiave)
+            if dati is None:
+                dati = self._valori[chiave] = [[0] * len(bucket), 0.0, 0]
+            for i, limite in enumerate(bucket):
+                if valore <= limite:
+                    dati[0][i] += 1
+            dati[1] += valore
+            dati[2] += 1
+
+    @contextmanager
+    def misura(self, nome, **etichette):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.osserva(nome, time.perf_counter() - inizio, **etichette)
+
+    @staticmethod
+    def _etichette(coppie):
+        if not coppie:
+            return ''
+        testo = ','.join(
+            f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for k, v in coppie
+        )
+        return '{' + testo + '}'
+
+    def testo(self):
+        """Esposizione nel formato testuale Prometheus 0.0.4"""
+        with self._lock:
+            valori = sorted(
+                ((nome, etichette, dati if not isinstance(dati, list) else [list(dati[0]), dati[1], dati[2]])
+                 for (nome, etichette), dati in self._valori.items()),
+                key=lambda v: (v[0], v[1])
+            )
+        righe = []
+        nome_corrente = None
+        for nome, etichette, dati in valori:
+            tipo, descrizione, bucket = self._definizioni.get(nome, ('untyped', '', ()))
+            if nome != nome_corrente:
+                righe.append(f"# HELP {nome} {descrizione}")
+                righe.append(f"# TYPE {nome} {tipo}")
+                nome_corrente = nome
+            if tipo != 'histogram':
+                righe.append(f"{nome}{self._etichette(etichette)} {dati}")
+                continue
+            conteggi, somma, conteggio = dati
+            for limite, numero in zip(bucket, conteggi):
+                righe.append(f"{nome}_bucket{self._etichette(etichette + (('le', limite),))} {numero}")
+            righe.append(f"{nome}_bucket{self._etichette(etichette + (('le', '+Inf'),))} {conteggio}")
+            righe.append(f"{nome}_sum{self._etichette(etichette)} {somma}")
+            righe.append(f"{nome}_count{self._etichette(etichette)} {conteggio}")
+        return '\n'.join(righe) + '\n'
+
+# Istanza globale delle metriche
+metriche = RegistroMetriche()
+metriche.definisci('bot_handler_durata_secondi', 'histogram', 'Durata degli handler Telegram')
+metriche.definisci('bot_handler_errori_totale', 'counter', 'Eccezioni non gestite negli handler')
+metriche.definisci('bot_callback_totale', 'counter', 'Callback ricevute per prefisso')
+metriche.definisci('bot_fasi_scadute_totale', 'counter', 'Fasi di inserimento scadute per inattività')
+metriche.definisci('bot_fasi_transizioni_rifiutate_totale', 'counter', 'Transizioni di fase non dichiarate')
+metriche.definisci('bot_db_query_durata_secondi', 'histogram', 'Durata delle query per funzione', BUCKET_QUERY)
+metriche.definisci('bot_export_righe_totale', 'counter', 'Righe esportate in CSV')
+metriche.definisci('bot_export_durata_secondi', 'histogram', 'Durata delle esportazioni CSV', BUCKET_LENTI)
+metriche.definisci('bot_import_righe_totale', 'counter', 'Righe importate da CSV per esito')
+metriche.definisci('bot_import_durata_secondi', 'histogram', 'Durata delle importazioni CSV', BUCKET_LENTI)
+metriche.definisci('bot_backup_durata_secondi', 'histogram', 'Durata dei backup per esito', BUCKET_LENTI)
+metriche.definisci('bot_backup_dimensione_byte', 'gauge', "Dimensione dell'ultimo database salvato")
+metriche.definisci('bot_errori_telegram_totale', 'counter', 'Errori delle API Telegram per tipo (sottoclassi di TelegramError)')
+metriche.definisci('bot_processo_rss_byte', 'gauge', 'Memoria residente del processo')
+metriche.definisci('bot_loop_lag_secondi', 'gauge', "Ritardo dell'event loop all'ultimo campione")
+metriche.definisci('bot_loop_blocchi_durata_secondi', 'histogram', "Blocchi dell'event loop oltre soglia", BUCKET_LENTI)
+
+# === LATENZE PER HANDLER (QUANTILI) ===
+class SketchQuantili:
+    """Quantili approssimati in memoria limitata (bucket logaritmici, errore relativo ~2%)"""
+    ALFA = 0.02
+    GAMMA = (1 + ALFA) / (1 - ALFA)
+    MINIMO = 1e-4  # sotto 0.1ms tutto nello stesso bucket
+
+    def __init__(self):
+        self.bucket = {}
+        self.conteggio = 0
+        self.massimo = 0.0
+
+    def aggiungi(self, valore):
+        indice = math.ceil(math.log(max(valore, self.MINIMO), self.GAMMA))
+        self.bucket[indice] = self.bucket.get(indice, 0) + 1
+        self.conteggio += 1
+        self.massimo = max(self.massimo, valore)
+
+    def unisci(self, altro):
+        for indice, numero in altro.bucket.items():
+            self.bucket[indice] = self.bucket.get(indice, 0) + numero
+        self.conteggio += altro.conteggio
+        self.massimo = max(self.massimo, altro.massimo)
+
+    def quantile(self, q):
+        if not self.conteggio:
+            return 0.0
+        rango = q * (self.conteggio - 1)
+        cumulato = 0
+        for indice in sorted(self.bucket):
+            cumulato += self.bucket[indice]
+            if cumulato > rango:
+                return min(2 * self.GAMMA ** indice / (self.GAMMA + 1), self.massimo)
+        return self.massimo
+
+class LatenzeHandler:
+    """Uno sketch per handler ogni 5 minuti, per 24 ore: p50/p95/p99 su ultima ora o giorno"""
+    SLOT_SECONDI = 300
+    SLOT = 288
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slot = {}  # handler -> {indice slot: SketchQuantili}
+
+    def registra(self, handler, secondi):
+        indice = int(time.time() // self.SLOT_SECONDI)
+        with self._lock:
+            slot = self._slot.setdefault(handler, {})
+            sketch = slot.get(indice)
+            if sketch is None:
+                sketch = slot[indice] = SketchQuantili()
+                for vecchio in [i for i in slot if i <= indice - self.SLOT]:
+                    del slot[vecchio]
+            sketch.aggiungi(secondi)
+
+    def riepilogo(self, secondi):
+        """Handler ordinati dal più lento (p95) nella finestra richiesta"""
+        primo = int(time.time() // self.SLOT_SECONDI) - math.ceil(secondi / self.SLOT_SECONDI) + 1
+        risultato = []
+        with self._lock:
+            for handler, slot in self._slot.items():
+                totale = SketchQuantili()
+                for indice, sketch in slot.items():
+                    if indice >= primo:
+                        totale.unisci(sketch)
+                if totale.conteggio:
+                    risultato.append({
+                        'handler': handler,
+                        'conteggio': totale.conteggio,
+                        'p50': totale.quantile(0.5),
+                        'p95': totale.quantile(0.95),
+                        'p99': totale.quantile(0.99),
+                        'max': totale.massimo
+                    })
+        return sorted(risultato, key=lambda r: r['p95'], reverse=True)
+
+# Istanza globale delle latenze per handler
+latenze_handler = LatenzeHandler()
+
+# === PROFILAZIONE SU RICHIESTA ===
+PROFILO_MAX_MINUTI = 60
+PROFILO_MAX_UPDATE = 500
+PROFILO_RIGHE_REPORT = 40
+
+class ProfilatoreHandler:
+    """cProfile attivo solo sugli update di una finestra (minuti o numero di update); spento costa un if"""
+    def __init__(self):
+        self.attivo = False
+        self.profilo = None
+        self.chat_id = None
+        self.scadenza = None
+        self.update_rimanenti = None
+        self.update_profilati = 0
+        self.avviato = None
+        self.job_scadenza = None
+
+    def avvia(self, chat_id, minuti=None, update=None):
+        self.profilo = cProfile.Profile()
+        self.chat_id = chat_id
+        self.scadenza = time.monotonic() + minuti * 60 if minuti else None
+        self.update_rimanenti = update
+        self.update_profilati = 0
+        self.avviato = datetime.now()
+        self.attivo = True
+
+    def inizia_update(self):
+        profilo = self.profilo
+        profilo.enable()
+        return profilo
+
+    def termina_update(self, profilo):
+        """True se la finestra di profilazione è esaurita"""
+        profilo.disable()
+        if profilo is not self.profilo:
+            return False
+        self.update_profilati += 1
+        if self.update_rimanenti is not None:
+            self.update_rimanenti -= 1
+        esaurita = (self.update_rimanenti is not None and self.update_rimanenti <= 0) or \
+                   (self.scadenza is not None and time.monotonic() >= self.scadenza)
+        if esaurita:
+            self.attivo = False  # nessun nuovo update nel profilo mentre il report viene preparato
+        return esaurita
+
+    def ferma(self):
+        """Chiude la finestra e restituisce (profilo, chat_id) oppure None se non attiva"""
+        if self.profilo is None:
+            return None
+        self.attivo = False
+        profilo, self.profilo = self.profilo, None
+        profilo.disable()
+        if self.job_scadenza is not None:
+            self.job_scadenza.schedule_removal()
+            self.job_scadenza = None
+        return profilo, self.chat_id
+
+    def report(self, profilo):
+        flusso = StringIO()
+        flusso.write(f"Profilo update dalle {self.avviato.strftime('%d/%m/%Y %H:%M:%S')} "
+                     f"alle {datetime.now().strftime('%H:%M:%S')} - {self.update_profilati} update\n\n")
+        try:
+            statistiche = pstats.Stats(profilo, stream=flusso)
+        except TypeError:  # nessuna funzione registrata
+            flusso.write("Nessun dato raccolto.\n")
+            return flusso.getvalue()
+        statistiche.strip_dirs()
+        flusso.write("=== PER TEMPO CUMULATIVO ===\n")
+        statistiche.sort_stats('cumulative').print_stats(PROFILO_RIGHE_REPORT)
+        flusso.write("\n=== PER TEMPO PROPRIO ===\n")
+        statistiche.sort_stats('tottime').print_stats(PROFILO_RIGHE_REPORT // 2)
+        return flusso.getvalue()
+
+    async def concludi_e_invia(self, bot):
+        fermato = self.ferma()
+        if fermato is None:
+            return
+        profilo, chat_id = fermato
+        testo = await asyncio.to_thread(self.report, profilo)
+        documento = BytesIO(testo.encode('utf-8'))
+        documento.name = f"profilo_{datetime.now().strftime('%Y%m%d_%H%M')}.txt"
+        await bot.send_document(
+            chat_id=chat_id,
+            document=documento,
+            filename=documento.name,
+            caption=f"🔬 Profilo cProfile di {self.update_profilati} update (ordinato per tempo cumulativo)"
+        )
+        print(f"🔬 Report di profilazione inviato ({self.update_profilati} update)")
+
+# Istanza globale del profilatore
+profilatore = ProfilatoreHandler()
+
+def handler_misurato(funzione):
+    """Durata ed errori di un handler Telegram; imposta contesto_handler"""
+    @functools.wraps(funzione)
+    async def wrapper(update, context, *args, **kwargs):
+        token = contesto_handler.set(funzione.__name__)
+        task = asyncio.current_task()
+        callback_data = update.callback_query.data if getattr(update, 'callback_query', None) else None
+        # Gli handler si annidano (gestisci_callback -> ramo): si ripristina quello esterno all'uscita
+        esterno = handler_in_esecuzione.get(task)
+        handler_in_esecuzione[task] = (funzione.__name__, callback_data)
+        profilo = profilatore.inizia_update() if profilatore.attivo and esterno is None else None
+        inizio = time.perf_counter()
+        try:
+            return await funzione(update, context, *args, **kwargs)
+        except Exception:
+            metriche.incrementa('bot_handler_errori_totale', handler=funzione.__name__)
+            raise
+        finally:
+            durata = time.perf_counter() - inizio
+            metriche.osserva('bot_handler_durata_secondi', durata, handler=funzione.__name__)
+            latenze_handler.registra(funzione.__name__, durata)
+            if esterno is None:
+                handler_in_esecuzione.pop(task, None)
+            else:
+                handler_in_esecuzione[task] = esterno
+            contesto_handler.reset(token)
+            if profilo is not None and profilatore.termina_update(profilo):
+                context.application.create_task(profilatore.concludi_e_invia(context.bot))
+    return wrapper
+
+def query_misurata(funzione):
+    """Durata di una funzione di accesso al database, etichettata col suo nome"""
+    @functools.wraps(funzione)
+    def wrapper(*args, **kwargs):
+        with metriche.misura('bot_db_query_durata_secondi', query=funzione.__name__):
+            return funzione(*args, **kwargs)
+    return wrapper
+
+def durata_misurata(nome, esito=False, **etichette):
+    """Istogramma della durata (sync o async); con esito=True etichetta ok/errore dal risultato"""
+    def decoratore(funzione):
+        def osserva(inizio, riuscito):
+            extra = {'esito': 'ok' if riuscito else 'errore'} if esito else {}
+            metriche.osserva(nome, time.perf_counter() - inizio, **etichette, **extra)
+        
+        if asyncio.iscoroutinefunction(funzione):
+            @functools.wraps(funzione)
+            async def wrapper_async(*args, **kwargs):
+                inizio = time.perf_counter()
+                risultato = None
+                try:
+                    risultato = await funzione(*args, **kwargs)
+                    return risultato
+                finally:
+                    osserva(inizio, bool(risultato))
+            return wrapper_async
+        
+        @functools.wraps(funzione)
+        def wrapper(*args, **kwargs):
+            inizio = time.perf_counter()
+            risultato = None
+            try:
+                risultato = funzione(*args, **kwargs)
+                return risultato
+            finally:
+                osserva(inizio, bool(risultato))
+        return wrapper
+    return decoratore
+
+def prefisso_callback(callback_data):
+    """Parte iniziale della callback_data, senza id o numeri (cardinalità limitata)"""
+    prefisso = (callback_data or '').split('_', 1)[0]
+    return prefisso if prefisso.isalpha() else 'altro'
+
+# === TRACCIAMENTO SQL ===
+SQL_TRACCIA_ATTIVA = os.environ.get('SQL_TRACCIA', '1') != '0'
+SQL_SOGLIA_LENTA_SECONDI = float(os.environ.get('SQL_SOGLIA_LENTA_MS', '50')) / 1000
+SQL_MAX_IMPRONTE = 500
+SQL_QUERY_LENTE = 50
+
+_RE_STRINGHE_SQL = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMERI_SQL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_LISTE_SQL = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_RE_SPAZI_SQL = re.compile(r"\s+")
+
+def impronta_sql(sql):
+    """Forma normalizzata della query: letterali -> ?, liste IN compattate, spazi uniformi"""
+    testo = _RE_STRINGHE_SQL.sub('?', sql)
+    testo = _RE_NUMERI_SQL.sub('?', testo)
+    testo = _RE_LISTE_SQL.sub('(?+)', testo)
+    return _RE_SPAZI_SQL.sub(' ', testo).strip()
+
+class TracciaSQL:
+    """Conteggi e tempi per impronta di query, con registro delle query lente e piano di esecuzione"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.impronte = {}  # impronta -> statistiche
+        self.lente = []  # ultime query lente
+
+    def registra(self, sql, secondi):
+        impronta = impronta_sql(sql)
+        handler = contesto_handler.get() or '-'
+        with self._lock:
+            dati = self.impronte.get(impronta)
+            if dati is None:
+                if len(self.impronte) >= SQL_MAX_IMPRONTE:
+                    return
+                dati = self.impronte[impronta] = {'conteggio': 0, 'totale_secondi': 0.0, 'massimo_secondi': 0.0, 'handler': {}}
+            dati['conteggio'] += 1
+            dati['totale_secondi'] += secondi
+            dati['massimo_secondi'] = max(dati['massimo_secondi'], secondi)
+            dati['handler'][handler] = dati['handler'].get(handler, 0) + 1
+
+    def registra_lenta(self, sql, secondi, piano):
+        voce = {
+            'quando': datetime.now().isoformat(timespec='seconds'),
+            'secondi': round(secondi, 4),
+            'handler': contesto_handler.get(),
+            'sql': impronta_sql(sql),
+            'piano': piano
+        }
+        with self._lock:
+            self.lente.append(voce)
+            del self.lente[:-SQL_QUERY_LENTE]
+        print(f"🐌 Query lenta {secondi * 1000:.0f}ms ({voce['handler'] or '-'}): {voce['sql'][:200]}")
+        for riga in piano:
+            print(f"    {riga}")
+
+    def classifica(self, ordine='totale_secondi', limite=20):
+        with self._lock:
+            righe = [
+                {
+                    'sql': impronta,
+                    'conteggio': dati['conteggio'],
+                    'totale_secondi': round(dati['totale_secondi'], 4),
+                    'media_ms': round(dati['totale_secondi'] / dati['conteggio'] * 1000, 3),
+                    'massimo_ms': round(dati['massimo_secondi'] * 1000, 3),
+                    'handler': dict(sorted(dati['handler'].items(), key=lambda h: -h[1])[:5])
+                }
+                for impronta, dati in self.impronte.items()
+            ]
+        return sorted(righe, key=lambda r: r[ordine], reverse=True)[:limite]
+
+    def query_lente(self):
+        with self._lock:
+            return list(reversed(self.lente))
+
+# Istanza globale del tracciamento SQL
+traccia_sql = TracciaSQL()
+
+class CursoreTracciato(sqlite3.Cursor):
+    """Cronometra execute e fetch dello stesso statement (SQLite calcola le righe durante il fetch)"""
+    _sql = None
+    _parametri = ()
+    _secondi = 0.0
+
+    def _chiudi_statement(self):
+        if self._sql is None:
+            return
+        sql, parametri, secondi = self._sql, self._parametri, self._secondi
+        self._sql = None
+        traccia_sql.registra(sql, secondi)
+        if secondi > SQL_SOGLIA_LENTA_SECONDI:
+            traccia_sql.registra_lenta(sql, secondi, self.connection.piano_esecuzione(sql, parametri))
+
+    def _misura(self, metodo, *args):
+        inizio = time.perf_counter()
+        try:
+            return metodo(*args)
+        finally:
+            self._secondi += time.perf_counter() - inizio
+
+    def execute(self, sql, parametri=()):
+        self._chiudi_statement()
+        self._sql, self._parametri, self._secondi = sql, parametri, 0.0
+        self._misura(super().execute, sql, parametri)
+        if self.description is None:
+            # Nessuna riga da leggere (INSERT/UPDATE/DDL): statement concluso
+            self._chiudi_statement()
+        return self
+
+    def executemany(self, sql, sequenza):
+        self._chiudi_statement()
+        self._sql, self._parametri, self._secondi = sql, None, 0.0
+        self._misura(super().executemany, sql, sequenza)
+        self._chiudi_statement()
+        return self
+
+    def fetchone(self):
+        riga = self._misura(super().fetchone)
+        if riga is None:
+            self._chiudi_statement()
+        return riga
+
+    def fetchmany(self, size=None):
+        righe = self._misura(super().fetchmany, size if size is not None else self.arraysize)
+        if not righe:
+            self._chiudi_statement()
+        return righe
+
+    def fetchall(self):
+        righe = self._misura(super().fetchall)
+        self._chiudi_statement()
+        return righe
+
+    def close(self):
+        self._chiudi_statement()
+        super().close()
+
+class ConnessioneTracciata(sqlite3.Connection):
+    """Connessione i cui cursori registrano tempi e query lente"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursori = weakref.WeakSet()
+
+    def cursor(self, factory=CursoreTracciato):
+        cursore = super().cursor(factory)
+        self._cursori.add(cursore)
+        return cursore
+
+    def close(self):
+        # Statement letti solo in parte (es. un solo fetchone) vengono registrati alla chiusura
+        for cursore in list(self._cursori):
+            cursore._chiudi_statement()
+        super().close()
+
+    def execute(self, sql, parametri=()):
+        return self.cursor().execute(sql, parametri)
+
+    def executemany(self, sql, sequenza):
+        return self.cursor().executemany(sql, sequenza)
+
+    def piano_esecuzione(self, sql, parametri):
+        """EXPLAIN QUERY PLAN con un cursore non tracciato"""
+        if parametri is None or not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+            return []
+        try:
+            righe = sqlite3.Cursor(self).execute(f"EXPLAIN QUERY PLAN {sql}", parametri).fetchall()
+            return [riga[-1] for riga in righe]
+        except sqlite3.Error as e:
+            return [f"piano non disponibile: {e}"]
+
+def connetti_db(percorso=DATABASE_NAME):
+    """Connessione al database del bot (tracciata se SQL_TRACCIA non è 0)"""
+    if SQL_TRACCIA_ATTIVA:
+        return sqlite3.connect(percorso, factory=ConnessioneTracciata)
+    return sqlite3.connect(percorso)
+
 # === DATABASE ===
 def init_db():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
 
     # Tabella interventi
@@ -258,182 +1054,698 @@ def init_db():
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', 
                     (nome, cognome, qualifica, grado, nautica, saf, tpss, atp))
 
+    crea_tabelle_supporto(c)
+
     conn.commit()
     conn.close()
 
+def crea_tabelle_supporto(c):
+    """Tabelle di servizio del bot (non fanno parte dei dati degli interventi)"""
+    # Registro dei job programmati: ultima esecuzione, prossima scadenza, esito
+    c.execute('''CREATE TABLE IF NOT EXISTS job_programmati
+                 (nome TEXT PRIMARY KEY,
+                  ultima_esecuzione TIMESTAMP,
+                  prossima_scadenza TIMESTAMP,
+                  stato TEXT,
+                  ultimo_errore TEXT,
+                  aggiornato TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Destinatari già serviti nello slot corrente di un job: i tentativi successivi li saltano
+    c.execute('''CREATE TABLE IF NOT EXISTS job_consegne
+                 (nome TEXT NOT NULL,
+                  scadenza TIMESTAMP NOT NULL,
+                  destinatario INTEGER NOT NULL,
+                  esito TEXT,
+                  aggiornato TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (nome, scadenza, destinatario))''')
+    # Update ricevuti per giorno e ora: serve a scegliere quando riavviare
+    c.execute('''CREATE TABLE IF NOT EXISTS attivita_oraria
+                 (giorno TEXT NOT NULL,
+                  ora INTEGER NOT NULL,
+                  aggiornamenti INTEGER DEFAULT 0,
+                  PRIMARY KEY (giorno, ora))''')
+    # Stato delle conversazioni in corso (user_data/chat_data serializzati)
+    c.execute('''CREATE TABLE IF NOT EXISTS persistenza_bot
+                 (tipo TEXT NOT NULL,
+                  chiave INTEGER NOT NULL,
+                  dati BLOB NOT NULL,
+                  aggiornato TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (tipo, chiave))''')
+
+def aggiorna_schema_database():
+    """Aggiunge le tabelle di servizio mancanti (es. database ripristinati da backup precedenti)"""
+    conn = connetti_db()
+    c = conn.cursor()
+    crea_tabelle_supporto(c)
+    conn.commit()
+    conn.close()
+
+# === PERSISTENZA STATO CONVERSAZIONI ===
+class PersistenzaSQLite(BasePersistence):
+    """user_data e chat_data su SQLite: i flussi a più passaggi sopravvivono ai riavvii.
+
+    Le modifiche di un ciclo di aggiornamento vengono accodate in memoria e scritte
+    in un'unica transazione; flush() scrive quelle rimaste allo spegnimento.
+    """
+    def __init__(self, database=DATABASE_NAME, update_interval=PERSISTENZA_INTERVALLO_SECONDI):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.database = database
+        self._in_sospeso = {}  # (tipo, chiave) -> dati serializzati, None = da eliminare
+        self._scrittura = None
+
+    def _leggi(self, tipo):
+        conn = connetti_db(self.database)
+        c = conn.cursor()
+        c.execute("SELECT chiave, dati FROM persistenza_bot WHERE tipo = ?", (tipo,))
+        righe = c.fetchall()
+        conn.close()
+        dati = {}
+        for chiave, blob in righe:
+            try:
+                dati[chiave] = pickle.loads(blob)
+            except Exception as e:
+                print(f"⚠️ Stato {tipo} {chiave} non leggibile, ignorato: {e}")
+        return dati
+
+    def _scrivi(self, modifiche):
+        conn = connetti_db(self.database)
+        try:
+            with conn:
+                for (tipo, chiave), blob in modifiche.items():
+                    if blob is None:
+                        conn.execute("DELETE FROM persistenza_bot WHERE tipo = ? AND chiave = ?", (tipo, chiave))
+                    else:
+                        conn.execute('''INSERT INTO persistenza_bot (tipo, chiave, dati, aggiornato)
+                                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                                        ON CONFLICT (tipo, chiave) DO UPDATE
+                                        SET dati = excluded.dati, aggiornato = excluded.aggiornato''',
+                                     (tipo, chiave, blob))
+        finally:
+            conn.close()
+
+    def _accoda(self, tipo, chiave, dati):
+        self._in_sospeso[(tipo, chiave)] = None if dati is None else pickle.dumps(dati)
+        # Gli update_* di un ciclo arrivano insieme: la scrittura parte dopo l'ultimo
+        if self._scrittura is None or self._scrittura.done():
+            self._scrittura = asyncio.create_task(self._scrivi_in_sospeso())
+
+    async def _scrivi_in_sospeso(self):
+        await asyncio.sleep(0)
+        if not self._in_sospeso:
+            return
+        modifiche, self._in_sospeso = self._in_sospeso, {}
+        try:
+            await asyncio.to_thread(self._scrivi, modifiche)
+        except Exception as e:
+            # Rimette in coda ciò che non è stato sovrascritto nel frattempo
+            print(f"❌ Errore salvataggio stato conversazioni: {e}")
+            for chiave, blob in modifiche.items():
+                self._in_sospeso.setdefault(chiave, blob)
+
+    async def _carica(self, tipo):
+        # Il database definitivo è disponibile solo a restore completato
+        await supervisore.attendi_evento(stato_avvio.restore_completato)
+        dati = await asyncio.to_thread(self._leggi, tipo)
+        if dati:
+            print(f"💾 Ripristinato stato di {len(dati)} conversazioni ({tipo})")
+        return dati
+
+    async def get_user_data(self):
+        return await self._carica('user')
+
+    async def get_chat_data(self):
+        return await self._carica('chat')
+
+    async def update_user_data(self, user_id, data):
+        self._accoda('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._accoda('chat', chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._accoda('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._accoda('chat', chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def flush(self):
+        if self._scrittura is not None:
+            await self._scrittura
+        await self._scrivi_in_sospeso()
+
+    # bot_data, callback_data e conversazioni non sono usati dal bot
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
 # Inizializzazione database con sistema di robustezza
 if not sistema_robustezza.rigenera_database_se_necessario():
     print("🔄 Inizializzazione database standard...")
     init_db()
+aggiorna_schema_database()
+
+# === SESSIONE HTTP CONDIVISA ===
+def crea_sessione_http():
+    """Crea una sessione requests con connessioni riutilizzate e retry con backoff esponenziale"""
+    sessione = requests.Session()
+    retry = Retry(
+        total=HTTP_MAX_RETRY,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['GET', 'PATCH']),  # POST crea un nuovo Gist: niente retry
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4)
+    sessione.mount('https://', adapter)
+    sessione.mount('http://', adapter)
+    return sessione
+
+sessione_http = crea_sessione_http()
+
+# === BACKEND DI BACKUP ===
+class ErroreBackup(Exception):
+    """Errore sollevato dai backend di backup"""
+
+class BackendBackup(ABC):
+    """Interfaccia comune dei backend di backup: un contenitore di file di testo.
+
+    Un backend incompleto fallisce già alla creazione, non a metà di un backup.
+    """
+    nome = 'base'
+
+    @abstractmethod
+    def configurato(self, per_restore=False):
+        """True se il backend è utilizzabile (per il restore possono servire più parametri)"""
+
+    def stato_configurazione(self):
+        """Righe diagnostiche da stampare quando il backend non è configurato"""
+        return []
+
+    @abstractmethod
+    def salva_file(self, files):
+        """Scrive i file indicati (nome -> contenuto); un contenuto None elimina il file"""
+
+    @abstractmethod
+    def leggi_file(self, nome_file):
+        """Restituisce il contenuto del file o None se non esiste"""
+
+    @abstractmethod
+    def elenca_file(self):
+        """Restituisce i nomi dei file presenti nel backend"""
+
+    @abstractmethod
+    def apri_stream(self, nome_file, dimensione_blocco=RESTORE_DIMENSIONE_BLOCCO):
+        """Context manager con un iteratore sui byte del file letti a blocchi,
+        senza caricarlo tutto in memoria"""
+
+class BackendGist(BackendBackup):
+    """Backend su GitHub Gist con sessione HTTP condivisa, timeout e retry"""
+    nome = 'gist'
+    API_URL = 'https://api.github.com'
+
+    def __init__(self, token, gist_id, sessione=None):
+        self.token = token
+        self.gist_id = gist_id
+        self.sessione = sessione or sessione_http
+
+    def configurato(self, per_restore=False):
+        if per_restore:
+            return bool(self.token and self.gist_id)
+        return bool(self.token)
+
+    def stato_configurazione(self):
+        return [
+            f"🔍 GITHUB_TOKEN: {'✅ Configurato' if self.token else '❌ Mancante'}",
+            f"🔍 GIST_ID: {'✅ Configurato' if self.gist_id else '❌ Mancante'}"
+        ]
+
+    def _headers(self):
+        return {
+            'Authorization': f'token {self.token}',
+            'Accept': 'application/vnd.github.v3+json'
+        }
+
+    def _verifica_risposta(self, response):
+        if response.status_code in [200, 201]:
+            return
+        if response.status_code == 401:
+            print("❌ ERRORE 401 - Unauthorized")
+            print("🔍 Possibili cause:")
+            print("   • Token GitHub scaduto")
+            print("   • Token non ha permessi 'gist'")
+            print("   • Token revocato")
+        elif response.status_code == 404:
+            print("❌ ERRORE 404 - Gist non trovato")
+            print("🔍 Verifica che:")
+            print("   • Il GIST_ID sia corretto")
+            print("   • Il Gist esista ancora")
+            print("   • Il Gist non sia stato eliminato")
+        raise ErroreBackup(f"GitHub ha risposto {response.status_code} - {response.text[:200]}")
+
+    def _get_gist(self):
+        if not self.gist_id:
+            raise ErroreBackup("GIST_ID non configurato")
+        url = f'{self.API_URL}/gists/{self.gist_id}'
+        response = self.sessione.get(url, headers=self._headers(), timeout=HTTP_TIMEOUT)
+        self._verifica_risposta(response)
+        return response.json()
+
+    def salva_file(self, files):
+        if not self.token:
+            raise ErroreBackup("GITHUB_TOKEN non configurato")
+        payload_files = {
+            nome: (None if contenuto is None else {'content': contenuto})
+            for nome, contenuto in files.items()
+        }
+
+        if self.gist_id:
+            url = f'{self.API_URL}/gists/{self.gist_id}'
+            response = self.sessione.patch(url, headers=self._headers(), json={'files': payload_files}, timeout=HTTP_TIMEOUT)
+        else:
+            url = f'{self.API_URL}/gists'
+            data = {
+                'description': f'Backup Interventi VVF - {datetime.now().strftime("%Y-%m-%d %H:%M")}',
+                'public': False,
+                'files': {nome: f for nome, f in payload_files.items() if f is not None}
+            }
+            response = self.sessione.post(url, headers=self._headers(), json=data, timeout=HTTP_TIMEOUT)
+
+        self._verifica_risposta(response)
+        result = response.json()
+        print(f"✅ Gist aggiornato: {result.get('html_url')}")
+
+        if not self.gist_id:
+            self.gist_id = result['id']
+            print(f"📝 Nuovo Gist ID creato: {self.gist_id}")
+            print(f"⚠️  COPIA QUESTO GIST_ID NELLE VARIABILI AMBIENTE SU RENDER: {self.gist_id}")
+
+    def _metadati_file(self):
+        """Nome, dimensione e raw_url dei file del Gist senza scaricarne il contenuto.
+
+        GET /gists/{id} restituisce anche il contenuto (fino a 1MB per file) di tutte
+        le generazioni; l'elenco dei Gist dell'utente riporta solo i metadati.
+        """
+        if not self.gist_id:
+            raise ErroreBackup("GIST_ID non configurato")
+        for pagina in range(1, 11):
+            response = self.sessione.get(f'{self.API_URL}/gists', headers=self._headers(),
+                                         params={'per_page': 100, 'page': pagina}, timeout=HTTP_TIMEOUT)
+            self._verifica_risposta(response)
+            gists = response.json()
+            for gist in gists:
+                if gist['id'] == self.gist_id:
+                    return gist['files']
+            if len(gists) < 100:
+                break
+        # Gist di un altro utente: ripiego sul dettaglio completo
+        return self._get_gist()['files']
+
+    def leggi_file(self, nome_file):
+        file_info = self._metadati_file().get(nome_file)
+        if not file_info:
+            return None
+        response = self.sessione.get(file_info['raw_url'], headers=self._headers(), timeout=HTTP_TIMEOUT)
+        self._verifica_risposta(response)
+        return response.text
+
+    def elenca_file(self):
+        return list(self._metadati_file().keys())
+
+    @contextmanager
+    def apri_stream(self, nome_file, dimensione_blocco=RESTORE_DIMENSIONE_BLOCCO):
+        file_info = self._metadati_file().get(nome_file)
+        if not file_info:
+            raise ErroreBackup(f"File {nome_file} non trovato nel Gist")
+        response = self.sessione.get(file_info['raw_url'], headers=self._headers(), timeout=HTTP_TIMEOUT, stream=True)
+        try:
+            self._verifica_risposta(response)
+            yield response.iter_content(chunk_size=dimensione_blocco)
+        finally:
+            response.close()
+
+class BackendLocale(BackendBackup):
+    """Backend su directory locale: utilizzabile offline e nei test"""
+    nome = 'locale'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def configurato(self, per_restore=False):
+        return True
+
+    def stato_configurazione(self):
+        return [f"🔍 BACKUP_DIR: {os.path.abspath(self.directory)}"]
+
+    def _percorso(self, nome_file):
+        if os.path.basename(nome_file) != nome_file:
+            raise ErroreBackup(f"Nome file non valido: {nome_file}")
+        return os.path.join(self.directory, nome_file)
+
+    def salva_file(self, files):
+        os.makedirs(self.directory, exist_ok=True)
+        for nome_file, contenuto in files.items():
+            percorso = self._percorso(nome_file)
+            if contenuto is None:
+                if os.path.exists(percorso):
+                    os.remove(percorso)
+                continue
+            # Scrittura atomica: un backup interrotto non sovrascrive quello buono
+            temp = f"{percorso}.tmp"
+            with open(temp, 'w', encoding='utf-8') as f:
+                f.write(contenuto)
+            os.replace(temp, percorso)
+        print(f"✅ Backup locale aggiornato in: {os.path.abspath(self.directory)}")
+
+    def leggi_file(self, nome_file):
+        percorso = self._percorso(nome_file)
+        if not os.path.exists(percorso):
+            print(f"🔍 File disponibili in {self.directory}: {self.elenca_file()}")
+            return None
+        with open(percorso, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def elenca_file(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(f for f in os.listdir(self.directory) if not f.endswith('.tmp'))
+
+    @contextmanager
+    def apri_stream(self, nome_file, dimensione_blocco=RESTORE_DIMENSIONE_BLOCCO):
+        percorso = self._percorso(nome_file)
+        if not os.path.exists(percorso):
+            raise ErroreBackup(f"File {nome_file} non trovato in {self.directory}")
+        with open(percorso, 'rb') as f:
+            yield iter(lambda: f.read(dimensione_blocco), b'')
+
+def crea_backend_backup():
+    """Seleziona il backend di backup in base a BACKUP_BACKEND"""
+    if BACKUP_BACKEND == 'locale':
+        return BackendLocale(BACKUP_DIR)
+    return BackendGist(GITHUB_TOKEN, GIST_ID)
+
+# Istanza globale del backend di backup
+backend_backup = crea_backend_backup()
+
+# === GENERAZIONI DI BACKUP ===
+def crea_snapshot_database(destinazione):
+    """Copia consistente del database tramite l'API di backup di SQLite"""
+    sorgente = connetti_db()
+    copia = sqlite3.connect(destinazione)
+    try:
+        sorgente.backup(copia)
+    finally:
+        copia.close()
+        sorgente.close()
+
+def analizza_database(percorso):
+    """Restituisce (integro, righe_per_tabella) per il database indicato"""
+    conn = sqlite3.connect(percorso)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tabelle_esistenti = {row[0] for row in c.fetchall()}
+        righe = {}
+        for tabella in TABELLE_NECESSARIE:
+            if tabella in tabelle_esistenti:
+                c.execute(f"SELECT COUNT(*) FROM {tabella}")
+                righe[tabella] = c.fetchone()[0]
+        c.execute("PRAGMA quick_check")
+        integro = c.fetchone()[0] == 'ok' and len(righe) == len(TABELLE_NECESSARIE)
+        return integro, righe
+    except sqlite3.DatabaseError:
+        return False, {}
+    finally:
+        conn.close()
+
+# Confronto tra stati del database: le colonne che dipendono dall'orologio non contano
+TABELLE_CONFRONTO = ['interventi', 'partecipanti', 'vigili', 'mezzi']
+COLONNE_VOLATILI = {'created_at', 'data_uscita', 'data_rientro', 'data_richiesta', 'data_approvazione'}
+
+def impronta_database(percorso=DATABASE_NAME):
+    """Per ogni tabella di TABELLE_CONFRONTO: numero di righe e hash del contenuto stabile"""
+    conn = sqlite3.connect(percorso)
+    try:
+        impronte = {}
+        for tabella in TABELLE_CONFRONTO:
+            colonne = [riga[1] for riga in conn.execute(f"PRAGMA table_info({tabella})")
+                       if riga[1] not in COLONNE_VOLATILI]
+            elenco = ", ".join(colonne)
+            digest = hashlib.sha256()
+            righe = 0
+            for riga in conn.execute(f"SELECT {elenco} FROM {tabella} ORDER BY {elenco}"):
+                digest.update(repr(riga).encode('utf-8'))
+                righe += 1
+            impronte[tabella] = {'righe': righe, 'impronta': digest.hexdigest()[:16]}
+        return impronte
+    finally:
+        conn.close()
+
+def seleziona_generazioni_da_tenere(generazioni, adesso):
+    """Rotazione: una generazione per ora nelle ultime BACKUP_RETENTION_ORE ore,
+    una per giorno negli ultimi BACKUP_RETENTION_GIORNI giorni, le altre scadono"""
+    da_tenere = []
+    slot_occupati = set()
+    for gen in sorted(generazioni, key=lambda g: g['timestamp'], reverse=True):
+        eta = adesso - datetime.fromisoformat(gen['timestamp'])
+        if eta < timedelta(hours=BACKUP_RETENTION_ORE):
+            slot = ('ora', gen['timestamp'][:13])
+        elif eta < timedelta(days=BACKUP_RETENTION_GIORNI):
+            slot = ('giorno', gen['timestamp'][:10])
+        else:
+            continue
+        if slot not in slot_occupati:
+            slot_occupati.add(slot)
+            da_tenere.append(gen)
+    return da_tenere
+
+def leggi_indice_backup(backend):
+    """Restituisce le generazioni elencate nell'indice, dalla più recente"""
+    contenuto = backend.leggi_file(NOME_FILE_INDICE)
+    if not contenuto:
+        return []
+    indice = json.loads(contenuto)
+    return sorted(indice.get('generazioni', []), key=lambda g: g['timestamp'], reverse=True)
+
+def motivo_scarto_generazione(gen, precedenti):
+    """Controlli sui soli metadati dell'indice; None se la generazione è plausibile.
+
+    Il calo di righe si misura sulla sola generazione integra immediatamente
+    precedente: dopo una cancellazione voluta, già la generazione successiva
+    torna plausibile invece di essere scartata per tutta la retention.
+    """
+    if gen.get('integrita') != 'ok':
+        return "integrità non verificata al momento del backup"
+    righe = gen.get('righe', {})
+    mancanti = [t for t in TABELLE_NECESSARIE if t not in righe]
+    if mancanti:
+        return f"tabelle mancanti: {', '.join(mancanti)}"
+    precedente = next((p for p in precedenti if p.get('integrita') == 'ok'), None)
+    riferimento = precedente['righe'].get('interventi', 0) if precedente else 0
+    if riferimento and righe['interventi'] < riferimento * BACKUP_SOGLIA_CALO_RIGHE:
+        return f"interventi crollati a {righe['interventi']} (generazione precedente: {riferimento})"
+    return None
 
-# === SISTEMA BACKUP GITHUB GIST MIGLIORATO ===
-def backup_database_to_gist():
-    """Backup migliorato con gestione errori avanzata"""
-    if not GITHUB_TOKEN:
-        print("❌ Token GitHub non configurato - backup disabilitato")
+# === SISTEMA BACKUP ===
+# Scheduler, job e riavvio possono chiedere un backup insieme: uno alla volta
+lock_backup = threading.Lock()
+
+@durata_misurata('bot_backup_durata_secondi', esito=True)
+def backup_database(backend=None):
+    """Backup del database come nuova generazione sul backend configurato"""
+    with lock_backup:
+        return esegui_backup_database(backend or backend_backup)
+
+def esegui_backup_database(backend):
+    if not backend.configurato():
+        print(f"❌ Backend di backup '{backend.nome}' non configurato - backup disabilitato")
+        for riga in backend.stato_configurazione():
+            print(riga)
         return False
     
+    snapshot = f"{DATABASE_NAME}.snapshot"
     try:
         # Verifica che il database esista e sia leggibile
         if not os.path.exists(DATABASE_NAME):
             print("❌ Database non trovato per il backup")
             return False
-            
-        with open(DATABASE_NAME, 'rb') as f:
-            db_content = f.read()
         
-        if len(db_content) == 0:
-            print("❌ Database vuoto - backup saltato")
+        crea_snapshot_database(snapshot)
+        integro, righe = analizza_database(snapshot)
+        if not integro:
+            print(f"❌ Snapshot non integro - backup saltato (righe: {righe})")
             return False
         
-        db_base64 = base64.b64encode(db_content).decode('utf-8')
-        
-        files = {
-            'interventi_vvf_backup.json': {
-                'content': json.dumps({
-                    'timestamp': datetime.now().isoformat(),
-                    'database_size': len(db_content),
-                    'database_base64': db_base64,
-                    'backup_type': 'automatic',
-                    'version': '2.0'
-                })
-            }
-        }
-        
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
+        with open(snapshot, 'rb') as f:
+            db_content = f.read()
+        metriche.imposta('bot_backup_dimensione_byte', len(db_content))
+        
+        adesso = datetime.now().replace(microsecond=0)
+        generazione = {
+            'file': f"{PREFISSO_GENERAZIONE}{adesso.strftime('%Y%m%d_%H%M%S')}.b64",
+            'timestamp': adesso.isoformat(),
+            'database_size': len(db_content),
+            'sha256': hashlib.sha256(db_content).hexdigest(),
+            'righe': righe,
+            'integrita': 'ok'
         }
         
-        current_gist_id = os.environ.get('GIST_ID')
-        
-        if current_gist_id:
-            url = f'https://api.github.com/gists/{current_gist_id}'
-            data = {'files': files}
-            response = requests.patch(url, headers=headers, json=data)
-        else:
-            url = 'https://api.github.com/gists'
-            data = {
-                'description': f'Backup Interventi VVF - {datetime.now().strftime("%Y-%m-%d %H:%M")}',
-                'public': False,
-                'files': files
-            }
-            response = requests.post(url, headers=headers, json=data)
+        generazioni = leggi_indice_backup(backend)
+        tutte = [generazione] + generazioni
+        da_tenere = seleziona_generazioni_da_tenere(tutte, adesso)
+        
+        # La generazione plausibile più recente non scade mai: il backup di un
+        # database svuotato non deve far ruotare via l'ultima copia buona
+        for i, gen in enumerate(tutte):
+            if motivo_scarto_generazione(gen, tutte[i + 1:]) is None:
+                if gen not in da_tenere:
+                    da_tenere.append(gen)
+                    da_tenere.sort(key=lambda g: g['timestamp'], reverse=True)
+                break
         
-        if response.status_code in [200, 201]:
-            result = response.json()
-            print(f"✅ Backup su Gist completato: {result['html_url']}")
-            
-            if not current_gist_id:
-                new_gist_id = result['id']
-                print(f"📝 Nuovo Gist ID creato: {new_gist_id}")
-                print(f"⚠️  COPIA QUESTO GIST_ID NELLE VARIABILI AMBIENTE SU RENDER: {new_gist_id}")
-            
-            return True
-        else:
-            print(f"❌ Errore backup Gist: {response.status_code} - {response.text}")
-            return False
+        files = {generazione['file']: base64.b64encode(db_content).decode('ascii')}
+        esistenti = set(backend.elenca_file())
+        for gen in generazioni:
+            if gen not in da_tenere and gen['file'] in esistenti:
+                files[gen['file']] = None
+        files[NOME_FILE_INDICE] = json.dumps({
+            'version': '3.0',
+            'aggiornato': adesso.isoformat(),
+            'generazioni': da_tenere
+        }, indent=1)
+        
+        backend.salva_file(files)
+        scadute = sum(1 for contenuto in files.values() if contenuto is None)
+        print(f"✅ Backup su {backend.nome} completato: {generazione['file']} "
+              f"({len(da_tenere)} generazioni conservate, {scadute} scadute)")
+        return True
             
     except Exception as e:
         print(f"❌ Errore durante backup: {str(e)}")
         return False
+    finally:
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+def decodifica_base64_in_streaming(blocchi, destinazione):
+    """Decodifica base64 a blocchi direttamente su file.
+
+    In memoria resta solo il blocco corrente più al massimo 3 caratteri di resto.
+    Restituisce (byte scritti, sha256 esadecimale).
+    """
+    sha = hashlib.sha256()
+    scritti = 0
+    resto = b''
+    with open(destinazione, 'wb') as f:
+        for blocco in blocchi:
+            dati = resto + blocco.translate(None, b'\r\n ')
+            taglio = len(dati) - len(dati) % 4
+            decodificati = base64.b64decode(dati[:taglio], validate=True)
+            resto = dati[taglio:]
+            f.write(decodificati)
+            sha.update(decodificati)
+            scritti += len(decodificati)
+    if resto:
+        raise ValueError("Payload base64 troncato")
+    return scritti, sha.hexdigest()
+
+def sostituisci_database_ripristinato(temp_db, etichetta):
+    """Verifica il database ripristinato e, se valido, sostituisce quello corrente"""
+    integro, righe = analizza_database(temp_db)
+    print(f"🔍 Righe nel database ripristinato: {righe}")
+    
+    if integro:
+        # Sostituisci il database corrente
+        os.replace(temp_db, DATABASE_NAME)
+        invalida_cache_database()
+        print(f"✅ Database ripristinato da backup: {etichetta}")
+        return True
+    
+    print(f"❌ Database ripristinato non valido: {etichetta}")
+    os.remove(temp_db)
+    return False
 
-def restore_database_from_gist():
-    """Ripristino migliorato con verifica integrità e debug"""
-    current_gist_id = os.environ.get('GIST_ID')
-    if not GITHUB_TOKEN or not current_gist_id:
-        print("❌ Token o Gist ID non configurati - restore disabilitato")
-        print(f"🔍 GITHUB_TOKEN: {'✅ Configurato' if GITHUB_TOKEN else '❌ Mancante'}")
-        print(f"🔍 GIST_ID: {'✅ Configurato' if current_gist_id else '❌ Mancante'}")
+def restore_database(backend=None):
+    """Ripristino della generazione più recente che supera i controlli"""
+    backend = backend or backend_backup
+    if not backend.configurato(per_restore=True):
+        print(f"❌ Backend di backup '{backend.nome}' non configurato - restore disabilitato")
+        for riga in backend.stato_configurazione():
+            print(riga)
         return False
     
     try:
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        
-        url = f'https://api.github.com/gists/{current_gist_id}'
-        print(f"🔍 Tentativo di accesso a Gist: {current_gist_id}")
-        print(f"🔍 URL: {url}")
-        
-        response = requests.get(url, headers=headers)
-        
-        print(f"🔍 Status Code Ricevuto: {response.status_code}")
-        
-        if response.status_code == 200:
-            gist_data = response.json()
-            print(f"🔍 Gist trovato: {gist_data.get('description', 'Nessuna descrizione')}")
-            
-            backup_file = gist_data['files'].get('interventi_vvf_backup.json')
+        print(f"🔍 Lettura indice backup da backend: {backend.nome}")
+        generazioni = leggi_indice_backup(backend)
+        
+        if not generazioni:
+            return restore_database_legacy(backend)
+        
+        print(f"🔍 Generazioni disponibili: {len(generazioni)}")
+        scartate = []
+        for i, gen in enumerate(generazioni):
+            motivo = motivo_scarto_generazione(gen, generazioni[i + 1:])
+            if motivo:
+                print(f"⏭️ Generazione {gen['timestamp']} scartata: {motivo}")
+                scartate.append(gen['timestamp'])
+                continue
             
-            if backup_file:
-                print("🔍 File di backup trovato nel Gist")
-                backup_content = json.loads(backup_file['content'])
-                db_base64 = backup_content['database_base64']
-                timestamp = backup_content['timestamp']
-                
-                print(f"🔍 Backup timestamp: {timestamp}")
-                print(f"🔍 Dimensione database: {backup_content['database_size']} bytes")
-                
-                db_content = base64.b64decode(db_base64)
+            print(f"🔍 Download generazione {gen['timestamp']} ({gen['database_size']} bytes)")
+            temp_db = f"{DATABASE_NAME}.restored"
+            try:
+                try:
+                    with backend.apri_stream(gen['file']) as blocchi:
+                        dimensione, sha256 = decodifica_base64_in_streaming(blocchi, temp_db)
+                except (ErroreBackup, ValueError, requests.RequestException, OSError) as e:
+                    # Anche un errore di rete a metà download: si passa alla generazione precedente
+                    print(f"⏭️ Generazione {gen['file']} non leggibile: {e}")
+                    scartate.append(gen['timestamp'])
+                    continue
                 
-                # Salva il database temporaneamente
-                temp_db = f"{DATABASE_NAME}.restored"
-                with open(temp_db, 'wb') as f:
-                    f.write(db_content)
+                if dimensione != gen['database_size'] or sha256 != gen['sha256']:
+                    print(f"⏭️ Checksum non corrispondente per {gen['file']}")
+                    scartate.append(gen['timestamp'])
+                    continue
                 
-                # Verifica integrità del database ripristinato
-                try:
-                    conn = sqlite3.connect(temp_db)
-                    c = conn.cursor()
-                    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table'")
-                    table_count = c.fetchone()[0]
-                    conn.close()
-                    
-                    print(f"🔍 Tabelle trovate nel database ripristinato: {table_count}")
-                    
-                    if table_count >= 4:  # Almeno le tabelle principali
-                        # Sostituisci il database corrente
-                        if os.path.exists(DATABASE_NAME):
-                            os.remove(DATABASE_NAME)
-                        os.rename(temp_db, DATABASE_NAME)
-                        
-                        print(f"✅ Database ripristinato da backup: {timestamp}")
-                        return True
-                    else:
-                        print("❌ Database ripristinato non valido - tabelle insufficienti")
-                        os.remove(temp_db)
-                        return False
-                        
-                except Exception as e:
-                    print(f"❌ Database ripristinato corrotto: {e}")
-                    if os.path.exists(temp_db):
-                        os.remove(temp_db)
-                    return False
-            else:
-                print("❌ File di backup 'interventi_vvf_backup.json' non trovato nel Gist")
-                print(f"🔍 File disponibili nel Gist: {list(gist_data['files'].keys())}")
-                return False
-        elif response.status_code == 401:
-            print("❌ ERRORE 401 - Unauthorized")
-            print("🔍 Possibili cause:")
-            print("   • Token GitHub scaduto")
-            print("   • Token non ha permessi 'gist'")
-            print("   • Token revocato")
-            print(f"🔍 Response: {response.text}")
-            return False
-        elif response.status_code == 404:
-            print("❌ ERRORE 404 - Gist non trovato")
-            print("🔍 Verifica che:")
-            print("   • Il GIST_ID sia corretto")
-            print("   • Il Gist esista ancora")
-            print("   • Il Gist non sia stato eliminato")
-            return False
-        else:
-            print(f"❌ Errore recupero Gist: {response.status_code}")
-            print(f"🔍 Response: {response.text}")
-            return False
+                if sostituisci_database_ripristinato(temp_db, gen['timestamp']):
+                    if scartate:
+                        # I dati scritti dopo questa generazione non sono stati ripristinati
+                        print(f"⚠️⚠️⚠️ ATTENZIONE: ripristinata la generazione {gen['timestamp']}, "
+                              f"NON la più recente! Generazioni scartate: {', '.join(scartate)}")
+                    return True
+                scartate.append(gen['timestamp'])
+            finally:
+                # Dopo una sostituzione riuscita il file temporaneo non esiste più
+                if os.path.exists(temp_db):
+                    os.remove(temp_db)
+        
+        print("❌ Nessuna generazione di backup valida")
+        return False
             
     except Exception as e:
         print(f"❌ Errore durante restore: {str(e)}")
@@ -441,12 +1753,32 @@ def restore_database_from_gist():
         print(f"🔍 Traceback: {traceback.format_exc()}")
         return False
 
+def restore_database_legacy(backend):
+    """Ripristino dal file unico dei backup precedenti alla rotazione"""
+    contenuto = backend.leggi_file(NOME_FILE_BACKUP)
+    
+    if not contenuto:
+        print(f"❌ Né indice né file di backup '{NOME_FILE_BACKUP}' trovati")
+        return False
+    
+    print("🔍 File di backup (formato precedente) trovato")
+    backup_content = json.loads(contenuto)
+    timestamp = backup_content['timestamp']
+    
+    print(f"🔍 Backup timestamp: {timestamp}")
+    print(f"🔍 Dimensione database: {backup_content['database_size']} bytes")
+    
+    temp_db = f"{DATABASE_NAME}.restored"
+    with open(temp_db, 'wb') as f:
+        f.write(base64.b64decode(backup_content['database_base64']))
+    return sostituisci_database_ripristinato(temp_db, timestamp)
+
 def enhanced_restore_on_startup():
     """Ripristino automatico all'avvio con multiple tentativi"""
-    if not GITHUB_TOKEN or not GIST_ID:
-        print("❌ Token GitHub o GIST_ID non configurato - restore disabilitato")
-        print(f"🔍 GITHUB_TOKEN: {'✅ Configurato' if GITHUB_TOKEN else '❌ Mancante'}")
-        print(f"🔍 GIST_ID: {'✅ Configurato' if GIST_ID else '❌ Mancante'}")
+    if not backend_backup.configurato(per_restore=True):
+        print(f"❌ Backend di backup '{backend_backup.nome}' non configurato - restore disabilitato")
+        for riga in backend_backup.stato_configurazione():
+            print(riga)
         return False
     
     print("🔄 Tentativo di ripristino database all'avvio...")
@@ -455,8 +1787,8 @@ def enhanced_restore_on_startup():
     for attempt in range(max_attempts):
         print(f"🔄 Tentativo {attempt + 1} di {max_attempts}...")
         
-        if restore_database_from_gist():
-            print("✅ Database ripristinato con successo da Gist!")
+        if restore_database():
+            print(f"✅ Database ripristinato con successo da {backend_backup.nome}!")
             
             # Verifica finale integrità
             if sistema_robustezza.verifica_integrita_database():
@@ -470,54 +1802,102 @@ def enhanced_restore_on_startup():
     print("❌ Ripristino fallito dopo tutti i tentativi")
     return False
 
-def backup_scheduler():
-    """Scheduler backup migliorato con gestione errori"""
+def restore_in_background():
+    """Ripristino e verifica del database in parallelo all'avvio del bot"""
+    stato_avvio.imposta_stato('restoring')
+    try:
+        with stato_avvio.fase('restore'):
+            if not enhanced_restore_on_startup():
+                print("🔄 Database non ripristinato - uso database locale")
+        
+        with stato_avvio.fase('verifica_integrita'):
+            if not sistema_robustezza.verifica_integrita_database():
+                print("❌ Integrità database non verificata - rigenerazione...")
+                sistema_robustezza.rigenera_database_se_necessario()
+            aggiorna_schema_database()
+    except Exception as e:
+        print(f"❌ Errore nel ripristino all'avvio: {e}")
+    finally:
+        stato_avvio.imposta_stato('avvio_bot')
+        stato_avvio.restore_completato.set()
+
+async def backup_scheduler():
+    """Scheduler backup: ogni 30 minuti, mai prima del restore"""
     print("🔄 Scheduler backup avviato (ogni 30 minuti)")
     
-    # Attesa iniziale per permettere l'avvio completo
-    time.sleep(30)
+    # Attesa iniziale per permettere l'avvio completo: mai backup prima del restore
+    await asyncio.sleep(30)
+    await supervisore.attendi_evento(stato_avvio.restore_completato)
     
-    # Backup immediato all'avvio
+    # Backup immediato all'avvio, poi ciclo ogni 30 minuti
     print("🔄 Backup iniziale in corso...")
-    if backup_database_to_gist():
-        print("✅ Backup iniziale completato")
-    else:
-        print("❌ Backup iniziale fallito")
-    
-    # Ciclo principale ogni 30 minuti
     while True:
-        try:
-            time.sleep(1800)  # 30 minuti
-            
-            print("🔄 Backup automatico in corso...")
-            if backup_database_to_gist():
-                print("✅ Backup automatico completato")
+        if await supervisore.in_thread(backup_database):
+            print("✅ Backup automatico completato")
+        else:
+            print("❌ Backup automatico fallito")
+        await asyncio.sleep(1800)  # 30 minuti
+
+# === CACHE RUOLI UTENTI ===
+class CacheRuoli:
+    """user_id -> ruolo in memoria: i controlli di autorizzazione non toccano il database.
+
+    Caricata per intero all'avvio (o alla prima lettura) e tenuta allineata
+    dalle scritture: start, approva_utente e rimuovi_utente aggiornano la
+    singola voce, import e restore la invalidano. Con RUOLI_CACHE_TTL_SECONDI
+    viene comunque ricaricata periodicamente.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ruoli = None
+        self._caricata = None
+
+    @query_misurata
+    def carica(self):
+        # Sotto lock: una scrittura concorrente non può essere sovrascritta da una lettura più vecchia
+        with self._lock:
+            conn = connetti_db()
+            c = conn.cursor()
+            c.execute("SELECT user_id, ruolo FROM utenti")
+            self._ruoli = dict(c.fetchall())
+            conn.close()
+            self._caricata = time.monotonic()
+            return self._ruoli
+
+    def invalida(self):
+        """Dopo scritture massive sugli utenti: ricarica alla prossima lettura"""
+        with self._lock:
+            self._ruoli = None
+
+    def ruolo(self, user_id):
+        ruoli = self._ruoli
+        if ruoli is None or (RUOLI_CACHE_TTL_SECONDI and time.monotonic() - self._caricata > RUOLI_CACHE_TTL_SECONDI):
+            ruoli = self.carica()
+        return ruoli.get(user_id)
+
+    def imposta(self, user_id, ruolo):
+        """Write-through dopo il commit; ruolo None = utente rimosso"""
+        with self._lock:
+            if self._ruoli is None:
+                return
+            if ruolo is None:
+                self._ruoli.pop(user_id, None)
             else:
-                print("❌ Backup automatico fallito")
-                
-        except Exception as e:
-            print(f"❌ Errore nello scheduler backup: {e}")
-            time.sleep(300)  # Aspetta 5 minuti in caso di errore
+                self._ruoli[user_id] = ruolo
+
+# Istanza globale della cache dei ruoli
+ruoli_utenti = CacheRuoli()
 
 # === FUNZIONI UTILITY ===
 def is_admin(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("SELECT ruolo FROM utenti WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result and result[0] == 'admin'
+    return ruoli_utenti.ruolo(user_id) == 'admin'
 
 def is_user_approved(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("SELECT ruolo FROM utenti WHERE user_id = ? AND ruolo IN ('admin', 'user')", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result is not None
+    return ruoli_utenti.ruolo(user_id) in ('admin', 'user')
 
+@query_misurata
 def get_richieste_in_attesa():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT user_id, username, nome, telefono, data_richiesta 
                  FROM utenti WHERE ruolo = 'in_attesa' ORDER BY data_richiesta''')
@@ -525,8 +1905,9 @@ def get_richieste_in_attesa():
     conn.close()
     return result
 
+@query_misurata
 def get_utenti_approvati():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT user_id, username, nome, telefono, ruolo, data_approvazione 
                  FROM utenti WHERE ruolo IN ('admin', 'user') ORDER BY nome''')
@@ -534,40 +1915,49 @@ def get_utenti_approvati():
     conn.close()
     return result
 
+@query_misurata
 def approva_utente(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''UPDATE utenti SET ruolo = 'user', data_approvazione = CURRENT_TIMESTAMP 
                  WHERE user_id = ?''', (user_id,))
+    aggiornato = c.rowcount
     conn.commit()
     conn.close()
+    if aggiornato:
+        ruoli_utenti.imposta(user_id, 'user')
 
+@query_misurata
 def rimuovi_utente(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute("DELETE FROM utenti WHERE user_id = ?", (user_id,))
     conn.commit()
     conn.close()
+    ruoli_utenti.imposta(user_id, None)
 
+@query_misurata
 def aggiorna_telefono_utente(user_id, telefono):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''UPDATE utenti SET telefono = ? WHERE user_id = ?''', (telefono, user_id))
     conn.commit()
     conn.close()
 
 # === FUNZIONI INTERVENTI ===
+@query_misurata
 def get_prossimo_numero_erba():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute("SELECT MAX(numero_erba) FROM interventi")
     result = c.fetchone()[0]
     conn.close()
     return (result or 0) + 1
 
+@query_misurata
 def get_ultimi_interventi_attivi():
     """Restituisce gli ultimi interventi (sia attivi che completati)"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT id, rapporto_como, progressivo_como, numero_erba, data_uscita, indirizzo, data_rientro
                  FROM interventi 
@@ -576,8 +1966,9 @@ def get_ultimi_interventi_attivi():
     conn.close()
     return result
 
+@query_misurata
 def get_ultimi_15_interventi():
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT id, rapporto_como, progressivo_como, numero_erba, data_uscita, indirizzo
                  FROM interventi 
@@ -586,8 +1977,9 @@ def get_ultimi_15_interventi():
     conn.close()
     return result
 
+@query_misurata
 def get_interventi_per_rapporto(rapporto, anno):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT * FROM interventi 
                  WHERE rapporto_como = ? AND strftime('%Y', data_uscita) = ?
@@ -596,8 +1988,9 @@ def get_interventi_per_rapporto(rapporto, anno):
     conn.close()
     return result
 
+@query_misurata
 def get_interventi_per_anno(anno):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT * FROM interventi 
                  WHERE strftime('%Y', data_uscita) = ?
@@ -606,8 +1999,9 @@ def get_interventi_per_anno(anno):
     conn.close()
     return result
 
+@query_misurata
 def get_intervento_by_rapporto(rapporto, progressivo):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT * FROM interventi 
                  WHERE rapporto_como = ? AND progressivo_como = ?''', (rapporto, progressivo))
@@ -615,8 +2009,9 @@ def get_intervento_by_rapporto(rapporto, progressivo):
     conn.close()
     return result
 
+@query_misurata
 def get_ultimi_km_mezzo(targa):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT km_finali FROM interventi 
                  WHERE mezzo_targa = ? AND km_finali IS NOT NULL 
@@ -625,16 +2020,19 @@ def get_ultimi_km_mezzo(targa):
     conn.close()
     return result[0] if result else 0
 
+@query_misurata
 def aggiorna_intervento(rapporto, progressivo, campo, valore):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute(f"UPDATE interventi SET {campo} = ? WHERE rapporto_como = ? AND progressivo_como = ?", 
               (valore, rapporto, progressivo))
     conn.commit()
     conn.close()
+    riepilogo_servizio.invalida()
 
+@query_misurata
 def get_progressivo_per_rapporto(rapporto):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT progressivo_como FROM interventi 
                  WHERE rapporto_como = ? 
@@ -650,8 +2048,9 @@ def get_progressivo_per_rapporto(rapporto):
             return "02"
     return "01"
 
+@query_misurata
 def get_ultimo_indirizzo_per_rapporto(rapporto):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT indirizzo FROM interventi 
                  WHERE rapporto_como = ? 
@@ -660,8 +2059,9 @@ def get_ultimo_indirizzo_per_rapporto(rapporto):
     conn.close()
     return result[0] if result else ""
 
+@query_misurata
 def get_ultima_tipologia_per_rapporto(rapporto):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT tipologia FROM interventi 
                  WHERE rapporto_como = ? 
@@ -676,8 +2076,9 @@ def normalizza_comune(comune):
         return ""
     return ' '.join(word.capitalize() for word in comune.split())
 
+@query_misurata
 def inserisci_intervento(dati):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     
     try:
@@ -701,6 +2102,7 @@ def inserisci_intervento(dati):
                       (intervento_id, vigile_id))
         
         conn.commit()
+        riepilogo_servizio.invalida()
         return intervento_id
     except Exception as e:
         conn.rollback()
@@ -708,8 +2110,9 @@ def inserisci_intervento(dati):
     finally:
         conn.close()
 
+@query_misurata
 def get_ultimi_interventi(limite=10):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT i.*, 
                  GROUP_CONCAT(v.nome || ' ' || v.cognome) as partecipanti
@@ -739,8 +2142,9 @@ def calcola_durata_intervento(data_uscita, data_rientro):
     except:
         return "N/A"
 
+@query_misurata
 def get_statistiche_anno(anno=None):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     
     if anno:
@@ -799,9 +2203,10 @@ def get_statistiche_anno(anno=None):
         'mensili': dict(mensili)
     }
 
+@query_misurata
 def get_anni_disponibili():
     """Restituisce la lista degli anni per cui ci sono interventi"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT DISTINCT strftime('%Y', data_uscita) as anno 
                  FROM interventi 
@@ -810,53 +2215,96 @@ def get_anni_disponibili():
     conn.close()
     return anni
 
+# === CATALOGO VIGILI E MEZZI ===
+# Stesse colonne di SELECT *: le righe si spacchettano come prima
+Vigile = namedtuple('Vigile', ['id', 'nome', 'cognome', 'qualifica', 'grado_patente_terrestre',
+                               'patente_nautica', 'saf', 'tpss', 'atp', 'attivo'])
+Mezzo = namedtuple('Mezzo', ['id', 'targa', 'tipo', 'attivo'])
+
+def chiave_ordine_sql(*valori):
+    """Chiave di ordinamento come ORDER BY di SQLite sui testi (NULL per primi)"""
+    return tuple((valore is not None, str(valore) if valore is not None else '') for valore in valori)
+
+class CatalogoAnagrafiche:
+    """Vigili e mezzi in memoria, indicizzati per id e per targa.
+
+    Il database viene letto una volta per versione: aggiungi_vigile,
+    aggiorna_vigile, aggiungi_mezzo, gli import e il restore incrementano
+    la versione e la lettura successiva ricarica tutto. Chi costruisce
+    qualcosa a partire dal catalogo può usare la versione come chiave.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dati = None
+        self.versione = 0
+
+    def invalida(self):
+        """Dopo ogni scrittura su vigili o mezzi"""
+        with self._lock:
+            self.versione += 1
+            self._dati = None
+
+    @query_misurata
+    def carica_catalogo(self):
+        conn = connetti_db()
+        c = conn.cursor()
+        c.execute("SELECT * FROM vigili ORDER BY id")
+        vigili = [Vigile(*riga) for riga in c.fetchall()]
+        c.execute("SELECT * FROM mezzi ORDER BY id")
+        mezzi = [Mezzo(*riga) for riga in c.fetchall()]
+        conn.close()
+        
+        vigili_ordinati = sorted(vigili, key=lambda v: chiave_ordine_sql(v.cognome, v.nome))
+        mezzi_per_tipo = sorted(mezzi, key=lambda m: chiave_ordine_sql(m.tipo))
+        return {
+            'vigili_per_id': {v.id: v for v in vigili},
+            'mezzi_per_targa': {m.targa: m for m in mezzi},
+            'tutti_vigili': tuple(vigili_ordinati),
+            'vigili_attivi': tuple((v.id, v.nome, v.cognome, v.qualifica) for v in vigili_ordinati if v.attivo == 1),
+            'tutti_mezzi': tuple(sorted(mezzi, key=lambda m: chiave_ordine_sql(m.tipo, m.targa))),
+            'mezzi_attivi': tuple((m.targa, m.tipo) for m in mezzi_per_tipo if m.attivo == 1),
+        }
+
+    def dati(self):
+        dati = self._dati
+        if dati is None:
+            # Sotto lock: una invalida() concorrente non viene persa
+            with self._lock:
+                if self._dati is None:
+                    self._dati = self.carica_catalogo()
+                dati = self._dati
+        return dati
+
+# Istanza globale del catalogo
+catalogo = CatalogoAnagrafiche()
+
+def invalida_cache_database():
+    """Il file del database è stato sostituito (restore, strumenti di test): si rilegge tutto"""
+    riepilogo_servizio.invalida()
+    ruoli_utenti.invalida()
+    catalogo.invalida()
+
 # === FUNZIONI VIGILI E MEZZI ===
 def get_vigili_attivi():
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''SELECT id, nome, cognome, qualifica FROM vigili WHERE attivo = 1 ORDER BY cognome, nome''')
-    result = c.fetchall()
-    conn.close()
-    return result
+    return catalogo.dati()['vigili_attivi']
 
 def get_vigile_by_id(vigile_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''SELECT * FROM vigili WHERE id = ?''', (vigile_id,))
-    result = c.fetchone()
-    conn.close()
-    return result
+    return catalogo.dati()['vigili_per_id'].get(vigile_id)
+
+def get_mezzo_by_targa(targa):
+    return catalogo.dati()['mezzi_per_targa'].get(targa)
 
 def get_mezzi_attivi():
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''SELECT targa, tipo FROM mezzi WHERE attivo = 1 ORDER BY tipo''')
-    result = c.fetchall()
-    conn.close()
-    return result
+    return catalogo.dati()['mezzi_attivi']
 
 def get_tutti_vigili():
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''SELECT * FROM vigili ORDER BY cognome, nome''')
-    result = c.fetchall()
-    conn.close()
-    return result
+    return catalogo.dati()['tutti_vigili']
 
 def get_tutti_mezzi():
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''SELECT * FROM mezzi ORDER BY tipo, targa''')
-    result = c.fetchall()
-    conn.close()
-    return result
+    return catalogo.dati()['tutti_mezzi']
 
 def get_tipi_mezzo():
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''SELECT DISTINCT tipo FROM mezzi ORDER BY tipo''')
-    result = [row[0] for row in c.fetchall()]
-    conn.close()
+    result = list({mezzo.tipo for mezzo in get_tutti_mezzi()})
     
     for tipo in TIPI_MEZZO_PREDEFINITI:
         if tipo not in result:
@@ -864,15 +2312,18 @@ def get_tipi_mezzo():
     
     return sorted(result)
 
+@query_misurata
 def aggiorna_vigile(vigile_id, campo, valore):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute(f"UPDATE vigili SET {campo} = ? WHERE id = ?", (valore, vigile_id))
     conn.commit()
     conn.close()
+    catalogo.invalida()
 
+@query_misurata
 def aggiungi_vigile(nome, cognome, qualifica, grado_patente, patente_nautica=False, saf=False, tpss=False, atp=False):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''INSERT INTO vigili 
                 (nome, cognome, qualifica, grado_patente_terrestre, patente_nautica, saf, tpss, atp) 
@@ -881,357 +2332,421 @@ def aggiungi_vigile(nome, cognome, qualifica, grado_patente, patente_nautica=Fal
     conn.commit()
     vigile_id = c.lastrowid
     conn.close()
+    catalogo.invalida()
     return vigile_id
 
+@query_misurata
 def aggiungi_mezzo(targa, tipo):
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''INSERT OR REPLACE INTO mezzi (targa, tipo) VALUES (?, ?)''', (targa, tipo))
     conn.commit()
     conn.close()
-
-# === INVIO AUTOMATICO CSV AGLI ADMIN ===
-async def invia_csv_automatico_admin(context):
-    """Funzione per inviare automaticamente i CSV agli admin"""
-    try:
-        # Crea i file CSV
-        files_to_send = []
-        
-        # 1. Interventi con partecipanti (SENZA INDIRIZZO)
-        interventi = get_ultimi_interventi(10000)
-        if interventi:
-            output = StringIO()
-            writer = csv.writer(output)
-            # HEADER SENZA INDIRIZZO
-            writer.writerow(['Numero_Erba', 'Rapporto_Como', 'Progressivo', 'Data_Uscita', 'Data_Rientro', 
-                           'Mezzo_Targa', 'Mezzo_Tipo', 'Capopartenza', 'Autista', 'Partecipanti', 'Comune', 'Via', 
-                           'Tipologia', 'Cambio_Personale', 'Km_Finali', 'Litri_Riforniti'])
-            
-            for intervento in interventi:
-                if len(intervento) >= 18:
-                    id_int, rapporto, progressivo, num_erba, data_uscita, data_rientro, mezzo_targa, mezzo_tipo, capo, autista, comune, via, indirizzo, tipologia, cambio_personale, km_finali, litri_riforniti, created_at = intervento[:18]
-                    
-                    # Recupera i partecipanti
-                    partecipanti_nomi = []
-                    conn = sqlite3.connect(DATABASE_NAME)
-                    c = conn.cursor()
-                    c.execute('''SELECT v.nome, v.cognome 
-                                 FROM partecipanti p 
-                                 JOIN vigili v ON p.vigile_id = v.id 
-                                 WHERE p.intervento_id = ?''', (id_int,))
-                    partecipanti = c.fetchall()
-                    conn.close()
-                    
-                    for nome, cognome in partecipanti:
-                        partecipanti_nomi.append(f"{cognome} {nome}")
-                    
-                    partecipanti_str = "; ".join(partecipanti_nomi)
-                    
-                    try:
-                        data_uscita_fmt = datetime.strptime(data_uscita, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M')
-                    except:
-                        data_uscita_fmt = data_uscita
-                    
-                    try:
-                        data_rientro_fmt = datetime.strptime(data_rientro, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M') if data_rientro else ''
-                    except:
-                        data_rientro_fmt = data_rientro or ''
-                    
-                    # WRITEROW SENZA INDIRIZZO
-                    writer.writerow([
-                        num_erba, rapporto, progressivo, data_uscita_fmt, data_rientro_fmt,
-                        mezzo_targa, mezzo_tipo, capo, autista, partecipanti_str, comune, via, 
-                        tipologia or '', 'Sì' if cambio_personale else 'No',
-                        km_finali or '', litri_riforniti or ''
-                    ])
-            
-            csv_data = output.getvalue()
-            output.close()
-            csv_bytes = csv_data.encode('utf-8')
-            files_to_send.append(('db_interventi.csv', csv_bytes))
-        
-        # 2. Vigili
-        vigili = get_tutti_vigili()
-        if vigili:
-            output = StringIO()
-            writer = csv.writer(output)
-            writer.writerow(['Nome', 'Cognome', 'Qualifica', 'Grado_Patente', 'Patente_Nautica', 'SAF', 'TPSS', 'ATP', 'Stato'])
-            
-            for vigile in vigili:
-                id_v, nome, cognome, qualifica, grado, nautica, saf, tpss, atp, attivo = vigile
-                writer.writerow([
-                    nome, cognome, qualifica, grado,
-                    1 if nautica else 0,
-                    1 if saf else 0,
-                    1 if tpss else 0,
-                    1 if atp else 0,
-                    1 if attivo else 0
-                ])
-            
-            csv_data = output.getvalue()
-            output.close()
-            csv_bytes = csv_data.encode('utf-8')
-            files_to_send.append(('db_vigili.csv', csv_bytes))
-        
-        # 3. Mezzi
-        mezzi = get_tutti_mezzi()
-        if mezzi:
-            output = StringIO()
-            writer = csv.writer(output)
-            writer.writerow(['Targa', 'Tipo', 'Stato'])
-            
-            for mezzo in mezzi:
-                id_m, targa, tipo, attivo = mezzo
-                writer.writerow([
-                    targa, tipo,
-                    1 if attivo else 0
-                ])
+    catalogo.invalida()
+
+# === GENERAZIONE CSV ===
+INTESTAZIONE_CSV_INTERVENTI = [
+    'Numero_Erba', 'Rapporto_Como', 'Progressivo', 'Data_Uscita', 'Data_Rientro',
+    'Mezzo_Targa', 'Mezzo_Tipo', 'Capopartenza', 'Autista', 'Partecipanti', 'Comune', 'Via', 
+    'Tipologia', 'Cambio_Personale', 'Km_Finali', 'Litri_Riforniti'
+]
+
+@durata_misurata('bot_export_durata_secondi', tipo='interventi', origine='automatico')
+def genera_csv_interventi(interventi):
+    """CSV interventi con partecipanti (SENZA INDIRIZZO) a partire dalle righe della tabella"""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(INTESTAZIONE_CSV_INTERVENTI)
+    
+    conn = connetti_db()
+    c = conn.cursor()
+    for intervento in interventi:
+        if len(intervento) >= 18:
+            id_int, rapporto, progressivo, num_erba, data_uscita, data_rientro, mezzo_targa, mezzo_tipo, capo, autista, comune, via, indirizzo, tipologia, cambio_personale, km_finali, litri_riforniti, created_at = intervento[:18]
             
-            csv_data = output.getvalue()
-            output.close()
-            csv_bytes = csv_data.encode('utf-8')
-            files_to_send.append(('db_mezzi.csv', csv_bytes))
-        
-        # 4. Utenti
-        utenti = get_utenti_approvati()
-        if utenti:
-            output = StringIO()
-            writer = csv.writer(output)
-            writer.writerow(['user_id', 'username', 'nome', 'telefono', 'ruolo', 'data_approvazione'])
+            # Recupera i partecipanti
+            c.execute('''SELECT v.nome, v.cognome 
+                         FROM partecipanti p 
+                         JOIN vigili v ON p.vigile_id = v.id 
+                         WHERE p.intervento_id = ?''', (id_int,))
+            partecipanti_str = "; ".join(f"{cognome} {nome}" for nome, cognome in c.fetchall())
             
-            for utente in utenti:
-                user_id, username, nome, telefono, ruolo, data_approvazione = utente
-                writer.writerow([
-                    user_id,
-                    username or '',
-                    nome or '',
-                    telefono or '',
-                    ruolo,
-                    data_approvazione or ''
-                ])
+            try:
+                data_uscita_fmt = datetime.strptime(data_uscita, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M')
+            except:
+                data_uscita_fmt = data_uscita
             
-            csv_data = output.getvalue()
-            output.close()
-            csv_bytes = csv_data.encode('utf-8')
-            files_to_send.append(('db_user.csv', csv_bytes))
-        
-        # Invia i file a tutti gli admin
-        for admin_id in ADMIN_IDS:
             try:
-                for filename, csv_bytes in files_to_send:
-                    csv_file = BytesIO(csv_bytes)
-                    csv_file.name = filename
-                    
-                    await context.bot.send_document(
-                        chat_id=admin_id,
-                        document=csv_file,
-                        filename=filename,
-                        caption=f"📊 Backup automatico - {datetime.now().strftime('%d/%m/%Y %H:%M')}"
-                    )
-                    time.sleep(1)  # Piccola pausa tra i file
-                
-                print(f"✅ CSV inviati automaticamente all'admin {admin_id}")
-                
-            except Exception as e:
-                print(f"❌ Errore nell'invio a admin {admin_id}: {e}")
-        
-    except Exception as e:
-        print(f"❌ Errore generale nell'invio automatico CSV: {e}")
-# === SCHEDULER CSV MIGLIORATO ===
-def scheduler_csv_migliorato():
-    """Scheduler CSV con logiche specifiche"""
-    print("⏰ Scheduler CSV avviato - Invii differenziati attivi")
+                data_rientro_fmt = datetime.strptime(data_rientro, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M') if data_rientro else ''
+            except:
+                data_rientro_fmt = data_rientro or ''
+            
+            writer.writerow([
+                num_erba, rapporto, progressivo, data_uscita_fmt, data_rientro_fmt,
+                mezzo_targa, mezzo_tipo, capo, autista, partecipanti_str, comune, via, 
+                tipologia or '', 'Sì' if cambio_personale else 'No',
+                km_finali or '', litri_riforniti or ''
+            ])
+    conn.close()
+    
+    metriche.incrementa('bot_export_righe_totale', len(interventi), tipo='interventi', origine='automatico')
+    return output.getvalue().encode('utf-8')
+
+@durata_misurata('bot_export_durata_secondi', tipo='vigili', origine='automatico')
+def genera_csv_vigili(vigili):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Nome', 'Cognome', 'Qualifica', 'Grado_Patente', 'Patente_Nautica', 'SAF', 'TPSS', 'ATP', 'Stato'])
     
-    ultimo_invio_super_admin = None
-    ultimo_invio_utenti = None
+    for vigile in vigili:
+        id_v, nome, cognome, qualifica, grado, nautica, saf, tpss, atp, attivo = vigile
+        writer.writerow([
+            nome, cognome, qualifica, grado,
+            1 if nautica else 0,
+            1 if saf else 0,
+            1 if tpss else 0,
+            1 if atp else 0,
+            1 if attivo else 0
+        ])
     
-    while True:
+    metriche.incrementa('bot_export_righe_totale', len(vigili), tipo='vigili', origine='automatico')
+    return output.getvalue().encode('utf-8')
+
+@durata_misurata('bot_export_durata_secondi', tipo='mezzi', origine='automatico')
+def genera_csv_mezzi(mezzi):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['Targa', 'Tipo', 'Stato'])
+    
+    for mezzo in mezzi:
+        id_m, targa, tipo, attivo = mezzo
+        writer.writerow([
+            targa, tipo,
+            1 if attivo else 0
+        ])
+    
+    metriche.incrementa('bot_export_righe_totale', len(mezzi), tipo='mezzi', origine='automatico')
+    return output.getvalue().encode('utf-8')
+
+@durata_misurata('bot_export_durata_secondi', tipo='utenti', origine='automatico')
+def genera_csv_utenti(utenti):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['user_id', 'username', 'nome', 'telefono', 'ruolo', 'data_approvazione'])
+    
+    for utente in utenti:
+        user_id, username, nome, telefono, ruolo, data_approvazione = utente
+        writer.writerow([
+            user_id,
+            username or '',
+            nome or '',
+            telefono or '',
+            ruolo,
+            data_approvazione or ''
+        ])
+    
+    metriche.incrementa('bot_export_righe_totale', len(utenti), tipo='utenti', origine='automatico')
+    return output.getvalue().encode('utf-8')
+
+def prepara_csv_completi():
+    """I quattro CSV del backup completo come lista di (nome_file, bytes)"""
+    files_to_send = []
+    
+    interventi = get_ultimi_interventi(10000)
+    if interventi:
+        files_to_send.append(('db_interventi.csv', genera_csv_interventi(interventi)))
+    
+    vigili = get_tutti_vigili()
+    if vigili:
+        files_to_send.append(('db_vigili.csv', genera_csv_vigili(vigili)))
+    
+    mezzi = get_tutti_mezzi()
+    if mezzi:
+        files_to_send.append(('db_mezzi.csv', genera_csv_mezzi(mezzi)))
+    
+    utenti = get_utenti_approvati()
+    if utenti:
+        files_to_send.append(('db_user.csv', genera_csv_utenti(utenti)))
+    
+    return files_to_send
+
+# === INVIO AUTOMATICO CSV AGLI ADMIN ===
+def errore_invio_definitivo(errore):
+    """Bot bloccato o chat inesistente: ritentare non serve"""
+    if isinstance(errore, Forbidden):
+        return True
+    return isinstance(errore, BadRequest) and 'chat not found' in str(errore).lower()
+
+async def invia_ai_destinatari(destinatari, invia, consegne=None):
+    """Chiama invia(chat_id) per ogni destinatario; uno irraggiungibile non blocca gli altri.
+
+    Con consegne (registro dello slot di un job) salta chi ha già ricevuto e
+    registra ogni esito. Gli errori definitivi non si ritentano; RuntimeError
+    se qualche invio è fallito per un errore temporaneo.
+    """
+    da_servire = consegne.da_servire(destinatari) if consegne else list(destinatari)
+    falliti = []
+    for chat_id in da_servire:
         try:
-            now = datetime.now()
-            giorno_settimana = now.weekday()  # 0=lunedì, 6=domenica
-            ora_corrente = now.hour
-            minuto_corrente = now.minute
-            giorno_mese = now.day
-            
-            # DEBUG: Log ogni ora per monitorare
-            if minuto_corrente == 0:
-                print(f"⏰ Scheduler attivo - {now.strftime('%d/%m/%Y %H:%M')} - Giorno settimana: {giorno_settimana}")
-            
-            # ⭐⭐ INVIO 1: CSV INTERVENTI ANNO CORRENTE AL SUPER ADMIN - OGNI GIORNO 23:55 ⭐⭐
-            if ora_corrente == 23 and minuto_corrente == 55:
-                oggi = now.date()
-                
-                # Controlla se non abbiamo già inviato oggi al super admin
-                if ultimo_invio_super_admin != oggi:
-                    print(f"🦸 Invio CSV interventi {now.year} al SUPER ADMIN...")
-                    
-                    # Prepara CSV interventi anno corrente
-                    anno_corrente = now.year
-                    interventi_anno = get_interventi_per_anno(str(anno_corrente))
-                    
-                    if interventi_anno:
-                        output = StringIO()
-                        writer = csv.writer(output)
-                        
-                        writer.writerow([
-                            'Numero_Erba', 'Rapporto_Como', 'Progressivo', 'Data_Uscita', 'Data_Rientro',
-                            'Mezzo_Targa', 'Mezzo_Tipo', 'Capopartenza', 'Autista', 'Partecipanti', 'Comune', 'Via', 
-                            'Tipologia', 'Cambio_Personale', 'Km_Finali', 'Litri_Riforniti'
-                        ])
-                        
-                        for intervento in interventi_anno:
-                            if len(intervento) >= 18:
-                                id_int, rapporto, progressivo, num_erba, data_uscita, data_rientro, mezzo_targa, mezzo_tipo, capo, autista, comune, via, indirizzo, tipologia, cambio_personale, km_finali, litri_riforniti, created_at = intervento[:18]
-                                
-                                # Recupera partecipanti
-                                partecipanti_nomi = []
-                                conn = sqlite3.connect(DATABASE_NAME)
-                                c = conn.cursor()
-                                c.execute('''SELECT v.nome, v.cognome 
-                                             FROM partecipanti p 
-                                             JOIN vigili v ON p.vigile_id = v.id 
-                                             WHERE p.intervento_id = ?''', (id_int,))
-                                partecipanti = c.fetchall()
-                                conn.close()
-                                
-                                for nome, cognome in partecipanti:
-                                    partecipanti_nomi.append(f"{cognome} {nome}")
-                                
-                                partecipanti_str = "; ".join(partecipanti_nomi)
-                                
-                                try:
-                                    data_uscita_fmt = datetime.strptime(data_uscita, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M')
-                                except:
-                                    data_uscita_fmt = data_uscita
-                                
-                                try:
-                                    data_rientro_fmt = datetime.strptime(data_rientro, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M') if data_rientro else ''
-                                except:
-                                    data_rientro_fmt = data_rientro or ''
-                                
-                                writer.writerow([
-                                    num_erba, rapporto, progressivo, data_uscita_fmt, data_rientro_fmt,
-                                    mezzo_targa, mezzo_tipo, capo, autista, partecipanti_str, comune, via, 
-                                    tipologia or '', 'Sì' if cambio_personale else 'No',
-                                    km_finali or '', litri_riforniti or ''
-                                ])
-                        
-                        csv_data = output.getvalue()
-                        output.close()
-                        
-                        csv_bytes = csv_data.encode('utf-8')
-                        
-                        # Invia solo al SUPER ADMIN
-                        try:
-                            from telegram import Bot
-                            bot = Bot(token=BOT_TOKEN)
-                            
-                            with BytesIO(csv_bytes) as csv_file:
-                                csv_file.name = f"interventi_{anno_corrente}_{now.strftime('%Y%m%d')}.csv"
-                                bot.send_document(
-                                    chat_id=SUPER_ADMIN_ID,
-                                    document=csv_file,
-                                    filename=csv_file.name,
-                                    caption=f"📊 CSV Interventi {anno_corrente} - {now.strftime('%d/%m/%Y')}"
-                                )
-                            
-                            print(f"✅ CSV interventi {anno_corrente} inviato al SUPER ADMIN {SUPER_ADMIN_ID}")
-                            ultimo_invio_super_admin = oggi
-                            
-                        except Exception as e:
-                            print(f"❌ Errore invio super admin: {e}")
-                    else:
-                        print("ℹ️ Nessun intervento per l'anno corrente")
-            
-            # ⭐⭐ INVIO 2: CSV COMPLETI A TUTTI GLI ADMIN - OGNI DOMENICA 23:55 ⭐⭐
-            if giorno_settimana == 6 and ora_corrente == 23 and minuto_corrente == 55:  # 6=domenica
-                print("📅 Invio CSV domenicale COMPLETO a TUTTI gli ADMIN...")
-                try:
-                    # Usa la funzione esistente per inviare tutti i CSV a tutti gli admin
-                    class ContextFittizio:
-                        def __init__(self):
-                            from telegram import Bot
-                            self.bot = Bot(token=BOT_TOKEN)
-                    
-                    context_fittizio = ContextFittizio()
-                    asyncio.run(invia_csv_automatico_admin(context_fittizio))
-                    print("✅ CSV domenicali completi inviati a tutti gli admin!")
-                    
-                except Exception as e:
-                    print(f"❌ Errore invio domenicale admin: {e}")
-            
-            # ⭐⭐ INVIO 3: CSV UTENTI - OGNI 2 MESI (1° del mese dispari) 23:55 ⭐⭐
-            if (giorno_mese == 1 and 
-                ora_corrente == 23 and 
-                minuto_corrente == 55 and 
-                now.month % 2 == 1):  # 1, 3, 5, 7, 9, 11
-                
-                # Controlla se non abbiamo già inviato questo mese
-                mese_anno = (now.month, now.year)
-                
-                if ultimo_invio_utenti != mese_anno:
-                    print(f"👤 Invio CSV utenti bimestrale ({now.strftime('%B %Y')})...")
-                    
-                    try:
-                        utenti = get_utenti_approvati()
-                        
-                        if utenti:
-                            output = StringIO()
-                            writer = csv.writer(output)
-                            writer.writerow(['user_id', 'username', 'nome', 'telefono', 'ruolo', 'data_approvazione'])
-                            
-                            for utente in utenti:
-                                user_id, username, nome, telefono, ruolo, data_approvazione = utente
-                                writer.writerow([
-                                    user_id,
-                                    username or '',
-                                    nome or '',
-                                    telefono or '',
-                                    ruolo,
-                                    data_approvazione or ''
-                                ])
-                            
-                            csv_data = output.getvalue()
-                            output.close()
-                            
-                            csv_bytes = csv_data.encode('utf-8')
-                            
-                            from telegram import Bot
-                            bot = Bot(token=BOT_TOKEN)
-                            
-                            # Invia a TUTTI gli admin
-                            for admin_id in ADMIN_IDS:
-                                try:
-                                    with BytesIO(csv_bytes) as csv_file:
-                                        csv_file.name = f"utenti_{now.strftime('%Y%m')}.csv"
-                                        bot.send_document(
-                                            chat_id=admin_id,
-                                            document=csv_file,
-                                            filename=csv_file.name,
-                                            caption=f"👤 CSV Utenti - {now.strftime('%B %Y')} (invio bimestrale)"
-                                        )
-                                    print(f"✅ CSV utenti inviato all'admin {admin_id}")
-                                    time.sleep(1)  # Pausa tra gli invii
-                                    
-                                except Exception as e:
-                                    print(f"❌ Errore invio utenti a admin {admin_id}: {e}")
-                            
-                            ultimo_invio_utenti = mese_anno
-                            print("✅ Invio bimestrale utenti completato!")
-                        else:
-                            print("ℹ️ Nessun utente da esportare")
-                            
-                    except Exception as e:
-                        print(f"❌ Errore invio bimestrale utenti: {e}")
-            
-            # Aspetta 60 secondi tra i controlli
-            time.sleep(60)
-            
+            await invia(chat_id)
         except Exception as e:
-            print(f"❌ Errore critico nello scheduler CSV: {e}")
-            time.sleep(300)  # Aspetta 5 minuti in caso di errore
+            if errore_invio_definitivo(e):
+                print(f"🚫 Destinatario {chat_id} non raggiungibile ({e}): non verrà ritentato")
+                if consegne:
+                    consegne.segna(chat_id, 'scartato')
+            else:
+                print(f"❌ Errore nell'invio a {chat_id}: {e}")
+                falliti.append(chat_id)
+            continue
+        if consegne:
+            consegne.segna(chat_id, 'ok')
+    
+    # Il job registrato deve vedere il fallimento per ritentare lo slot (solo per chi manca)
+    if falliti:
+        raise RuntimeError(f"invio non riuscito per {falliti}")
+
+async def invia_csv_automatico_admin(context, consegne=None):
+    """Invia i CSV completi a tutti gli admin; RuntimeError se l'invio a qualcuno fallisce"""
+    # Crea i file CSV fuori dall'event loop
+    files_to_send = await asyncio.to_thread(prepara_csv_completi)
+    
+    async def invia(admin_id):
+        for filename, csv_bytes in files_to_send:
+            csv_file = BytesIO(csv_bytes)
+            csv_file.name = filename
+            
+            await context.bot.send_document(
+                chat_id=admin_id,
+                document=csv_file,
+                filename=filename,
+                caption=f"📊 Backup automatico - {datetime.now().strftime('%d/%m/%Y %H:%M')}"
+            )
+            await asyncio.sleep(1)  # Piccola pausa tra i file
+        print(f"✅ CSV inviati automaticamente all'admin {admin_id}")
+    
+    await invia_ai_destinatari(ADMIN_IDS, invia, consegne)
+
+# === JOB CSV PROGRAMMATI (JobQueue) ===
+async def job_csv_super_admin(context: ContextTypes.DEFAULT_TYPE, consegne=None):
+    """OGNI GIORNO 23:55: CSV interventi dell'anno corrente al SUPER ADMIN"""
+    now = datetime.now()
+    anno_corrente = now.year
+    print(f"🦸 Invio CSV interventi {anno_corrente} al SUPER ADMIN...")
+    
+    interventi_anno = await asyncio.to_thread(get_interventi_per_anno, str(anno_corrente))
+    if not interventi_anno:
+        print("ℹ️ Nessun intervento per l'anno corrente")
+        return
+    
+    csv_bytes = await asyncio.to_thread(genera_csv_interventi, interventi_anno)
+    
+    async def invia(chat_id):
+        csv_file = BytesIO(csv_bytes)
+        csv_file.name = f"interventi_{anno_corrente}_{now.strftime('%Y%m%d')}.csv"
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=csv_file,
+            filename=csv_file.name,
+            caption=f"📊 CSV Interventi {anno_corrente} - {now.strftime('%d/%m/%Y')}"
+        )
+        print(f"✅ CSV interventi {anno_corrente} inviato al SUPER ADMIN {chat_id}")
+    
+    await invia_ai_destinatari([SUPER_ADMIN_ID], invia, consegne)
+
+async def job_csv_settimanale(context: ContextTypes.DEFAULT_TYPE, consegne=None):
+    """OGNI DOMENICA 23:55: CSV completi a TUTTI gli ADMIN"""
+    print("📅 Invio CSV domenicale COMPLETO a TUTTI gli ADMIN...")
+    await invia_csv_automatico_admin(context, consegne)
+    print("✅ CSV domenicali completi inviati a tutti gli admin!")
+
+async def job_csv_utenti_bimestrale(context: ContextTypes.DEFAULT_TYPE, consegne=None):
+    """OGNI 2 MESI (1° del mese dispari) 23:55: CSV utenti a TUTTI gli ADMIN"""
+    now = datetime.now()
+    print(f"👤 Invio CSV utenti bimestrale ({now.strftime('%B %Y')})...")
+    utenti = await asyncio.to_thread(get_utenti_approvati)
+    if not utenti:
+        print("ℹ️ Nessun utente da esportare")
+        return
+    
+    csv_bytes = genera_csv_utenti(utenti)
+    
+    # Invia a TUTTI gli admin
+    async def invia(admin_id):
+        csv_file = BytesIO(csv_bytes)
+        csv_file.name = f"utenti_{now.strftime('%Y%m')}.csv"
+        await context.bot.send_document(
+            chat_id=admin_id,
+            document=csv_file,
+            filename=csv_file.name,
+            caption=f"👤 CSV Utenti - {now.strftime('%B %Y')} (invio bimestrale)"
+        )
+        print(f"✅ CSV utenti inviato all'admin {admin_id}")
+        await asyncio.sleep(1)  # Pausa tra gli invii
+    
+    await invia_ai_destinatari(ADMIN_IDS, invia, consegne)
+    print("✅ Invio bimestrale utenti completato!")
+
+# === REGISTRO PERSISTENTE DEI JOB ===
+# nome job -> (callback, giorni validi per lo slot delle 23:55)
+JOB_CSV = {
+    'csv_super_admin': (job_csv_super_admin, lambda giorno: True),
+    'csv_settimanale': (job_csv_settimanale, lambda giorno: giorno.weekday() == 6),
+    'csv_utenti_bimestrale': (job_csv_utenti_bimestrale, lambda giorno: giorno.day == 1 and giorno.month % 2 == 1),
+}
+
+def adesso_scheduler():
+    return datetime.now(FUSO_ORARIO_SCHEDULER)
+
+def calcola_prossima_scadenza(nome, dopo):
+    """Primo slot del job strettamente successivo a 'dopo'"""
+    _, giorno_valido = JOB_CSV[nome]
+    candidato = datetime.combine(dopo.date(), ORARIO_INVII_CSV, tzinfo=FUSO_ORARIO_SCHEDULER)
+    while candidato <= dopo or not giorno_valido(candidato):
+        candidato += timedelta(days=1)
+    return candidato
+
+def leggi_registro_job(nome):
+    conn = connetti_db()
+    c = conn.cursor()
+    c.execute("SELECT prossima_scadenza, stato FROM job_programmati WHERE nome = ?", (nome,))
+    result = c.fetchone()
+    conn.close()
+    if not result:
+        return None
+    return datetime.fromisoformat(result[0]), result[1]
+
+def inizializza_registro_job(nome, prossima_scadenza):
+    conn = connetti_db()
+    c = conn.cursor()
+    c.execute('''INSERT OR IGNORE INTO job_programmati (nome, prossima_scadenza, stato)
+                 VALUES (?, ?, 'in_attesa')''', (nome, prossima_scadenza.isoformat()))
+    conn.commit()
+    conn.close()
+
+def prenota_slot_job(nome, scadenza):
+    """Segna lo slot come in corso; False se già preso o già eseguito"""
+    conn = connetti_db()
+    c = conn.cursor()
+    c.execute("""UPDATE job_programmati SET stato = 'in_corso', aggiornato = CURRENT_TIMESTAMP
+                 WHERE nome = ? AND prossima_scadenza = ? AND stato != 'in_corso'""",
+              (nome, scadenza.isoformat()))
+    conn.commit()
+    prenotato = c.rowcount == 1
+    conn.close()
+    return prenotato
+
+def chiudi_slot_job(nome, stato, prossima_scadenza, ultima_esecuzione=None, errore=None):
+    conn = connetti_db()
+    c = conn.cursor()
+    c.execute('''UPDATE job_programmati
+                 SET stato = ?, prossima_scadenza = ?, ultima_esecuzione = COALESCE(?, ultima_esecuzione),
+                     ultimo_errore = ?, aggiornato = CURRENT_TIMESTAMP
+                 WHERE nome = ?''',
+              (stato, prossima_scadenza.isoformat(),
+               ultima_esecuzione.isoformat() if ultima_esecuzione else None, errore, nome))
+    conn.commit()
+    conn.close()
+
+class ConsegneJob:
+    """Esiti per destinatario dello slot di un job, nel registro su database"""
+    def __init__(self, nome, scadenza):
+        self.nome = nome
+        self.scadenza = scadenza.isoformat()
+        # Le righe degli slot precedenti non servono più
+        conn = connetti_db()
+        conn.execute("DELETE FROM job_consegne WHERE nome = ? AND scadenza != ?", (self.nome, self.scadenza))
+        conn.commit()
+        conn.close()
+
+    def da_servire(self, destinatari):
+        conn = connetti_db()
+        c = conn.cursor()
+        c.execute("SELECT destinatario FROM job_consegne WHERE nome = ? AND scadenza = ?", (self.nome, self.scadenza))
+        serviti = {row[0] for row in c.fetchall()}
+        conn.close()
+        return [d for d in destinatari if d not in serviti]
+
+    def segna(self, destinatario, esito):
+        conn = connetti_db()
+        conn.execute('''INSERT OR REPLACE INTO job_consegne (nome, scadenza, destinatario, esito)
+                        VALUES (?, ?, ?, ?)''', (self.nome, self.scadenza, destinatario, esito))
+        conn.commit()
+        conn.close()
+
+def sblocca_job_interrotti():
+    """Slot rimasti 'in_corso' da un processo terminato: tornano eseguibili"""
+    conn = connetti_db()
+    c = conn.cursor()
+    c.execute("UPDATE job_programmati SET stato = 'interrotto' WHERE stato = 'in_corso'")
+    conn.commit()
+    conn.close()
+
+async def esegui_job_registrato(context: ContextTypes.DEFAULT_TYPE):
+    """Esegue lo slot scaduto del job (context.job.data) al massimo una volta"""
+    nome = context.job.data
+    funzione, _ = JOB_CSV[nome]
+    adesso = adesso_scheduler()
+    
+    registro = leggi_registro_job(nome)
+    if registro is None:
+        inizializza_registro_job(nome, calcola_prossima_scadenza(nome, adesso - timedelta(minutes=1)))
+        registro = leggi_registro_job(nome)
+    scadenza, stato = registro
+    
+    # Slot non ancora dovuto: già eseguito (es. dal recupero all'avvio) o giorno non valido
+    if scadenza > adesso + timedelta(minutes=1):
+        return
+    
+    if adesso - scadenza > timedelta(hours=SCHEDULER_FINESTRA_RECUPERO_ORE):
+        prossima = calcola_prossima_scadenza(nome, adesso)
+        print(f"⏭️ Job {nome}: slot {scadenza:%d/%m %H:%M} fuori finestra di recupero - saltato")
+        chiudi_slot_job(nome, 'saltato', prossima)
+        return
+    
+    if not prenota_slot_job(nome, scadenza):
+        return
+    
+    try:
+        # I tentativi successivi dello stesso slot servono solo i destinatari mancanti
+        await funzione(context, ConsegneJob(nome, scadenza))
+        chiudi_slot_job(nome, 'ok', calcola_prossima_scadenza(nome, max(scadenza, adesso)), ultima_esecuzione=adesso)
+    except Exception as e:
+        print(f"❌ Errore job {nome}: {e} - nuovo tentativo tra {SCHEDULER_RITENTA_MINUTI} minuti")
+        chiudi_slot_job(nome, 'errore', scadenza, errore=str(e)[:500])
+        context.job_queue.run_once(esegui_job_registrato, when=SCHEDULER_RITENTA_MINUTI * 60,
+                                   data=nome, name=f"{nome}_ritenta")
+    
+    # Il registro vive nel database, che all'avvio torna dal backup: senza un backup
+    # subito dopo, un redeploy entro il ciclo di 30 minuti rifarebbe gli invii già fatti
+    if not await supervisore.in_thread(backup_database):
+        print(f"⚠️ Job {nome}: backup dopo l'esecuzione non riuscito, un riavvio potrebbe ripetere l'invio")
+
+async def recupera_job_mancati(context: ContextTypes.DEFAULT_TYPE):
+    """All'avvio: recupera gli slot persi durante riavvii o redeploy"""
+    sblocca_job_interrotti()
+    adesso = adesso_scheduler()
+    for nome in JOB_CSV:
+        if leggi_registro_job(nome) is None:
+            inizializza_registro_job(nome, calcola_prossima_scadenza(nome, adesso))
+            continue
+        context.job_queue.run_once(esegui_job_registrato, when=0, data=nome, name=f"{nome}_recupero")
+
+def registra_job_csv(job_queue):
+    """Registra gli invii CSV programmati sulla JobQueue dell'applicazione"""
+    orario = ORARIO_INVII_CSV.replace(tzinfo=FUSO_ORARIO_SCHEDULER)
+    
+    job_queue.run_daily(esegui_job_registrato, time=orario, data='csv_super_admin', name='csv_super_admin')
+    # JobQueue numera i giorni da domenica (0) a sabato (6)
+    job_queue.run_daily(esegui_job_registrato, time=orario, days=(0,), data='csv_settimanale', name='csv_settimanale')
+    job_queue.run_monthly(esegui_job_registrato, when=orario, day=1, data='csv_utenti_bimestrale', name='csv_utenti_bimestrale')
+    
+    # Parte appena la JobQueue è avviata, cioè a restore completato
+    job_queue.run_once(recupera_job_mancati, when=0, name='recupero_job_csv')
+    
+    print(f"⏰ Job CSV programmati alle {ORARIO_INVII_CSV.strftime('%H:%M')} ({FUSO_ORARIO_SCHEDULER})")
+
 # === SISTEMA KEEP-ALIVE SEMPLIFICATO ===
-def keep_alive_aggressivo():
+async def keep_alive_aggressivo():
     """Sistema keep-alive OGNI 5 MINUTI per Render"""
     service_url = "https://bot-erba-interventi-2-0.onrender.com"
     
@@ -1239,7 +2754,7 @@ def keep_alive_aggressivo():
     
     while True:
         try:
-            response = requests.get(f"{service_url}/health", timeout=10)
+            response = await supervisore.in_thread(lambda: requests.get(f"{service_url}/health", timeout=10))
             if response.status_code == 200:
                 print(f"✅ Ping riuscito - {datetime.now().strftime('%H:%M:%S')}")
             else:
@@ -1248,63 +2763,635 @@ def keep_alive_aggressivo():
             print(f"❌ Errore ping: {e}")
         
         # ⭐⭐ MODIFICA: Aspetta 5 minuti tra i ping (300 secondi) ⭐⭐
-        time.sleep(300)
-# === AUTORIAVVIO OGNI 12 ORE ===
-def auto_restart_sicuro():
-    """Auto-riavvio programmato CON CONTROLLO SICUREZZA"""
-    print("🔄 Auto-restart SICURO avviato (ogni 12 ore)")
+        await asyncio.sleep(300)
+# === AUTORIAVVIO CONTROLLATO ===
+# Applicazione Telegram in esecuzione (impostata all'avvio del bot)
+applicazione_bot = None
+
+class MonitorAttivita:
+    """Conta gli update per ora del giorno per riavviare nelle fasce di minor traffico"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conteggi = {}  # (giorno, ora) -> update non ancora salvati
+        self.ultimo_update = None
+
+    def registra(self):
+        adesso = datetime.now()
+        with self._lock:
+            chiave = (adesso.strftime('%Y-%m-%d'), adesso.hour)
+            self._conteggi[chiave] = self._conteggi.get(chiave, 0) + 1
+            self.ultimo_update = time.monotonic()
+
+    def minuti_inattivita(self):
+        if self.ultimo_update is None:
+            return None
+        return (time.monotonic() - self.ultimo_update) / 60
+
+    def salva(self):
+        with self._lock:
+            conteggi, self._conteggi = self._conteggi, {}
+        limite = (datetime.now() - timedelta(days=ATTIVITA_GIORNI_STORICO)).strftime('%Y-%m-%d')
+        conn = connetti_db()
+        with conn:
+            for (giorno, ora), numero in conteggi.items():
+                conn.execute('''INSERT INTO attivita_oraria (giorno, ora, aggiornamenti) VALUES (?, ?, ?)
+                                ON CONFLICT (giorno, ora) DO UPDATE
+                                SET aggiornamenti = aggiornamenti + excluded.aggiornamenti''',
+                             (giorno, ora, numero))
+            conn.execute("DELETE FROM attivita_oraria WHERE giorno < ?", (limite,))
+        conn.close()
+
+    def ore_tranquille(self, quante=RIAVVIO_ORE_TRANQUILLE):
+        """Ore del giorno con meno update negli ultimi giorni"""
+        conn = connetti_db()
+        c = conn.cursor()
+        c.execute("SELECT ora, SUM(aggiornamenti) FROM attivita_oraria GROUP BY ora")
+        totali = dict(c.fetchall())
+        conn.close()
+        ore = sorted(range(24), key=lambda ora: (totali.get(ora, 0), ora))
+        return set(ore[:quante])
+
+# Istanza globale del monitor di attività
+monitor_attivita = MonitorAttivita()
+
+async def registra_attivita(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    monitor_attivita.registra()
+
+# === REGISTRAZIONE UPDATE ===
+class RegistratoreUpdate:
+    """Update ricevuti in JSONL compatto, per la riproduzione come corpus di regressione.
+
+    Al primo update salva una copia del database accanto al file, fuori dal
+    loop: la riproduzione riparte da quello stato. Gli id utente diventano
+    pseudonimi, anche nella copia.
+    """
+    def __init__(self, directory=REGISTRA_UPDATE_DIR, sale=REGISTRA_UPDATE_SALE):
+        self.directory = directory
+        self.sale = (sale or os.urandom(16).hex()).encode('utf-8')
+        self.percorso = None
+        self.registrati = 0
+        self._file = None
+        self._inizio = None
+        self._lock = threading.Lock()
+
+    @property
+    def attivo(self):
+        return bool(self.directory)
+
+    @property
+    def da_aprire(self):
+        return self.attivo and self._file is None
+
+    def pseudonimo(self, user_id):
+        digest = hmac.new(self.sale, str(user_id).encode('utf-8'), hashlib.sha256).digest()
+        return 10**12 + int.from_bytes(digest[:6], 'big') % 10**12
+
+    def _scrivi(self, voce):
+        self._file.write(json.dumps(voce, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self._file.flush()
+
+    def _anonimizza(self, percorso):
+        """La copia resta su disco con la registrazione: niente dati personali né stato delle conversazioni.
+        Alla riproduzione servono solo i ruoli, che vengono ricreati sugli pseudonimi."""
+        conn = sqlite3.connect(percorso)
+        try:
+            conn.create_function('pseudonimo', 1, self.pseudonimo, deterministic=True)
+            conn.execute("UPDATE utenti SET user_id = pseudonimo(user_id), username = NULL, nome = NULL, telefono = NULL")
+            conn.execute("DELETE FROM persistenza_bot")
+            conn.commit()
+            # Le pagine liberate conterrebbero ancora i dati originali
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+    def apri(self):
+        """Bloccante (copia del database): da chiamare fuori dal loop"""
+        with self._lock:
+            if self._file is None:
+                self._apri()
+
+    def _apri(self):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, datetime.now().strftime('update_%Y%m%d_%H%M%S'))
+        crea_snapshot_database(base + '.db')
+        self._anonimizza(base + '.db')
+        self.percorso = base + '.jsonl'
+        self._file = open(self.percorso, 'a', encoding='utf-8')
+        self._inizio = time.monotonic()
+        self._scrivi({'versione': 1, 'inizio': datetime.now().isoformat(timespec='seconds'),
+                      'database': os.path.basename(base + '.db')})
+        print(f"⏺️ Registrazione update in {self.percorso}")
+
+    def registra(self, update):
+        utente = update.effective_user
+        if utente is None:
+            return
+        ruolo = 'admin' if is_admin(utente.id) else 'user' if is_user_approved(utente.id) else ''
+        if update.callback_query:
+            messaggio = update.callback_query.message
+            voce = {'k': 'callback', 'x': update.callback_query.data,
+                    'm': messaggio.message_id if messaggio else None}
+        elif update.message and update.message.text is not None:
+            voce = {'k': 'testo', 'x': update.message.text}
+        elif update.message and update.message.document:
+            voce = {'k': 'documento', 'n': update.message.document.file_name}
+        else:
+            voce = {'k': 'altro'}
+        with self._lock:
+            if self._file is None:
+                return
+            self._scrivi({'t': round(time.monotonic() - self._inizio, 3),
+                          'u': self.pseudonimo(utente.id), 'r': ruolo, **voce})
+            self.registrati += 1
+
+    def chiudi(self):
+        """Ultima riga con l'impronta del database, confrontata dalla riproduzione"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._scrivi({'t': round(time.monotonic() - self._inizio, 3), 'k': 'stato',
+                          'stato': impronta_database()})
+            self._file.close()
+            self._file = None
+            print(f"⏹️ Registrazione chiusa: {self.registrati} update in {self.percorso}")
+
+# Istanza globale del registratore di update
+registratore_update = RegistratoreUpdate()
+
+async def registra_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if registratore_update.da_aprire:
+        await asyncio.to_thread(registratore_update.apri)
+    registratore_update.registra(update)
+
+async def chiudi_registrazione_update(application):
+    await asyncio.to_thread(registratore_update.chiudi)
+
+def momento_adatto_al_riavvio(urgente, ore_tranquille, minuti_inattivita):
+    """Soglie superate: al primo momento di inattività; solo crescita: anche in fascia tranquilla"""
+    inattivo = minuti_inattivita is None or minuti_inattivita >= RIAVVIO_INATTIVITA_MINUTI
+    if urgente:
+        return inattivo
+    return inattivo and datetime.now().hour in ore_tranquille
+
+async def riavvio_controllato(application):
+    """Drain: stop agli update nuovi, attesa handler in corso, flush stato, backup finale, uscita"""
+    stato_avvio.imposta_stato('draining')
+    
+    print("🛑 Stop ricezione nuovi update...")
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    
+    # stop() elabora gli update già ricevuti e ferma i job, ma non salva la persistenza:
+    # in PTB lo fa solo shutdown(), quindi il salvataggio finale è esplicito in ogni caso
+    print(f"⏳ Attesa handler in corso (max {RIAVVIO_TIMEOUT_DRAIN}s)...")
+    try:
+        await asyncio.wait_for(application.stop(), timeout=RIAVVIO_TIMEOUT_DRAIN)
+    except asyncio.TimeoutError:
+        print("⚠️ Timeout drain: salvataggio dello stato disponibile")
+    if application.persistence:
+        await application.update_persistence()
+        await application.persistence.flush()
+        print("💾 Stato delle conversazioni salvato")
+    
+    await supervisore.in_thread(monitor_attivita.salva)
+    # post_stop parte solo con run_polling: qui la registrazione va chiusa a mano
+    await supervisore.in_thread(registratore_update.chiudi)
+    
+    print("💾 Backup finale a bot fermo...")
+    for tentativo in range(3):
+        if await supervisore.in_thread(backup_database):
+            print("✅ Backup finale completato, riavvio...")
+            break
+        print(f"❌ Backup finale fallito (tentativo {tentativo + 1}/3)")
+        await asyncio.sleep(10)
+    else:
+        print("❌❌❌ Backup finale non riuscito: resta valido il backup precedente al drain")
+    
+    # Il thread del server Flask non termina da solo: uscita esplicita
+    os._exit(0)
+
+# === WATCHDOG RISORSE ===
+def pendenza_oraria(tempi, valori):
+    """Pendenza (unità/ora) della retta dei minimi quadrati"""
+    n = len(tempi)
+    if n < 2:
+        return 0.0
+    media_t = sum(tempi) / n
+    media_v = sum(valori) / n
+    varianza = sum((t - media_t) ** 2 for t in tempi)
+    if varianza == 0:
+        return 0.0
+    covarianza = sum((t - media_t) * (v - media_v) for t, v in zip(tempi, valori))
+    return covarianza / varianza * 3600
+
+class WatchdogRisorse:
+    """Valuta RAM, file aperti, thread e lag del loop dai campioni del campionatore; prima i rimedi, poi il riavvio"""
+    def __init__(self):
+        self.processo = psutil.Process(os.getpid())
+        self.rimedi = {'gc': gc.collect}
+        self.ultimi_rimedi = None
+        self.problemi = []
+        self.avvio = time.monotonic()
+
+    def registra_rimedio(self, nome, funzione):
+        """Funzione economica per liberare memoria (es. svuotare una cache)"""
+        self.rimedi[nome] = funzione
+
+    def crescita_rss(self):
+        tempi = campionatore.campioni.serie('t')
+        if not tempi or tempi[-1] - tempi[0] < WATCHDOG_STORICO_MINIMO_TREND_SECONDI:
+            return 0.0
+        return pendenza_oraria(tempi, campionatore.campioni.serie('rss_mb'))
+
+    def valuta(self):
+        """Restituisce (soglie superate, crescita anomala)"""
+        ultimo = campionatore.campioni.ultimo()
+        if ultimo is None:
+            return [], None
+        # Lag: il peggiore dall'ultima valutazione, non solo l'ultimo campione
+        ultimo['lag'] = max(campionatore.campioni.serie('lag', WATCHDOG_INTERVALLO_SECONDI // CAMPIONATORE_INTERVALLO_SECONDI))
+        superate = []
+        if ultimo['rss_mb'] > WATCHDOG_RSS_MAX_MB:
+            superate.append(f"RAM {ultimo['rss_mb']:.0f}MB > {WATCHDOG_RSS_MAX_MB}MB")
+        if ultimo['fd'] > WATCHDOG_FD_MAX:
+            superate.append(f"file aperti {ultimo['fd']:.0f} > {WATCHDOG_FD_MAX}")
+        if ultimo['thread'] > WATCHDOG_THREAD_MAX:
+            superate.append(f"thread {ultimo['thread']:.0f} > {WATCHDOG_THREAD_MAX}")
+        if ultimo['lag'] > WATCHDOG_LAG_MAX_SECONDI:
+            superate.append(f"lag loop {ultimo['lag']:.1f}s > {WATCHDOG_LAG_MAX_SECONDI}s")
+        crescita = self.crescita_rss()
+        anomala = f"RAM in crescita di {crescita:.1f}MB/ora" if crescita > WATCHDOG_CRESCITA_MB_ORA else None
+        return superate, anomala
+
+    def applica_rimedi(self):
+        prima = self.processo.memory_info().rss / 1024 / 1024
+        for nome, funzione in self.rimedi.items():
+            try:
+                funzione()
+            except Exception as e:
+                print(f"⚠️ Rimedio '{nome}' fallito: {e}")
+        dopo = self.processo.memory_info().rss / 1024 / 1024
+        self.ultimi_rimedi = time.monotonic()
+        print(f"🧹 Rimedi applicati ({', '.join(self.rimedi)}): RAM {prima:.0f}MB -> {dopo:.0f}MB")
+
+    def rimedi_recenti(self):
+        return self.ultimi_rimedi is not None and time.monotonic() - self.ultimi_rimedi < WATCHDOG_ATTESA_RIMEDI_MINUTI * 60
+
+    def snapshot(self):
+        ultimo = campionatore.campioni.ultimo() or {}
+        return {
+            'campioni': len(campionatore.campioni),
+            'rss_mb': round(ultimo.get('rss_mb', 0), 1),
+            'fd': int(ultimo.get('fd', 0)),
+            'thread': int(ultimo.get('thread', 0)),
+            'lag_secondi': round(ultimo.get('lag', 0), 3),
+            'crescita_rss_mb_ora': round(self.crescita_rss(), 2),
+            'problemi': list(self.problemi),
+        }
+
+# Istanza globale del watchdog
+watchdog = WatchdogRisorse()
+
+async def riavvia_se_sicuro(motivo):
+    """Riavvio solo con backup configurato e funzionante"""
+    print(f"💾 Controllo sicurezza prima del riavvio ({motivo})...")
     
-    # Attesa iniziale per permettere l'avvio completo
-    time.sleep(60)
+    # ⚠️ CONTROLLO CRITICO: Verifica se il backup funziona
+    if not backend_backup.configurato(per_restore=True):
+        print(f"❌❌❌ ATTENZIONE: backend di backup '{backend_backup.nome}' non configurato!")
+        print("❌❌❌ AUTO-RIAVVIO ANNULLATO per prevenire perdita dati!")
+        for riga in backend_backup.stato_configurazione():
+            print(riga)
+        return False
+    
+    # Un backup riuscito prima del drain: se fallisce, il bot resta attivo
+    print("💾 Backup di controllo prima del riavvio...")
+    if not await supervisore.in_thread(backup_database):
+        print("❌❌❌ BACKUP FALLITO! Riavvio annullato per sicurezza!")
+        print("❌❌❌ Controlla la configurazione del backend di backup")
+        return False
+    
+    await riavvio_controllato(applicazione_bot)
+    return True
+
+async def watchdog_risorse():
+    """Riavvio quando serve, non a orario: soglie superate o crescita continua della RAM"""
+    print(f"🩺 Watchdog risorse avviato (RAM max {WATCHDOG_RSS_MAX_MB}MB, crescita max {WATCHDOG_CRESCITA_MB_ORA}MB/ora)")
     
     while True:
-        # Aspetta 12 ore (43200 secondi)
-        time.sleep(12 * 60 * 60)
-        
-        print("💾 Controllo sicurezza prima del riavvio...")
-        
-        # ⚠️ CONTROLLO CRITICO: Verifica se il backup funziona
-        if not GITHUB_TOKEN or not GIST_ID:
-            print("❌❌❌ ATTENZIONE: GITHUB_TOKEN o GIST_ID non configurati!")
-            print("❌❌❌ AUTO-RIAVVIO ANNULLATO per prevenire perdita dati!")
-            print("❌❌❌ Configura GITHUB_TOKEN e GIST_ID su Render")
-            continue  # Salta il riavvio
-        
-        print("💾 Backup finale prima del riavvio programmato...")
-        if backup_database_to_gist():
-            print("✅ Backup completato, riavvio sicuro...")
-            print("🔄 Auto-riavvio programmato in corso...")
-            os._exit(0)  # Riavvio pulito
-        else:
-            print("❌❌❌ BACKUP FALLITO! Riavvio annullato per sicurezza!")
-            print("❌❌❌ Controlla le credenziali GitHub")
+        await asyncio.sleep(WATCHDOG_INTERVALLO_SECONDI)
+        await supervisore.in_thread(monitor_attivita.salva)
+        
+        superate, crescita = watchdog.valuta()
+        watchdog.problemi = superate + ([crescita] if crescita else [])
+        if not watchdog.problemi:
+            # Problema rientrato: un nuovo episodio riparte dai rimedi
+            watchdog.ultimi_rimedi = None
+            continue
+        
+        # Prima i rimedi economici, poi WATCHDOG_ATTESA_RIMEDI_MINUTI per vederne l'effetto:
+        # si valuta il riavvio solo se dopo l'attesa i problemi sono ancora presenti
+        if watchdog.ultimi_rimedi is None:
+            print(f"⚠️ Watchdog: {'; '.join(watchdog.problemi)}")
+            await supervisore.in_thread(watchdog.applica_rimedi)
+            continue
+        if watchdog.rimedi_recenti():
+            continue
+        
+        if time.monotonic() - watchdog.avvio < WATCHDOG_UPTIME_MINIMO_MINUTI * 60:
+            continue
+        if applicazione_bot is None or not stato_avvio.pronto():
+            continue
+        
+        ore_tranquille = await supervisore.in_thread(monitor_attivita.ore_tranquille)
+        if not momento_adatto_al_riavvio(bool(superate), ore_tranquille, monitor_attivita.minuti_inattivita()):
+            continue
+        
+        if not await riavvia_se_sicuro('; '.join(watchdog.problemi)):
+            # Nuovo ciclo di rimedi prima di ritentare
+            watchdog.ultimi_rimedi = None
+
 # === FUNZIONI SERVER STATUS ===
+CAMPIONATORE_INTERVALLO_SECONDI = 5
+CAMPIONATORE_CAMPIONI = 2880  # 4 ore di storico: servono anche al trend della RAM del watchdog
+FINESTRE_METRICHE = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600}
+
+class CampionatoreSistema:
+    """CPU, RAM, file aperti, thread, dimensione database/WAL e lag del loop campionati in background.
+
+    Unica fonte dei campioni: /sistema, /status, /metrics e il watchdog leggono da qui.
+    """
+    CAMPI = ('t', 'cpu', 'rss_mb', 'ram_sistema_percento', 'fd', 'thread', 'db_mb', 'wal_mb', 'lag')
+
+    def __init__(self):
+        self.processo = psutil.Process(os.getpid())
+        self.processo.cpu_percent(None)  # prima lettura: riferimento per le successive
+        self.campioni = BufferCircolare(CAMPIONATORE_CAMPIONI, self.CAMPI)
+
+    @staticmethod
+    def _dimensione_mb(percorso):
+        try:
+            return os.path.getsize(percorso) / 1024 / 1024
+        except OSError:
+            return 0.0
+
+    def campiona(self, lag):
+        try:
+            fd = self.processo.num_fds()
+        except AttributeError:  # Windows
+            fd = self.processo.num_handles()
+        # cpu_percent(None) misura dall'ultima chiamata: non blocca
+        self.campioni.aggiungi(
+            t=time.time(),
+            cpu=self.processo.cpu_percent(None),
+            rss_mb=self.processo.memory_info().rss / 1024 / 1024,
+            ram_sistema_percento=psutil.virtual_memory().percent,
+            fd=fd,
+            thread=self.processo.num_threads(),
+            db_mb=self._dimensione_mb(DATABASE_NAME),
+            wal_mb=self._dimensione_mb(f"{DATABASE_NAME}-wal"),
+            lag=lag
+        )
+
+    def uptime_processo(self):
+        return timedelta(seconds=int(time.time() - self.processo.create_time()))
+
+    def statistiche(self, secondi):
+        """min/media/max per campo sugli ultimi 'secondi'"""
+        quanti = max(1, secondi // CAMPIONATORE_INTERVALLO_SECONDI)
+        risultato = {}
+        for campo in self.CAMPI[1:]:
+            valori = self.campioni.serie(campo, quanti)
+            if valori:
+                risultato[campo] = {
+                    'min': round(min(valori), 3),
+                    'media': round(sum(valori) / len(valori), 3),
+                    'max': round(max(valori), 3)
+                }
+        return risultato
+
+    def riepilogo(self):
+        ultimo = self.campioni.ultimo() or {}
+        return {
+            'ultimo': {campo: round(valore, 3) for campo, valore in ultimo.items() if campo != 't'},
+            'finestre': {nome: self.statistiche(secondi) for nome, secondi in FINESTRE_METRICHE.items()},
+            'campioni': len(self.campioni),
+            'uptime_processo': str(self.uptime_processo())
+        }
+
+# Istanza globale del campionatore
+campionatore = CampionatoreSistema()
+
+async def campiona_sistema():
+    """Battito ogni LAG_BATTITO_SECONDI, un campione completo ogni pochi secondi.
+
+    Il lag di un battito è il ritardo del risveglio rispetto all'atteso; nel
+    campione va il peggiore dell'intervallo. Lo stesso battito è quello che
+    il thread sentinella di monitor_lag sorveglia.
+    """
+    loop = asyncio.get_running_loop()
+    monitor_lag.collega(loop)
+    battiti_per_campione = max(1, round(CAMPIONATORE_INTERVALLO_SECONDI / LAG_BATTITO_SECONDI))
+    battiti, lag_massimo = 0, 0.0
+    while True:
+        inizio = loop.time()
+        monitor_lag.battito = time.monotonic()
+        await asyncio.sleep(LAG_BATTITO_SECONDI)
+        lag_massimo = max(lag_massimo, loop.time() - inizio - LAG_BATTITO_SECONDI)
+        battiti += 1
+        if battiti >= battiti_per_campione:
+            campionatore.campiona(lag_massimo)
+            battiti, lag_massimo = 0, 0.0
+
+# === MONITOR BLOCCHI DELL'EVENT LOOP ===
+LAG_SOGLIA_SECONDI = float(os.environ.get('LAG_SOGLIA_SECONDI', '0.5'))
+LAG_BATTITO_SECONDI = 0.1
+LAG_PEGGIORI = 20
+
+class MonitorLag:
+    """Thread sentinella sul battito di campiona_sistema: se il battito si ferma, registra lo stack che blocca"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loop = None
+        self.thread_loop = None
+        self.battito = time.monotonic()
+        self.blocco_in_corso = None
+        self.peggiori = []  # blocchi più lunghi, in ordine decrescente di durata
+        self.totale_blocchi = 0
+
+    def collega(self, loop):
+        """Chiamata dal loop: da qui in poi il battito viene sorvegliato"""
+        self.loop = loop
+        self.thread_loop = threading.get_ident()
+        if not any(t.name == 'monitor-lag' for t in threading.enumerate()):
+            threading.Thread(target=self.sorveglia, name='monitor-lag', daemon=True).start()
+
+    def _cattura(self, ritardo):
+        frame = sys._current_frames().get(self.thread_loop)
+        stack = traceback.format_stack(frame, limit=12) if frame else []
+        task = asyncio.current_task(self.loop) if self.loop else None
+        handler, callback_data = handler_in_esecuzione.get(task, (None, None))
+        return {
+            'inizio': datetime.now().isoformat(timespec='seconds'),
+            'durata_secondi': round(ritardo, 3),
+            'handler': handler,
+            'callback_data': callback_data,
+            'task': task.get_name() if task else None,
+            'stack': ''.join(stack)
+        }
+
+    def _chiudi_blocco(self):
+        blocco = self.blocco_in_corso
+        self.blocco_in_corso = None
+        metriche.osserva('bot_loop_blocchi_durata_secondi', blocco['durata_secondi'], handler=blocco['handler'] or '-')
+        with self._lock:
+            self.totale_blocchi += 1
+            self.peggiori.append(blocco)
+            self.peggiori.sort(key=lambda b: b['durata_secondi'], reverse=True)
+            del self.peggiori[LAG_PEGGIORI:]
+        print(f"🐢 Loop bloccato per {blocco['durata_secondi']:.2f}s "
+              f"(handler: {blocco['handler'] or '-'}, callback: {blocco['callback_data'] or '-'})")
+
+    def sorveglia(self):
+        """Thread sentinella: non dipende dal loop, quindi vede i blocchi mentre avvengono"""
+        in_pausa = False
+        while True:
+            time.sleep(LAG_BATTITO_SECONDI)
+            if self.loop is None or not self.loop.is_running():
+                # Loop fermo (es. attesa tra due tentativi di avvio del bot): non è un blocco
+                self.blocco_in_corso = None
+                in_pausa = True
+                continue
+            if in_pausa:
+                # Alla ripresa il battito è vecchio quanto la pausa: si riparte da adesso
+                self.battito = time.monotonic()
+                in_pausa = False
+                continue
+            ultimo_battito = self.battito
+            ritardo = time.monotonic() - ultimo_battito - LAG_BATTITO_SECONDI
+            if self.blocco_in_corso is not None:
+                if self.blocco_in_corso['battito'] != ultimo_battito:
+                    self._chiudi_blocco()
+                else:
+                    self.blocco_in_corso['durata_secondi'] = round(ritardo, 3)
+                continue
+            if ritardo > LAG_SOGLIA_SECONDI and self.loop is not None:
+                blocco = self._cattura(ritardo)
+                blocco['battito'] = ultimo_battito
+                self.blocco_in_corso = blocco
+                print(f"🐢 Event loop bloccato da {ritardo:.2f}s "
+                      f"(handler: {blocco['handler'] or '-'}, callback: {blocco['callback_data'] or '-'})\n{blocco['stack']}")
+
+    def elenco(self):
+        with self._lock:
+            return [{k: v for k, v in b.items() if k != 'battito'} for b in self.peggiori]
+
+# Istanza globale del monitor del lag
+monitor_lag = MonitorLag()
+
 def get_system_metrics():
     try:
-        process = psutil.Process(os.getpid())
-        process_memory = process.memory_info().rss / 1024 / 1024
+        ultimo = campionatore.campioni.ultimo()
+        if ultimo is None:
+            return "📊 Metriche non ancora disponibili, riprova tra qualche secondo"
         
         system_memory = psutil.virtual_memory()
         total_memory_used = system_memory.used / 1024 / 1024
         total_memory_total = system_memory.total / 1024 / 1024
-        memory_percent = system_memory.percent
-        
-        cpu_percent = psutil.cpu_percent(interval=1)
-        
-        boot_time = datetime.fromtimestamp(psutil.boot_time())
-        uptime = datetime.now() - boot_time
+        cinque_minuti = campionatore.statistiche(300)
         
         metrics_msg = "📊 **METRICHE DI SISTEMA:**\n"
-        metrics_msg += f"• RAM Bot: {process_memory:.1f}MB\n"
-        metrics_msg += f"• RAM Sistema: {total_memory_used:.1f}MB / {total_memory_total:.1f}MB ({memory_percent:.1f}%)\n"
-        metrics_msg += f"• CPU: {cpu_percent:.1f}%\n"
-        metrics_msg += f"• Uptime: {str(uptime).split('.')[0]}\n"
+        metrics_msg += f"• RAM Bot: {ultimo['rss_mb']:.1f}MB (max 5m {cinque_minuti['rss_mb']['max']:.1f}MB)\n"
+        metrics_msg += f"• RAM Sistema: {total_memory_used:.1f}MB / {total_memory_total:.1f}MB ({ultimo['ram_sistema_percento']:.1f}%)\n"
+        metrics_msg += f"• CPU: {ultimo['cpu']:.1f}% (media 5m {cinque_minuti['cpu']['media']:.1f}%)\n"
+        metrics_msg += f"• Database: {ultimo['db_mb']:.2f}MB (WAL {ultimo['wal_mb']:.2f}MB)\n"
+        metrics_msg += f"• Lag loop: {ultimo['lag'] * 1000:.0f}ms (max 5m {cinque_minuti['lag']['max'] * 1000:.0f}ms)\n"
+        metrics_msg += f"• Uptime: {campionatore.uptime_processo()}\n"
         
         return metrics_msg
         
     except Exception as e:
         return f"📊 Errore metriche: {str(e)}"
 
+# === RIEPILOGO IN CACHE PER GLI ENDPOINT HTTP ===
+RIEPILOGO_INTERVALLO_SECONDI = 30  # controllo delle invalidazioni
+RIEPILOGO_VALIDITA_SECONDI = 600  # aggiornamento comunque dopo 10 minuti
+
+class RiepilogoServizio:
+    """Stato del database e totali calcolati in background: i ping HTTP non toccano il database"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dati = None
+        self._aggiornato = None
+        self._da_aggiornare = True
+
+    def invalida(self):
+        """Chiamata dopo le scritture sugli interventi"""
+        self._da_aggiornare = True
+
+    def scaduto(self):
+        if self._da_aggiornare or self._aggiornato is None:
+            return True
+        return time.monotonic() - self._aggiornato > RIEPILOGO_VALIDITA_SECONDI
+
+    @staticmethod
+    def calcola():
+        """Controlli reali: connessione al database e totali dell'anno"""
+        dati = {"database": "ok", "timestamp": datetime.now().isoformat()}
+        try:
+            conn = connetti_db()
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+            conn.close()
+            stats = get_statistiche_anno()
+            dati["interventi_totali"] = stats['totale_interventi']
+            dati["partenze_totali"] = stats['totale_partenze']
+        except Exception as e:
+            dati["database"] = "errore"
+            dati["errore"] = str(e)
+        return dati
+
+    def aggiorna(self):
+        self._da_aggiornare = False
+        dati = self.calcola()
+        with self._lock:
+            self._dati = dati
+            self._aggiornato = time.monotonic()
+        return dati
+
+    def leggi(self):
+        """Ultimo riepilogo calcolato (None se non ancora disponibile) ed età in secondi"""
+        with self._lock:
+            if self._dati is None:
+                return None, None
+            return dict(self._dati), round(time.monotonic() - self._aggiornato, 1)
+
+# Istanza globale del riepilogo
+riepilogo_servizio = RiepilogoServizio()
+
+async def aggiorna_riepilogo_servizio():
+    """Ricalcola il riepilogo dopo le scritture o alla scadenza, mai durante il restore"""
+    await supervisore.attendi_evento(stato_avvio.restore_completato)
+    while True:
+        if riepilogo_servizio.scaduto():
+            await supervisore.in_thread(riepilogo_servizio.aggiorna)
+        await asyncio.sleep(RIEPILOGO_INTERVALLO_SECONDI)
+
+def richiesta_approfondita():
+    return request.args.get('deep') in ('1', 'true')
+
+def richiede_token_diagnostica(funzione):
+    """Endpoint di diagnostica: l'URL di Render è pubblico, senza token non si risponde"""
+    @functools.wraps(funzione)
+    def wrapper(*args, **kwargs):
+        if not DIAGNOSTICA_TOKEN:
+            return jsonify({"errore": "diagnostica disattivata"}), 404
+        fornito = request.headers.get('X-Token-Diagnostica', '')
+        if not hmac.compare_digest(fornito.encode('utf-8'), DIAGNOSTICA_TOKEN.encode('utf-8')):
+            return jsonify({"errore": "non autorizzato"}), 401
+        return funzione(*args, **kwargs)
+    return wrapper
+
 # === SERVER FLASK PER RENDER ===
 app = Flask(__name__)
 
@@ -1314,15 +3401,27 @@ def home():
 
 @app.route('/health')
 def health():
-    try:
-        # Verifica integrità database
-        conn = sqlite3.connect(DATABASE_NAME)
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM sqlite_master LIMIT 1")
-        conn.close()
-        return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()}), 200
-    except Exception as e:
-        return jsonify({"status": "unhealthy", "error": str(e)}), 500
+    # Durante il restore il processo è vivo ma il database non è ancora quello definitivo
+    if not stato_avvio.restore_completato.is_set():
+        return jsonify({"status": "restoring", "avvio": stato_avvio.snapshot(), "timestamp": datetime.now().isoformat()}), 200
+    # ?deep=1: verifica reale del database; altrimenti ultimo esito in cache
+    if richiesta_approfondita():
+        dati, eta = riepilogo_servizio.aggiorna(), 0
+    else:
+        dati, eta = riepilogo_servizio.leggi()
+    risposta = {"status": "healthy", "readiness": stato_avvio.stato, "timestamp": datetime.now().isoformat()}
+    if dati is None:
+        return jsonify(risposta), 200
+    risposta["eta_controllo_secondi"] = eta
+    if dati["database"] != "ok":
+        return jsonify({"status": "unhealthy", "error": dati.get("errore"), "eta_controllo_secondi": eta}), 500
+    return jsonify(risposta), 200
+
+@app.route('/ready')
+def ready():
+    """Readiness: 200 solo quando restore completato e polling avviato"""
+    codice = 200 if stato_avvio.pronto() else 503
+    return jsonify(stato_avvio.snapshot()), codice
 
 @app.route('/ping')
 def ping():
@@ -1330,22 +3429,26 @@ def ping():
 
 @app.route('/status')
 def status():
-    try:
-        # Statistiche di sistema
-        stats = get_statistiche_anno()
-        return jsonify({
-            "status": "active", 
-            "timestamp": datetime.now().isoformat(),
-            "interventi_totali": stats['totale_interventi'],
-            "partenze_totali": stats['totale_partenze']
-        })
-    except:
-        return jsonify({"status": "active", "timestamp": datetime.now().isoformat()})
+    risposta = {"status": "active", "timestamp": datetime.now().isoformat()}
+    if not stato_avvio.restore_completato.is_set():
+        return jsonify(risposta)
+    # Statistiche dal riepilogo in cache (ricalcolate solo con ?deep=1)
+    if richiesta_approfondita():
+        dati, eta = riepilogo_servizio.aggiorna(), 0
+    else:
+        dati, eta = riepilogo_servizio.leggi()
+    if dati and "interventi_totali" in dati:
+        risposta["interventi_totali"] = dati["interventi_totali"]
+        risposta["partenze_totali"] = dati["partenze_totali"]
+        risposta["aggiornato_da_secondi"] = eta
+    return jsonify(risposta)
 
 @app.route('/backup')
 def trigger_backup():
     """Endpoint per trigger manuale del backup"""
-    if backup_database_to_gist():
+    if not stato_avvio.restore_completato.is_set():
+        return jsonify({"status": "restoring"}), 503
+    if backup_database():
         return jsonify({"status": "backup_success"})
     else:
         return jsonify({"status": "backup_failed"}), 500
@@ -1353,14 +3456,64 @@ def trigger_backup():
 @app.route('/restore')
 def trigger_restore():
     """Endpoint per trigger manuale del restore"""
-    if restore_database_from_gist():
+    if restore_database():
         return jsonify({"status": "restore_success"})
     else:
         return jsonify({"status": "restore_failed"}), 500
 
+@app.route('/metrics')
+def metrics():
+    """Metriche in formato testuale Prometheus"""
+    ultimo = campionatore.campioni.ultimo()
+    if ultimo:
+        metriche.imposta('bot_processo_rss_byte', int(ultimo['rss_mb'] * 1024 * 1024))
+        metriche.imposta('bot_loop_lag_secondi', round(ultimo['lag'], 4))
+    return Response(metriche.testo(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/sistema')
+@richiede_token_diagnostica
+def sistema():
+    """Ultimo campione e min/media/max per finestra temporale"""
+    return jsonify(campionatore.riepilogo())
+
+@app.route('/lag')
+@richiede_token_diagnostica
+def lag():
+    """Blocchi dell'event loop più lunghi, con handler e stack"""
+    # La callback_data può contenere id utente (es. approva_<id>): via HTTP solo il prefisso
+    peggiori = [dict(b, callback_data=prefisso_callback(b['callback_data']) if b['callback_data'] else None)
+                for b in monitor_lag.elenco()]
+    return jsonify({
+        "soglia_secondi": LAG_SOGLIA_SECONDI,
+        "blocchi_totali": monitor_lag.totale_blocchi,
+        "peggiori": peggiori
+    })
+
+@app.route('/sql')
+@richiede_token_diagnostica
+def sql_trace():
+    """Query per tempo totale (?ordine=conteggio per frequenza) e ultime query lente"""
+    ordine = request.args.get('ordine', 'totale_secondi')
+    if ordine not in ('totale_secondi', 'conteggio', 'massimo_ms', 'media_ms'):
+        ordine = 'totale_secondi'
+    return jsonify({
+        "attivo": SQL_TRACCIA_ATTIVA,
+        "soglia_lenta_ms": SQL_SOGLIA_LENTA_SECONDI * 1000,
+        "query": traccia_sql.classifica(ordine, limite=50),
+        "lente": traccia_sql.query_lente()
+    })
+
+@app.route('/servizi')
+def servizi():
+    """Stato dei servizi di background gestiti dal supervisore"""
+    return jsonify({"servizi": supervisore.snapshot(), "risorse": watchdog.snapshot(), "timestamp": datetime.now().isoformat()})
+
 def run_flask():
     app.run(host='0.0.0.0', port=10000, debug=False)
 
+async def servizio_restore():
+    await supervisore.in_thread(restore_in_background)
+
 # === TASTIERA FISICA ===
 def crea_tastiera_fisica(user_id):
     if not is_user_approved(user_id):
@@ -1378,8 +3531,10 @@ def crea_tastiera_fisica(user_id):
     return ReplyKeyboardMarkup(tastiera, resize_keyboard=True, is_persistent=True)
 
 # === SISTEMA DI SELEZIONE TIPOLOGIA PAGINATO - VERSIONE CORRETTA ===
-def crea_tastiera_tipologie_paginata(page=0, items_per_page=8):
-    """Crea una tastiera paginata per le tipologie usando il mapping"""
+TIPOLOGIE_PER_PAGINA = 8
+
+def costruisci_tastiera_tipologie(page, items_per_page=TIPOLOGIE_PER_PAGINA):
+    """Crea una pagina della tastiera tipologie usando il mapping"""
     start_idx = page * items_per_page
     end_idx = start_idx + items_per_page
     
@@ -1411,12 +3566,23 @@ def crea_tastiera_tipologie_paginata(page=0, items_per_page=8):
     
     return InlineKeyboardMarkup(keyboard)
 
+# Le tipologie sono fisse: tutte le pagine vengono costruite una volta all'avvio
+TASTIERE_TIPOLOGIE = tuple(
+    costruisci_tastiera_tipologie(page)
+    for page in range((len(TIPOLOGIE_MAPPING) + TIPOLOGIE_PER_PAGINA - 1) // TIPOLOGIE_PER_PAGINA)
+)
+
+def crea_tastiera_tipologie_paginata(page=0):
+    """Pagina precalcolata della tastiera tipologie (fuori intervallo: la più vicina)"""
+    return TASTIERE_TIPOLOGIE[min(max(page, 0), len(TASTIERE_TIPOLOGIE) - 1)]
+
+@handler_misurato
 async def mostra_selezione_tipologia_paginata(update, context, page=0):
     """Mostra la selezione tipologie con paginazione"""
+    totale_pagine = len(TASTIERE_TIPOLOGIE)
+    page = min(max(page, 0), totale_pagine - 1)
     reply_markup = crea_tastiera_tipologie_paginata(page)
     
-    totale_tipologie = len(TIPOLOGIE_MAPPING)
-    totale_pagine = (totale_tipologie + 7) // 8  # 8 items per pagina
     messaggio_paginazione = f" - Pagina {page+1} di {totale_pagine}" if totale_pagine > 1 else ""
     
     messaggio = f"🚨 **TIPOLOGIA INTERVENTO**{messaggio_paginazione}\n\n"
@@ -1431,7 +3597,85 @@ async def mostra_selezione_tipologia_paginata(update, context, page=0):
     else:
         await update.edit_message_text(messaggio, reply_markup=reply_markup)
 
+# === TASTIERE DI VIGILI E MEZZI ===
+# Righe di controllo della selezione partecipanti, uguali per tutti
+RIGHE_CONTROLLO_PARTECIPANTI = (
+    (InlineKeyboardButton("🔄 Deseleziona Tutto", callback_data="deseleziona_tutti"),
+     InlineKeyboardButton("✅ Seleziona Tutto", callback_data="seleziona_tutti")),
+    (InlineKeyboardButton("➡️ AVANTI", callback_data="conferma_partecipanti"),
+     InlineKeyboardButton("❌ ANNULLA", callback_data="annulla_selezione")),
+)
+
+def tastiera_elenco(bottoni):
+    """Un bottone per riga"""
+    return InlineKeyboardMarkup([[bottone] for bottone in bottoni])
+
+class TastiereAnagrafiche:
+    """Tastiere di vigili e mezzi costruite una volta per versione del catalogo.
+
+    Gli InlineKeyboardMarkup sono immutabili e vengono condivisi tra tutti
+    gli utenti. Per la selezione multipla dei partecipanti si tengono solo
+    i bottoni di ogni vigile (non selezionato, selezionato): la tastiera
+    del singolo utente si compone da questi.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versione = None
+        self._tastiere = None
+
+    def costruisci(self):
+        vigili = get_vigili_attivi()
+        mezzi = get_mezzi_attivi()
+        return {
+            'vigili_attivi': vigili,
+            'mezzo': tastiera_elenco(
+                InlineKeyboardButton(f"🚒 {targa} - {tipo}", callback_data=f"mezzo_{targa}") for targa, tipo in mezzi),
+            'capo': tastiera_elenco(
+                InlineKeyboardButton(f"👨‍🚒 {cognome} {nome} ({qualifica})", callback_data=f"capo_{vigile_id}")
+                for vigile_id, nome, cognome, qualifica in vigili),
+            'autista': tastiera_elenco(
+                InlineKeyboardButton(f"🚗 {cognome} {nome} ({qualifica})", callback_data=f"autista_{vigile_id}")
+                for vigile_id, nome, cognome, qualifica in vigili),
+            'modmezzo': tastiera_elenco(
+                InlineKeyboardButton(f"{targa} - {tipo}", callback_data=f"modmezzo_{targa}") for targa, tipo in mezzi),
+            'modcapo': tastiera_elenco(
+                InlineKeyboardButton(f"{cognome} {nome} ({qualifica})", callback_data=f"modcapo_{vigile_id}")
+                for vigile_id, nome, cognome, qualifica in vigili),
+            'modautista': tastiera_elenco(
+                InlineKeyboardButton(f"{cognome} {nome} ({qualifica})", callback_data=f"modautista_{vigile_id}")
+                for vigile_id, nome, cognome, qualifica in vigili),
+            'partecipanti': {
+                vigile_id: tuple(
+                    InlineKeyboardButton(f"{emoji} {cognome} {nome} ({qualifica})", callback_data=f"toggle_vigile_{vigile_id}")
+                    for emoji in ("⚪", "✅"))
+                for vigile_id, nome, cognome, qualifica in vigili
+            },
+        }
+
+    def attuali(self):
+        """Tastiere della versione corrente del catalogo, ricostruite solo se è cambiata"""
+        # La versione va letta prima dei dati: al peggio si ricostruisce una volta di troppo
+        versione = catalogo.versione
+        if self._versione != versione:
+            with self._lock:
+                if self._versione != versione:
+                    self._tastiere = self.costruisci()
+                    self._versione = versione
+        return self._tastiere
+
+    def tastiera(self, nome):
+        return self.attuali()[nome]
+
+# Istanza globale delle tastiere
+tastiere_anagrafiche = TastiereAnagrafiche()
+
 # === IMPORT/EXPORT CSV - VERSIONE SEMPLIFICATA ===
+def registra_righe_importate(tipo, **per_esito):
+    for esito, righe in per_esito.items():
+        if righe:
+            metriche.incrementa('bot_import_righe_totale', righe, tipo=tipo, esito=esito)
+
+@handler_misurato
 async def gestisci_file_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not is_admin(user_id):
@@ -1469,13 +3713,17 @@ async def gestisci_file_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Determina il tipo di CSV in base al nome del file
         if 'db_interventi' in file_name:
-            await gestisci_import_interventi(update, context, reader)
+            with metriche.misura('bot_import_durata_secondi', tipo='interventi'):
+                await gestisci_import_interventi(update, context, reader)
         elif 'db_vigili' in file_name:
-            await gestisci_import_vigili(update, context, reader)
+            with metriche.misura('bot_import_durata_secondi', tipo='vigili'):
+                await gestisci_import_vigili(update, context, reader)
         elif 'db_mezzi' in file_name:
-            await gestisci_import_mezzi(update, context, reader)
+            with metriche.misura('bot_import_durata_secondi', tipo='mezzi'):
+                await gestisci_import_mezzi(update, context, reader)
         elif 'db_user' in file_name:
-            await gestisci_import_utenti(update, context, reader)
+            with metriche.misura('bot_import_durata_secondi', tipo='utenti'):
+                await gestisci_import_utenti(update, context, reader)
         else:
             await update.message.reply_text(
                 "❌ Impossibile determinare il tipo di CSV.\n\n"
@@ -1490,7 +3738,8 @@ async def gestisci_file_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Errore durante l'importazione: {str(e)}")
         print(f"Errore dettagliato: {e}")
 
-async def gestisci_import_interventi(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+def importa_righe_interventi(reader):
+    """Importa gli interventi da righe CSV (senza intestazione)"""
     imported_count = 0
     skipped_count = 0
     error_count = 0
@@ -1547,7 +3796,7 @@ async def gestisci_import_interventi(update: Update, context: ContextTypes.DEFAU
                             cognome = nome_cognome[0]
                             nome = ' '.join(nome_cognome[1:])
                             
-                            conn = sqlite3.connect(DATABASE_NAME)
+                            conn = connetti_db()
                             c = conn.cursor()
                             c.execute("SELECT id FROM vigili WHERE cognome = ? AND nome = ?", (cognome, nome))
                             vigile = c.fetchone()
@@ -1596,7 +3845,24 @@ async def gestisci_import_interventi(update: Update, context: ContextTypes.DEFAU
             print(f"Errore nell'importazione riga {row_num}: {e}")
             continue
     
+    return {
+        'importati': imported_count,
+        'saltati': skipped_count,
+        'errori': error_count,
+        'dettagli_errori': error_details,
+    }
+
+@handler_misurato
+async def gestisci_import_interventi(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+    # Le righe vengono scritte una alla volta: l'import gira fuori dall'event loop
+    esito = await asyncio.to_thread(importa_righe_interventi, reader)
+    imported_count = esito['importati']
+    skipped_count = esito['saltati']
+    error_count = esito['errori']
+    error_details = esito['dettagli_errori']
+    
     # Invia il report
+    registra_righe_importate('interventi', importati=imported_count, saltati=skipped_count, errori=error_count)
     messaggio = f"✅ **IMPORTAZIONE INTERVENTI COMPLETATA**\n\n"
     messaggio += f"📊 **Risultati:**\n"
     messaggio += f"• ✅ Record importati: {imported_count}\n"
@@ -1612,7 +3878,8 @@ async def gestisci_import_interventi(update: Update, context: ContextTypes.DEFAU
     
     await update.message.reply_text(messaggio)
 
-async def gestisci_import_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+def importa_righe_mezzi(reader):
+    """Importa o aggiorna i mezzi da righe CSV"""
     imported_count = 0
     updated_count = 0
     error_count = 0
@@ -1634,7 +3901,7 @@ async def gestisci_import_mezzi(update: Update, context: ContextTypes.DEFAULT_TY
             
             # Aggiorna lo stato attivo se necessario
             if not attivo:
-                conn = sqlite3.connect(DATABASE_NAME)
+                conn = connetti_db()
                 c = conn.cursor()
                 c.execute("UPDATE mezzi SET attivo = ? WHERE targa = ?", (attivo, targa))
                 conn.commit()
@@ -1647,6 +3914,26 @@ async def gestisci_import_mezzi(update: Update, context: ContextTypes.DEFAULT_TY
             error_details.append(f"Riga {row_num}: {str(e)}")
             continue
     
+    if imported_count or updated_count:
+        catalogo.invalida()
+    
+    return {
+        'importati': imported_count,
+        'aggiornati': updated_count,
+        'errori': error_count,
+        'dettagli_errori': error_details,
+    }
+
+@handler_misurato
+async def gestisci_import_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+    # Le righe vengono scritte una alla volta: l'import gira fuori dall'event loop
+    esito = await asyncio.to_thread(importa_righe_mezzi, reader)
+    imported_count = esito['importati']
+    updated_count = esito['aggiornati']
+    error_count = esito['errori']
+    error_details = esito['dettagli_errori']
+    
+    registra_righe_importate('mezzi', importati=imported_count, aggiornati=updated_count, errori=error_count)
     messaggio = f"✅ **IMPORTAZIONE MEZZI COMPLETATA**\n\n"
     messaggio += f"📊 **Risultati:**\n"
     messaggio += f"• 🔄 Mezzi importati/aggiornati: {updated_count}\n"
@@ -1658,8 +3945,8 @@ async def gestisci_import_mezzi(update: Update, context: ContextTypes.DEFAULT_TY
             messaggio += f"• {detail}\n"
     
     await update.message.reply_text(messaggio)
-async def gestisci_import_vigili(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
-    """Gestisce l'importazione dei vigili da CSV"""
+def importa_righe_vigili(reader):
+    """Importa o aggiorna i vigili da righe CSV"""
     imported_count = 0
     updated_count = 0
     error_count = 0
@@ -1683,7 +3970,7 @@ async def gestisci_import_vigili(update: Update, context: ContextTypes.DEFAULT_T
             attivo = bool(int(row[8])) if len(row) > 8 and row[8] and row[8].isdigit() else True
             
             # Cerca se il vigile esiste già
-            conn = sqlite3.connect(DATABASE_NAME)
+            conn = connetti_db()
             c = conn.cursor()
             c.execute("SELECT id FROM vigili WHERE nome = ? AND cognome = ?", (nome, cognome))
             existing_vigile = c.fetchone()
@@ -1713,6 +4000,27 @@ async def gestisci_import_vigili(update: Update, context: ContextTypes.DEFAULT_T
             error_details.append(f"Riga {row_num}: {str(e)}")
             continue
     
+    if imported_count or updated_count:
+        catalogo.invalida()
+    
+    return {
+        'importati': imported_count,
+        'aggiornati': updated_count,
+        'errori': error_count,
+        'dettagli_errori': error_details,
+    }
+
+@handler_misurato
+async def gestisci_import_vigili(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+    """Gestisce l'importazione dei vigili da CSV"""
+    # Le righe vengono scritte una alla volta: l'import gira fuori dall'event loop
+    esito = await asyncio.to_thread(importa_righe_vigili, reader)
+    imported_count = esito['importati']
+    updated_count = esito['aggiornati']
+    error_count = esito['errori']
+    error_details = esito['dettagli_errori']
+    
+    registra_righe_importate('vigili', importati=imported_count, aggiornati=updated_count, errori=error_count)
     messaggio = f"✅ **IMPORTAZIONE VIGILI COMPLETATA**\n\n"
     messaggio += f"📊 **Risultati:**\n"
     messaggio += f"• ✅ Vigili importati: {imported_count}\n"
@@ -1728,7 +4036,8 @@ async def gestisci_import_vigili(update: Update, context: ContextTypes.DEFAULT_T
     
     await update.message.reply_text(messaggio)
     
-async def gestisci_import_utenti(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+def importa_righe_utenti(reader):
+    """Importa o aggiorna gli utenti da righe CSV"""
     imported_count = 0
     updated_count = 0
     error_count = 0
@@ -1748,7 +4057,7 @@ async def gestisci_import_utenti(update: Update, context: ContextTypes.DEFAULT_T
             ruolo = row[4] if len(row) > 4 else 'user'
             data_approvazione = row[5] if len(row) > 5 else None
             
-            conn = sqlite3.connect(DATABASE_NAME)
+            conn = connetti_db()
             c = conn.cursor()
             c.execute("SELECT * FROM utenti WHERE user_id = ?", (user_id,))
             existing_user = c.fetchone()
@@ -1774,6 +4083,26 @@ async def gestisci_import_utenti(update: Update, context: ContextTypes.DEFAULT_T
             error_details.append(f"Riga {row_num}: {str(e)}")
             continue
     
+    if imported_count or updated_count:
+        ruoli_utenti.invalida()
+    
+    return {
+        'importati': imported_count,
+        'aggiornati': updated_count,
+        'errori': error_count,
+        'dettagli_errori': error_details,
+    }
+
+@handler_misurato
+async def gestisci_import_utenti(update: Update, context: ContextTypes.DEFAULT_TYPE, reader):
+    # Le righe vengono scritte una alla volta: l'import gira fuori dall'event loop
+    esito = await asyncio.to_thread(importa_righe_utenti, reader)
+    imported_count = esito['importati']
+    updated_count = esito['aggiornati']
+    error_count = esito['errori']
+    error_details = esito['dettagli_errori']
+    
+    registra_righe_importate('utenti', importati=imported_count, aggiornati=updated_count, errori=error_count)
     messaggio = f"✅ **IMPORTAZIONE UTENTI COMPLETATA**\n\n"
     messaggio += f"📊 **Risultati:**\n"
     messaggio += f"• ✅ Utenti importati: {imported_count}\n"
@@ -1788,6 +4117,7 @@ async def gestisci_import_utenti(update: Update, context: ContextTypes.DEFAULT_T
     await update.message.reply_text(messaggio)
 
 # === ESTRAZIONE DATI - VERSIONE SEMPLIFICATA ===
+@handler_misurato
 async def estrazione_dati(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not is_user_approved(user_id):
@@ -1812,13 +4142,10 @@ async def estrazione_dati(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@durata_misurata('bot_export_durata_secondi', tipo='interventi')
+@handler_misurato
 async def esegui_export_interventi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     try:
         interventi = get_ultimi_interventi(10000)
@@ -1842,7 +4169,7 @@ async def esegui_export_interventi(update: Update, context: ContextTypes.DEFAULT
                 
                 # Recupera i partecipanti per questo intervento
                 partecipanti_nomi = []
-                conn = sqlite3.connect(DATABASE_NAME)
+                conn = connetti_db()
                 c = conn.cursor()
                 c.execute('''SELECT v.nome, v.cognome 
                              FROM partecipanti p 
@@ -1879,6 +4206,7 @@ async def esegui_export_interventi(update: Update, context: ContextTypes.DEFAULT
         csv_bytes = csv_data.encode('utf-8')
         csv_file = BytesIO(csv_bytes)
         csv_file.name = f"db_interventi_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        metriche.incrementa('bot_export_righe_totale', len(interventi), tipo='interventi')
         
         await query.edit_message_text("📤 Generazione file in corso...")
         await context.bot.send_document(
@@ -1891,13 +4219,10 @@ async def esegui_export_interventi(update: Update, context: ContextTypes.DEFAULT
     except Exception as e:
         await query.edit_message_text(f"❌ Errore durante l'esportazione: {str(e)}")
 
+@durata_misurata('bot_export_durata_secondi', tipo='vigili')
+@handler_misurato
 async def esegui_export_vigili(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     try:
         vigili = get_tutti_vigili()
@@ -1924,6 +4249,7 @@ async def esegui_export_vigili(update: Update, context: ContextTypes.DEFAULT_TYP
         csv_bytes = csv_data.encode('utf-8')
         csv_file = BytesIO(csv_bytes)
         csv_file.name = f"db_vigili_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        metriche.incrementa('bot_export_righe_totale', len(vigili), tipo='vigili')
         
         await query.edit_message_text("📤 Generazione file Vigili in corso...")
         await context.bot.send_document(
@@ -1936,13 +4262,10 @@ async def esegui_export_vigili(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception as e:
         await query.edit_message_text(f"❌ Errore durante l'esportazione vigili: {str(e)}")
 
+@durata_misurata('bot_export_durata_secondi', tipo='mezzi')
+@handler_misurato
 async def esegui_export_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     try:
         mezzi = get_tutti_mezzi()
@@ -1965,6 +4288,7 @@ async def esegui_export_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE
         csv_bytes = csv_data.encode('utf-8')
         csv_file = BytesIO(csv_bytes)
         csv_file.name = f"db_mezzi_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        metriche.incrementa('bot_export_righe_totale', len(mezzi), tipo='mezzi')
         
         await query.edit_message_text("📤 Generazione file Mezzi in corso...")
         await context.bot.send_document(
@@ -1977,13 +4301,10 @@ async def esegui_export_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception as e:
         await query.edit_message_text(f"❌ Errore durante l'esportazione mezzi: {str(e)}")
 
+@durata_misurata('bot_export_durata_secondi', tipo='utenti')
+@handler_misurato
 async def esegui_export_utenti(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     try:
         utenti = get_utenti_approvati()
@@ -2010,6 +4331,7 @@ async def esegui_export_utenti(update: Update, context: ContextTypes.DEFAULT_TYP
         csv_bytes = csv_data.encode('utf-8')
         csv_file = BytesIO(csv_bytes)
         csv_file.name = f"db_user_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        metriche.incrementa('bot_export_righe_totale', len(utenti), tipo='utenti')
         
         await query.edit_message_text("📤 Generazione file Utenti in corso...")
         await context.bot.send_document(
@@ -2022,14 +4344,10 @@ async def esegui_export_utenti(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception as e:
         await query.edit_message_text(f"❌ Errore durante l'esportazione utenti: {str(e)}")
 
+@handler_misurato
 async def mostra_scelta_anno_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Mostra la selezione degli anni per l'esportazione"""
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     anni = get_anni_disponibili()
     
@@ -2052,14 +4370,11 @@ async def mostra_scelta_anno_export(update: Update, context: ContextTypes.DEFAUL
         reply_markup=reply_markup
     )
 
+@durata_misurata('bot_export_durata_secondi', tipo='interventi')
+@handler_misurato
 async def esegui_export_interventi_anno(update: Update, context: ContextTypes.DEFAULT_TYPE, anno: str = None):
     """Esporta gli interventi per un anno specifico"""
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     try:
         if anno == "tutti":
@@ -2090,7 +4405,7 @@ async def esegui_export_interventi_anno(update: Update, context: ContextTypes.DE
                 
                 # Recupera i partecipanti per questo intervento
                 partecipanti_nomi = []
-                conn = sqlite3.connect(DATABASE_NAME)
+                conn = connetti_db()
                 c = conn.cursor()
                 c.execute('''SELECT v.nome, v.cognome 
                              FROM partecipanti p 
@@ -2127,6 +4442,7 @@ async def esegui_export_interventi_anno(update: Update, context: ContextTypes.DE
         csv_bytes = csv_data.encode('utf-8')
         csv_file = BytesIO(csv_bytes)
         csv_file.name = f"{filename_suffix}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        metriche.incrementa('bot_export_righe_totale', len(interventi), tipo='interventi')
         
         await query.edit_message_text("📤 Generazione file in corso...")
         await context.bot.send_document(
@@ -2139,20 +4455,21 @@ async def esegui_export_interventi_anno(update: Update, context: ContextTypes.DE
     except Exception as e:
         await query.edit_message_text(f"❌ Errore durante l'esportazione: {str(e)}")
 
+@handler_misurato
 async def invia_csv_admin_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Invio manuale dei CSV agli admin"""
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     await query.edit_message_text("📤 Invio CSV a tutti gli admin in corso...")
-    await invia_csv_automatico_admin(context)
+    try:
+        await invia_csv_automatico_admin(context)
+    except Exception as e:
+        await query.edit_message_text(f"❌ Invio CSV non completato: {e}")
+        return
     await query.edit_message_text("✅ CSV inviati a tutti gli admin!")
 
 # === GESTIONE RICHIESTE ACCESSO ===
+@handler_misurato
 async def gestisci_richieste(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not is_admin(user_id):
@@ -2176,13 +4493,9 @@ async def gestisci_richieste(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     await update.message.reply_text(messaggio, reply_markup=reply_markup)
 
+@handler_misurato
 async def mostra_richieste_attesa(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     richieste = get_richieste_in_attesa()
     if not richieste:
@@ -2215,13 +4528,9 @@ async def mostra_richieste_attesa(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def mostra_utenti_approvati(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     utenti = get_utenti_approvati()
     if not utenti:
@@ -2249,13 +4558,9 @@ async def mostra_utenti_approvati(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def conferma_rimozione_utente(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_rimuovere: int):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     utenti = get_utenti_approvati()
     utente = next((u for u in utenti if u[0] == user_id_rimuovere), None)
@@ -2287,13 +4592,9 @@ async def conferma_rimozione_utente(update: Update, context: ContextTypes.DEFAUL
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def esegui_rimozione_utente(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_rimuovere: int):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     utenti = get_utenti_approvati()
     utente = next((u for u in utenti if u[0] == user_id_rimuovere), None)
@@ -2314,6 +4615,7 @@ async def esegui_rimozione_utente(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_text("❌ Utente non trovato.")
 
 # === HANDLER START ===
+@handler_misurato
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
@@ -2321,13 +4623,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for key in list(context.user_data.keys()):
         del context.user_data[key]
     
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''INSERT OR IGNORE INTO utenti (user_id, username, nome, ruolo) 
                  VALUES (?, ?, ?, 'in_attesa')''', 
                  (user_id, update.effective_user.username, user_name))
+    nuovo_utente = c.rowcount
     conn.commit()
     conn.close()
+    if nuovo_utente:
+        ruoli_utenti.imposta(user_id, 'in_attesa')
 
     if not is_user_approved(user_id):
         richieste = get_richieste_in_attesa()
@@ -2350,17 +4655,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(welcome_text, reply_markup=crea_tastiera_fisica(user_id))
 
 # === NUOVO INTERVENTO - FLUSSO COMPLETO ===
+@handler_misurato
 async def avvia_nuovo_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not is_user_approved(user_id):
         return
 
-    for key in ['nuovo_intervento', 'fase', 'vigili_da_selezionare', 'vigili_selezionati']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'nuovo')
     
     context.user_data['nuovo_intervento'] = {}
-    context.user_data['fase'] = 'scelta_tipo'
+    if not await macchina_fasi.passa(update, context, 'scelta_tipo'):
+        return
     
     keyboard = [
         [
@@ -2376,16 +4681,13 @@ async def avvia_nuovo_intervento(update: Update, context: ContextTypes.DEFAULT_T
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def gestisci_scelta_tipo(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     if callback_data == "tipo_nuovo":
-        context.user_data['fase'] = 'inserisci_rapporto'
+        if not await macchina_fasi.passa(update, context, 'inserisci_rapporto'):
+            return
         await query.edit_message_text(
             "📝 **INSERISCI RAPPORTO COMO**\n\n"
             "Inserisci il numero del rapporto Como (solo numeri):"
@@ -2415,15 +4717,11 @@ async def gestisci_scelta_tipo(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=reply_markup
         )
 
+@handler_misurato
 async def gestisci_collega_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE, intervento_id: int):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     c.execute('''SELECT rapporto_como, numero_erba, indirizzo, tipologia FROM interventi WHERE id = ?''', (intervento_id,))
     intervento = c.fetchone()
@@ -2433,6 +4731,8 @@ async def gestisci_collega_intervento(update: Update, context: ContextTypes.DEFA
         rapporto_como, numero_erba, indirizzo, tipologia = intervento
         progressivo_como = get_progressivo_per_rapporto(rapporto_como)
         
+        if not await macchina_fasi.passa(update, context, 'data_uscita'):
+            return
         context.user_data['nuovo_intervento']['rapporto_como'] = rapporto_como
         context.user_data['nuovo_intervento']['progressivo_como'] = progressivo_como
         context.user_data['nuovo_intervento']['numero_erba'] = numero_erba
@@ -2443,8 +4743,6 @@ async def gestisci_collega_intervento(update: Update, context: ContextTypes.DEFA
             if tipologia:
                 context.user_data['nuovo_intervento']['tipologia'] = tipologia
         
-        context.user_data['fase'] = 'data_uscita'
-        
         oggi = datetime.now().strftime('%d/%m/%Y')
         ieri = (datetime.now() - timedelta(days=1)).strftime('%d/%m/%Y')
         
@@ -2469,6 +4767,7 @@ async def gestisci_collega_intervento(update: Update, context: ContextTypes.DEFA
         
         await query.edit_message_text(messaggio, reply_markup=reply_markup)
 
+@handler_misurato
 async def gestisci_rapporto_como(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rapporto = update.message.text.strip()
     
@@ -2476,10 +4775,11 @@ async def gestisci_rapporto_como(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ Inserisci solo numeri! Riprova:")
         return
     
+    if not await macchina_fasi.passa(update, context, 'data_uscita'):
+        return
     context.user_data['nuovo_intervento']['rapporto_como'] = rapporto
     context.user_data['nuovo_intervento']['progressivo_como'] = "01"
     context.user_data['nuovo_intervento']['numero_erba'] = get_prossimo_numero_erba()
-    context.user_data['fase'] = 'data_uscita'
     
     oggi = datetime.now().strftime('%d/%m/%Y')
     ieri = (datetime.now() - timedelta(days=1)).strftime('%d/%m/%Y')
@@ -2498,27 +4798,25 @@ async def gestisci_rapporto_como(update: Update, context: ContextTypes.DEFAULT_T
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def gestisci_data_uscita(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     if callback_data == "data_oggi":
         data_uscita = datetime.now()
     else:
         data_uscita = datetime.now() - timedelta(days=1)
     
+    if not await macchina_fasi.passa(update, context, 'ora_uscita'):
+        return
     context.user_data['nuovo_intervento']['data_uscita'] = data_uscita.strftime('%Y-%m-%d')
-    context.user_data['fase'] = 'ora_uscita'
     
     await query.edit_message_text(
         "⏰ **ORA USCITA**\n\n"
         "Inserisci l'ora di uscita (formato 24h, es: 1423 per le 14:23):"
     )
 
+@handler_misurato
 async def gestisci_ora_uscita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         ora_str = update.message.text.strip()
@@ -2533,8 +4831,9 @@ async def gestisci_ora_uscita(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         data_uscita = datetime.strptime(context.user_data['nuovo_intervento']['data_uscita'], '%Y-%m-%d')
         data_uscita = data_uscita.replace(hour=ore, minute=minuti)
+        if not await macchina_fasi.passa(update, context, 'data_rientro'):
+            return
         context.user_data['nuovo_intervento']['data_uscita_completa'] = data_uscita.strftime('%Y-%m-%d %H:%M:%S')
-        context.user_data['fase'] = 'data_rientro'
         
         oggi = datetime.now().strftime('%d/%m/%Y')
         ieri = (datetime.now() - timedelta(days=1)).strftime('%d/%m/%Y')
@@ -2556,27 +4855,25 @@ async def gestisci_ora_uscita(update: Update, context: ContextTypes.DEFAULT_TYPE
     except ValueError as e:
         await update.message.reply_text("❌ Formato ora non valido! Inserisci 4 cifre (es: 1423 per 14:23):")
 
+@handler_misurato
 async def gestisci_data_rientro(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     if callback_data == "rientro_oggi":
         data_rientro = datetime.now()
     else:
         data_rientro = datetime.now() - timedelta(days=1)
     
+    if not await macchina_fasi.passa(update, context, 'ora_rientro'):
+        return
     context.user_data['nuovo_intervento']['data_rientro'] = data_rientro.strftime('%Y-%m-%d')
-    context.user_data['fase'] = 'ora_rientro'
     
     await query.edit_message_text(
         "⏰ **ORA RIENTRO**\n\n"
         "Inserisci l'ora di rientro (formato 24h, es: 1630 per le 16:30):"
     )
 
+@handler_misurato
 async def gestisci_ora_rientro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         ora_str = update.message.text.strip()
@@ -2602,15 +4899,11 @@ async def gestisci_ora_rientro(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return
         
+        if not await macchina_fasi.passa(update, context, 'selezione_mezzo'):
+            return
         context.user_data['nuovo_intervento']['data_rientro_completa'] = data_rientro.strftime('%Y-%m-%d %H:%M:%S')
-        context.user_data['fase'] = 'selezione_mezzo'
-        
-        mezzi = get_mezzi_attivi()
-        keyboard = []
-        for targa, tipo in mezzi:
-            keyboard.append([InlineKeyboardButton(f"🚒 {targa} - {tipo}", callback_data=f"mezzo_{targa}")])
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = tastiere_anagrafiche.tastiera('mezzo')
         await update.message.reply_text(
             "🚒 **SELEZIONE MEZZO**\n\n"
             "Scegli il mezzo utilizzato:",
@@ -2620,26 +4913,22 @@ async def gestisci_ora_rientro(update: Update, context: ContextTypes.DEFAULT_TYP
     except ValueError as e:
         await update.message.reply_text("❌ Formato ora non valido! Inserisci 4 cifres (es: 1630 per 16:30):")
 
-async def gestisci_selezione_mezzo(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
+@handler_misurato
+async def gestisci_selezione_mezzo(update: Update, context: ContextTypes.DEFAULT_TYPE, targa: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    targa = callback_data.replace('mezzo_', '')
-    mezzi = get_mezzi_attivi()
-    tipo_mezzo = next((tipo for targa_m, tipo in mezzi if targa_m == targa), "")
+    mezzo = get_mezzo_by_targa(targa)
+    tipo_mezzo = mezzo.tipo if mezzo and mezzo.attivo == 1 else ""
+    
+    progressivo = context.user_data['nuovo_intervento'].get('progressivo_como', '01')
+    cambio_possibile = progressivo in ['02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']
     
+    if not await macchina_fasi.passa(update, context, 'cambio_personale' if cambio_possibile else 'selezione_capopartenza'):
+        return
     context.user_data['nuovo_intervento']['mezzo_targa'] = targa
     context.user_data['nuovo_intervento']['mezzo_tipo'] = tipo_mezzo
     
-    progressivo = context.user_data['nuovo_intervento'].get('progressivo_como', '01')
-    
-    if progressivo in ['02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-        context.user_data['fase'] = 'cambio_personale'
-        
+    if cambio_possibile:
         keyboard = [
             [
                 InlineKeyboardButton("✅ Sì", callback_data="cambio_si"),
@@ -2655,64 +4944,41 @@ async def gestisci_selezione_mezzo(update: Update, context: ContextTypes.DEFAULT
         )
     else:
         context.user_data['nuovo_intervento']['cambio_personale'] = False
-        context.user_data['fase'] = 'selezione_capopartenza'
-        
-        vigili = get_vigili_attivi()
-        keyboard = []
-        for vigile_id, nome, cognome, qualifica in vigili:
-            keyboard.append([InlineKeyboardButton(f"👨‍🚒 {cognome} {nome} ({qualifica})", callback_data=f"capo_{vigile_id}")])
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = tastiere_anagrafiche.tastiera('capo')
         await query.edit_message_text(
             "👨‍🚒 **CAPOPARTENZA**\n\n"
             "Seleziona il capopartenza:",
             reply_markup=reply_markup
         )
 
+@handler_misurato
 async def gestisci_cambio_personale(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
+    if not await macchina_fasi.passa(update, context, 'selezione_capopartenza'):
+        return
     context.user_data['nuovo_intervento']['cambio_personale'] = (callback_data == "cambio_si")
-    context.user_data['fase'] = 'selezione_capopartenza'
-    
-    vigili = get_vigili_attivi()
-    keyboard = []
-    for vigile_id, nome, cognome, qualifica in vigili:
-        keyboard.append([InlineKeyboardButton(f"👨‍🚒 {cognome} {nome} ({qualifica})", callback_data=f"capo_{vigile_id}")])
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = tastiere_anagrafiche.tastiera('capo')
     await query.edit_message_text(
         "👨‍🚒 **CAPOPARTENZA**\n\n"
         "Seleziona il capopartenza:",
         reply_markup=reply_markup
     )
 
-async def gestisci_selezione_capopartenza(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
+@handler_misurato
+async def gestisci_selezione_capopartenza(update: Update, context: ContextTypes.DEFAULT_TYPE, vigile_id: int):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    vigile_id = int(callback_data.replace('capo_', ''))
     vigile = get_vigile_by_id(vigile_id)
     
+    if not await macchina_fasi.passa(update, context, 'selezione_autista'):
+        return
     context.user_data['nuovo_intervento']['capopartenza_id'] = vigile_id
     context.user_data['nuovo_intervento']['capopartenza'] = f"{vigile[1]} {vigile[2]}"
-    context.user_data['fase'] = 'selezione_autista'
     
-    vigili = get_vigili_attivi()
-    keyboard = []
-    for vigile_id_a, nome, cognome, qualifica in vigili:
-        keyboard.append([InlineKeyboardButton(f"🚗 {cognome} {nome} ({qualifica})", callback_data=f"autista_{vigile_id_a}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = tastiere_anagrafiche.tastiera('autista')
     await query.edit_message_text(
         "🚗 **AUTISTA**\n\n"
         "Seleziona l'autista (può essere anche il capopartenza):",
@@ -2720,6 +4986,7 @@ async def gestisci_selezione_capopartenza(update: Update, context: ContextTypes.
     )
 
 # === SISTEMA DI SELEZIONE VIGILI MIGLIORATO ===
+@handler_misurato
 async def mostra_selezione_vigili_multipla(update, context):
     """Mostra la selezione multipla dei vigili partecipanti"""
     query = update.callback_query
@@ -2728,42 +4995,21 @@ async def mostra_selezione_vigili_multipla(update, context):
     if 'vigili_selezionati' not in context.user_data:
         context.user_data['vigili_selezionati'] = []
     
+    # Vigili e bottoni dalla stessa versione del catalogo
+    tastiere = tastiere_anagrafiche.attuali()
+    
     # Prendi tutti i vigili attivi (escludendo capopartenza e autista già selezionati)
-    tutti_vigili = get_vigili_attivi()
-    vigili_disponibili = [
-        vigile for vigile in tutti_vigili 
-        if vigile[0] not in [
-            context.user_data['nuovo_intervento']['capopartenza_id'],
-            context.user_data['nuovo_intervento']['autista_id']
-        ]
-    ]
+    esclusi = (context.user_data['nuovo_intervento']['capopartenza_id'],
+               context.user_data['nuovo_intervento']['autista_id'])
+    vigili_disponibili = [vigile for vigile in tastiere['vigili_attivi'] if vigile[0] not in esclusi]
     
     context.user_data['vigili_disponibili'] = vigili_disponibili
     
-    # Crea tastiera con selezione multipla
-    keyboard = []
-    
-    for vigile in vigili_disponibili:
-        vigile_id, nome, cognome, qualifica = vigile
-        is_selected = vigile_id in context.user_data['vigili_selezionati']
-        
-        emoji = "✅" if is_selected else "⚪"
-        button_text = f"{emoji} {cognome} {nome} ({qualifica})"
-        
-        keyboard.append([
-            InlineKeyboardButton(button_text, callback_data=f"toggle_vigile_{vigile_id}")
-        ])
-    
-    # Aggiungi bottoni di controllo
-    keyboard.append([
-        InlineKeyboardButton("🔄 Deseleziona Tutto", callback_data="deseleziona_tutti"),
-        InlineKeyboardButton("✅ Seleziona Tutto", callback_data="seleziona_tutti")
-    ])
-    
-    keyboard.append([
-        InlineKeyboardButton("➡️ AVANTI", callback_data="conferma_partecipanti"),
-        InlineKeyboardButton("❌ ANNULLA", callback_data="annulla_selezione")
-    ])
+    # Tastiera con selezione multipla: per ogni vigile il bottone già pronto nello stato giusto
+    selezionati = set(context.user_data['vigili_selezionati'])
+    bottoni = tastiere['partecipanti']
+    keyboard = [[bottoni[vigile[0]][vigile[0] in selezionati]] for vigile in vigili_disponibili]
+    keyboard.extend(RIGHE_CONTROLLO_PARTECIPANTI)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -2791,23 +5037,23 @@ async def mostra_selezione_vigili_multipla(update, context):
         # Se il messaggio non è cambiato, non fare nulla
         pass
 
+@handler_misurato
+async def commuta_vigile(update: Update, context: ContextTypes.DEFAULT_TYPE, vigile_id: int):
+    """Seleziona o deseleziona un vigile tra i partecipanti"""
+    if vigile_id in context.user_data['vigili_selezionati']:
+        context.user_data['vigili_selezionati'].remove(vigile_id)
+    else:
+        context.user_data['vigili_selezionati'].append(vigile_id)
+    
+    # Ricarica la selezione
+    await mostra_selezione_vigili_multipla(update, context)
+
+@handler_misurato
 async def gestisci_selezione_vigile_multipla(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
-    """Gestisce la selezione/deselezione dei vigili"""
+    """Gestisce i comandi della selezione vigili (tutti, nessuno, conferma, annulla)"""
     query = update.callback_query
     
-    if callback_data.startswith("toggle_vigile_"):
-        vigile_id = int(callback_data.replace("toggle_vigile_", ""))
-        
-        # Toggle della selezione
-        if vigile_id in context.user_data['vigili_selezionati']:
-            context.user_data['vigili_selezionati'].remove(vigile_id)
-        else:
-            context.user_data['vigili_selezionati'].append(vigile_id)
-        
-        # Ricarica la selezione
-        await mostra_selezione_vigili_multipla(update, context)
-    
-    elif callback_data == "seleziona_tutti":
+    if callback_data == "seleziona_tutti":
         # Seleziona tutti i vigili disponibili
         context.user_data['vigili_selezionati'] = [
             vigile[0] for vigile in context.user_data['vigili_disponibili']
@@ -2825,9 +5071,11 @@ async def gestisci_selezione_vigile_multipla(update: Update, context: ContextTyp
     elif callback_data == "annulla_selezione":
         await query.edit_message_text("❌ Selezione partecipanti annullata.")
         # Torna al menu principale o ricomincia il flusso
-        context.user_data['fase'] = 'selezione_vigili'
+        if not await macchina_fasi.passa(update, context, 'selezione_vigili'):
+            return
         await mostra_selezione_vigili_multipla(update, context)
 
+@handler_misurato
 async def conferma_partecipanti(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Conferma la selezione dei partecipanti e procede"""
     query = update.callback_query
@@ -2843,8 +5091,9 @@ async def conferma_partecipanti(update: Update, context: ContextTypes.DEFAULT_TY
         if vigile_id not in partecipanti_finali:
             partecipanti_finali.append(vigile_id)
     
+    if not await macchina_fasi.passa(update, context, 'inserisci_comune'):
+        return
     context.user_data['nuovo_intervento']['partecipanti'] = partecipanti_finali
-    context.user_data['fase'] = 'inserisci_comune'
     
     # Riepilogo partecipanti
     partecipanti_nomi = []
@@ -2868,65 +5117,54 @@ async def conferma_partecipanti(update: Update, context: ContextTypes.DEFAULT_TY
     
     await query.edit_message_text(messaggio)
 
-async def gestisci_selezione_autista(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
-    query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
-    
-    vigile_id = int(callback_data.replace('autista_', ''))
+@handler_misurato
+async def gestisci_selezione_autista(update: Update, context: ContextTypes.DEFAULT_TYPE, vigile_id: int):
     vigile = get_vigile_by_id(vigile_id)
     
+    # ⭐⭐ MODIFICA: Ora passa direttamente alla selezione multipla ⭐⭐
+    if not await macchina_fasi.passa(update, context, 'selezione_vigili_multipla'):
+        return
+    
     context.user_data['nuovo_intervento']['autista_id'] = vigile_id
     context.user_data['nuovo_intervento']['autista'] = f"{vigile[1]} {vigile[2]}"
     
-    # ⭐⭐ MODIFICA: Ora passa direttamente alla selezione multipla ⭐⭐
-    context.user_data['fase'] = 'selezione_vigili_multipla'
-    
     await mostra_selezione_vigili_multipla(update, context)
 
+@handler_misurato
 async def gestisci_comune(update: Update, context: ContextTypes.DEFAULT_TYPE):
     comune = update.message.text.strip()
     comune_normalizzato = normalizza_comune(comune)
+    if not await macchina_fasi.passa(update, context, 'inserisci_via'):
+        return
     context.user_data['nuovo_intervento']['comune'] = comune_normalizzato
-    context.user_data['fase'] = 'inserisci_via'
     
     await update.message.reply_text(
         "📍 **VIA**\n\n"
         "Inserisci la via dell'intervento:"
     )
 
+@handler_misurato
 async def gestisci_via(update: Update, context: ContextTypes.DEFAULT_TYPE):
     via = update.message.text.strip()
+    if not await macchina_fasi.passa(update, context, 'tipologia_intervento'):
+        return
     context.user_data['nuovo_intervento']['via'] = via
     
     comune = context.user_data['nuovo_intervento'].get('comune', '')
     indirizzo_completo = f"{comune}, {via}" if comune else via
     context.user_data['nuovo_intervento']['indirizzo'] = indirizzo_completo
     
-    context.user_data['fase'] = 'tipologia_intervento'
     await mostra_selezione_tipologia_paginata(update, context)
 
 # === GESTIONE TIPOLOGIA NEL FLUSSO NUOVO INTERVENTO - VERSIONE CORRETTA ===
+@handler_misurato
 async def gestisci_tipologia_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    if callback_data.startswith("tipopage_"):
-        # Navigazione pagine
-        page = int(callback_data.replace('tipopage_', ''))
-        await mostra_selezione_tipologia_paginata(query, context, page)
-        return
-    
-    elif callback_data == "tipologia_altro":
+    if callback_data == "tipologia_altro":
         # Tipologia personalizzata
-        context.user_data['fase'] = 'inserisci_tipologia_personalizzata'
+        if not await macchina_fasi.passa(update, context, 'inserisci_tipologia_personalizzata'):
+            return
         await query.edit_message_text(
             "✏️ **TIPOLOGIA PERSONALIZZATA**\n\n"
             "Inserisci la tipologia di intervento:"
@@ -2939,8 +5177,9 @@ async def gestisci_tipologia_intervento(update: Update, context: ContextTypes.DE
             tipologia_completa = TIPOLOGIE_MAPPING[callback_data][1]
             display_name = TIPOLOGIE_MAPPING[callback_data][0]
             
+            if not await macchina_fasi.passa(update, context, 'km_finali'):
+                return
             context.user_data['nuovo_intervento']['tipologia'] = tipologia_completa
-            context.user_data['fase'] = 'km_finali'
             
             await query.edit_message_text(
                 f"✅ Tipologia selezionata: **{display_name}**\n\n"
@@ -2953,10 +5192,12 @@ async def gestisci_tipologia_intervento(update: Update, context: ContextTypes.DE
                 reply_markup=crea_tastiera_tipologie_paginata(0)
             )
 
+@handler_misurato
 async def gestisci_tipologia_personalizzata(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tipologia = update.message.text.strip()
+    if not await macchina_fasi.passa(update, context, 'km_finali'):
+        return
     context.user_data['nuovo_intervento']['tipologia'] = tipologia
-    context.user_data['fase'] = 'km_finali'
     
     await update.message.reply_text(
         f"✅ Tipologia personalizzata salvata: **{tipologia}**\n\n"
@@ -2964,6 +5205,7 @@ async def gestisci_tipologia_personalizzata(update: Update, context: ContextType
         "Inserisci i km finali del mezzo (solo numeri):"
     )
 
+@handler_misurato
 async def gestisci_km_finali(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         km_finali = int(update.message.text.strip())
@@ -2979,8 +5221,9 @@ async def gestisci_km_finali(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
         
+        if not await macchina_fasi.passa(update, context, 'litri_riforniti'):
+            return
         context.user_data['nuovo_intervento']['km_finali'] = km_finali
-        context.user_data['fase'] = 'litri_riforniti'
         
         await update.message.reply_text(
             "⛽ **LITRI RIFORNITI**\n\n"
@@ -2990,20 +5233,23 @@ async def gestisci_km_finali(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await update.message.reply_text("❌ Valore non valido! Inserisci solo numeri interi:")
 
+@handler_misurato
 async def gestisci_litri_riforniti(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         litri_riforniti = int(update.message.text.strip())
         if litri_riforniti < 0:
             raise ValueError("Valore negativo")
         
+        if not await macchina_fasi.passa(update, context, 'conferma'):
+            return
         context.user_data['nuovo_intervento']['litri_riforniti'] = litri_riforniti
-        context.user_data['fase'] = 'conferma'
         
         await mostra_riepilogo(update, context)
         
     except ValueError:
         await update.message.reply_text("❌ Valore non valido! Inserisci solo numeri interi:")
 
+@handler_misurato
 async def mostra_riepilogo(update, context):
     dati = context.user_data['nuovo_intervento']
     
@@ -3054,13 +5300,9 @@ async def mostra_riepilogo(update, context):
     else:
         await update.edit_message_text(riepilogo, reply_markup=reply_markup)
 
+@handler_misurato
 async def conferma_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     if callback_data == "conferma_si":
         try:
@@ -3080,11 +5322,10 @@ async def conferma_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         await query.edit_message_text("❌ Intervento annullato.")
     
-    for key in ['nuovo_intervento', 'fase', 'vigili_da_selezionare', 'vigili_selezionati']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'nuovo')
 
 # === GESTIONE AMMINISTRATIVA ===
+@handler_misurato
 async def gestione_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not is_admin(user_id):
@@ -3106,13 +5347,9 @@ async def gestione_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def gestione_vigili_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     keyboard = [
         [InlineKeyboardButton("👥 Lista Vigili", callback_data="lista_vigili")],
@@ -3126,13 +5363,9 @@ async def gestione_vigili_admin(update: Update, context: ContextTypes.DEFAULT_TY
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def gestione_mezzi_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     keyboard = [
         [InlineKeyboardButton("🚒 Lista Mezzi", callback_data="lista_mezzi")],
@@ -3146,13 +5379,9 @@ async def gestione_mezzi_admin(update: Update, context: ContextTypes.DEFAULT_TYP
         reply_markup=reply_markup
     )
 
+@handler_misurato
 async def importa_mezzi_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     await query.edit_message_text(
         "📥 **IMPORTA MEZZI DA CSV**\n\n"
@@ -3163,13 +5392,9 @@ async def importa_mezzi_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "I mezzi verranno aggiunti automaticamente al database."
     )
 
+@handler_misurato
 async def mostra_lista_vigili(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     vigili = get_tutti_vigili()
     if not vigili:
@@ -3191,13 +5416,9 @@ async def mostra_lista_vigili(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     await query.edit_message_text(messaggio)
 
+@handler_misurato
 async def mostra_lista_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     mezzi = get_tutti_mezzi()
     if not mezzi:
@@ -3212,13 +5433,9 @@ async def mostra_lista_mezzi(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     await query.edit_message_text(messaggio)
 
+@handler_misurato
 async def importa_vigili_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     await query.edit_message_text(
         "📥 **IMPORTA VIGILI DA CSV**\n\n"
@@ -3230,26 +5447,22 @@ async def importa_vigili_csv(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 # === MODIFICA INTERVENTO ===
+@handler_misurato
 async def avvia_modifica_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    for key in ['modifica_intervento', 'fase_modifica']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'modifica')
     
     context.user_data['modifica_intervento'] = {}
-    context.user_data['fase_modifica'] = 'anno'
+    if not await macchina_fasi.passa(update, context, 'modifica_anno'):
+        return
     
     await query.edit_message_text(
         "✏️ **MODIFICA INTERVENTO**\n\n"
         "Inserisci l'ANNO del rapporto Como da modificare (es: 2024):"
     )
 
+@handler_misurato
 async def gestisci_anno_modifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
     anno = update.message.text.strip()
     
@@ -3257,14 +5470,16 @@ async def gestisci_anno_modifica(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ Anno non valido! Inserisci 4 cifre (es: 2024):")
         return
     
+    if not await macchina_fasi.passa(update, context, 'modifica_rapporto'):
+        return
     context.user_data['modifica_intervento']['anno'] = anno
-    context.user_data['fase_modifica'] = 'rapporto'
     
     await update.message.reply_text(
         f"📅 Anno selezionato: {anno}\n\n"
         "Inserisci il numero del rapporto Como da modificare:"
     )
 
+@handler_misurato
 async def gestisci_rapporto_modifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rapporto = update.message.text.strip()
     
@@ -3273,8 +5488,9 @@ async def gestisci_rapporto_modifica(update: Update, context: ContextTypes.DEFAU
         return
     
     anno = context.user_data['modifica_intervento']['anno']
+    if not await macchina_fasi.passa(update, context, 'modifica_progressivo'):
+        return
     context.user_data['modifica_intervento']['rapporto'] = rapporto
-    context.user_data['fase_modifica'] = 'progressivo'
     
     await update.message.reply_text(
         f"📄 Rapporto: {rapporto}\n"
@@ -3282,6 +5498,7 @@ async def gestisci_rapporto_modifica(update: Update, context: ContextTypes.DEFAU
         "Inserisci il progressivo dell'intervento da modificare (es: 01, 02):"
     )
 
+@handler_misurato
 async def gestisci_progressivo_modifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
     progressivo = update.message.text.strip().zfill(2)
     
@@ -3309,9 +5526,7 @@ async def gestisci_progressivo_modifica(update: Update, context: ContextTypes.DE
             f"❌ Intervento R{rapporto}/{progressivo} per l'anno {anno} non trovato.\n"
             f"Verifica i dati e riprova."
         )
-        for key in ['modifica_intervento', 'fase_modifica']:
-            if key in context.user_data:
-                del context.user_data[key]
+        macchina_fasi.termina(context, 'modifica')
         return
     
     context.user_data['modifica_intervento']['progressivo'] = progressivo
@@ -3319,6 +5534,7 @@ async def gestisci_progressivo_modifica(update: Update, context: ContextTypes.DE
     
     await mostra_campi_modificabili(update, context)
 
+@handler_misurato
 async def mostra_campi_modificabili(update, context):
     intervento = context.user_data['modifica_intervento']['dati']
     rapporto = context.user_data['modifica_intervento']['rapporto']
@@ -3356,47 +5572,33 @@ async def mostra_campi_modificabili(update, context):
             reply_markup=reply_markup
         )
 
+@handler_misurato
 async def gestisci_selezione_campo(update: Update, context: ContextTypes.DEFAULT_TYPE, campo: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     context.user_data['modifica_intervento']['campo_selezionato'] = campo
     
     if campo in ['mezzo', 'capopartenza', 'autista']:
         if campo == 'mezzo':
-            mezzi = get_mezzi_attivi()
-            keyboard = []
-            for targa, tipo in mezzi:
-                keyboard.append([InlineKeyboardButton(f"{targa} - {tipo}", callback_data=f"modmezzo_{targa}")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = tastiere_anagrafiche.tastiera('modmezzo')
             await query.edit_message_text("Seleziona il nuovo mezzo:", reply_markup=reply_markup)
         
         elif campo == 'capopartenza':
-            vigili = get_vigili_attivi()
-            keyboard = []
-            for vigile_id, nome, cognome, qualifica in vigili:
-                keyboard.append([InlineKeyboardButton(f"{cognome} {nome} ({qualifica})", callback_data=f"modcapo_{vigile_id}")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = tastiere_anagrafiche.tastiera('modcapo')
             await query.edit_message_text("Seleziona il nuovo capopartenza:", reply_markup=reply_markup)
         
         elif campo == 'autista':
-            vigili = get_vigili_attivi()
-            keyboard = []
-            for vigile_id, nome, cognome, qualifica in vigili:
-                keyboard.append([InlineKeyboardButton(f"{cognome} {nome} ({qualifica})", callback_data=f"modautista_{vigile_id}")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = tastiere_anagrafiche.tastiera('modautista')
             await query.edit_message_text("Seleziona il nuovo autista:", reply_markup=reply_markup)
     
     elif campo == 'tipologia':
-        context.user_data['fase_modifica'] = 'modifica_tipologia'
+        if not await macchina_fasi.passa(update, context, 'modifica_tipologia'):
+            return
         await mostra_selezione_tipologia_paginata(query, context, 0)
     
     elif campo == 'indirizzo':
-        context.user_data['fase_modifica'] = 'modifica_indirizzo'
+        if not await macchina_fasi.passa(update, context, 'modifica_indirizzo'):
+            return
         context.user_data['sottofase_indirizzo'] = 'comune'
         await query.edit_message_text(
             "🏘️ **MODIFICA INDIRIZZO**\n\n"
@@ -3404,7 +5606,8 @@ async def gestisci_selezione_campo(update: Update, context: ContextTypes.DEFAULT
         )
     
     elif campo in ['data_uscita', 'data_rientro']:
-        context.user_data['fase_modifica'] = 'modifica_orari'
+        if not await macchina_fasi.passa(update, context, 'modifica_orari'):
+            return
         context.user_data['tipo_orario'] = campo
         
         if campo == 'data_uscita':
@@ -3423,7 +5626,8 @@ async def gestisci_selezione_campo(update: Update, context: ContextTypes.DEFAULT
             )
     
     else:
-        context.user_data['fase_modifica'] = 'inserisci_valore'
+        if not await macchina_fasi.passa(update, context, 'modifica_valore'):
+            return
         messaggi_campi = {
             'km_finali': "Inserisci i nuovi km finali:",
             'litri_riforniti': "Inserisci i nuovi litri riforniti:"
@@ -3432,23 +5636,14 @@ async def gestisci_selezione_campo(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text(messaggi_campi.get(campo, "Inserisci il nuovo valore:"))
 
 # === GESTIONE TIPOLOGIA NEL FLUSSO MODIFICA INTERVENTO - VERSIONE CORRETTA ===
+@handler_misurato
 async def gestisci_tipologia_modifica(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
-    
-    if callback_data.startswith("tipopage_"):
-        # Navigazione pagine
-        page = int(callback_data.replace('tipopage_', ''))
-        await mostra_selezione_tipologia_paginata(query, context, page)
-        return
     
-    elif callback_data == "tipologia_altro":
+    if callback_data == "tipologia_altro":
         # Tipologia personalizzata
-        context.user_data['fase_modifica'] = 'inserisci_tipologia_modifica'
+        if not await macchina_fasi.passa(update, context, 'modifica_tipologia_personalizzata'):
+            return
         await query.edit_message_text(
             "✏️ **MODIFICA TIPOLOGIA**\n\n"
             "Inserisci la nuova tipologia di intervento:"
@@ -3473,15 +5668,14 @@ async def gestisci_tipologia_modifica(update: Update, context: ContextTypes.DEFA
             )
             
             # Pulisci lo stato
-            for key in ['modifica_intervento', 'fase_modifica']:
-                if key in context.user_data:
-                    del context.user_data[key]
+            macchina_fasi.termina(context, 'modifica')
         else:
             await query.edit_message_text(
                 "❌ Errore nella selezione della tipologia. Riprova.",
                 reply_markup=crea_tastiera_tipologie_paginata(0)
             )
 
+@handler_misurato
 async def gestisci_modifica_indirizzo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     testo = update.message.text.strip()
     sottofase = context.user_data['sottofase_indirizzo']
@@ -3522,10 +5716,9 @@ async def gestisci_modifica_indirizzo(update: Update, context: ContextTypes.DEFA
         except Exception as e:
             await update.message.reply_text(f"❌ Errore durante l'aggiornamento: {str(e)}")
         
-        for key in ['modifica_intervento', 'fase_modifica', 'sottofase_indirizzo', 'nuovo_comune', 'nuova_via']:
-            if key in context.user_data:
-                del context.user_data[key]
+        macchina_fasi.termina(context, 'modifica')
 
+@handler_misurato
 async def gestisci_modifica_orari(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         nuovo_valore = update.message.text.strip()
@@ -3572,17 +5765,11 @@ async def gestisci_modifica_orari(update: Update, context: ContextTypes.DEFAULT_
     except Exception as e:
         await update.message.reply_text(f"❌ Errore durante la modifica: {str(e)}")
     
-    for key in ['modifica_intervento', 'fase_modifica', 'tipo_orario']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'modifica')
 
+@handler_misurato
 async def gestisci_valore_modifica_bottoni(update: Update, context: ContextTypes.DEFAULT_TYPE, campo: str, valore: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     rapporto = context.user_data['modifica_intervento']['rapporto']
     progressivo = context.user_data['modifica_intervento']['progressivo']
@@ -3599,8 +5786,8 @@ async def gestisci_valore_modifica_bottoni(update: Update, context: ContextTypes
         campo_db = campi_db.get(campo_selezionato)
         
         if campo_selezionato == 'mezzo':
-            mezzi = get_mezzi_attivi()
-            tipo_mezzo = next((tipo for targa_m, tipo in mezzi if targa_m == valore), "")
+            mezzo = get_mezzo_by_targa(valore)
+            tipo_mezzo = mezzo.tipo if mezzo and mezzo.attivo == 1 else ""
             aggiorna_intervento(rapporto, progressivo, 'mezzo_targa', valore)
             aggiorna_intervento(rapporto, progressivo, 'mezzo_tipo', tipo_mezzo)
             valore_mostrato = f"{valore} - {tipo_mezzo}"
@@ -3618,10 +5805,9 @@ async def gestisci_valore_modifica_bottoni(update: Update, context: ContextTypes
     except Exception as e:
         await query.edit_message_text(f"❌ Errore durante la modifica: {str(e)}")
     
-    for key in ['modifica_intervento', 'fase_modifica']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'modifica')
 
+@handler_misurato
 async def gestisci_valore_modifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
     nuovo_valore = update.message.text.strip()
     campo = context.user_data['modifica_intervento']['campo_selezionato']
@@ -3653,13 +5839,12 @@ async def gestisci_valore_modifica(update: Update, context: ContextTypes.DEFAULT
     except Exception as e:
         await update.message.reply_text(f"❌ Errore durante la modifica: {str(e)}")
     
-    for key in ['modifica_intervento', 'fase_modifica']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'modifica')
 # === FUNZIONE PER ELIMINARE INTERVENTO ===
+@query_misurata
 def elimina_intervento_db(rapporto, progressivo):
     """Elimina un intervento dal database dato rapporto e progressivo"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti_db()
     c = conn.cursor()
     
     try:
@@ -3683,6 +5868,7 @@ def elimina_intervento_db(rapporto, progressivo):
         
         conn.commit()
         conn.close()
+        riepilogo_servizio.invalida()
         return True
         
     except Exception as e:
@@ -3692,26 +5878,22 @@ def elimina_intervento_db(rapporto, progressivo):
         return False
 
 # === FLUSSO ELIMINAZIONE INTERVENTO ===
+@handler_misurato
 async def avvia_elimina_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    for key in ['elimina_intervento', 'fase_elimina']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'elimina')
     
     context.user_data['elimina_intervento'] = {}
-    context.user_data['fase_elimina'] = 'anno'
+    if not await macchina_fasi.passa(update, context, 'elimina_anno'):
+        return
     
     await query.edit_message_text(
         "🗑️ **ELIMINA INTERVENTO**\n\n"
         "Inserisci l'ANNO del rapporto Como da eliminare (es: 2024):"
     )
 
+@handler_misurato
 async def gestisci_anno_elimina(update: Update, context: ContextTypes.DEFAULT_TYPE):
     anno = update.message.text.strip()
     
@@ -3719,14 +5901,16 @@ async def gestisci_anno_elimina(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("❌ Anno non valido! Inserisci 4 cifre (es: 2024):")
         return
     
+    if not await macchina_fasi.passa(update, context, 'elimina_rapporto'):
+        return
     context.user_data['elimina_intervento']['anno'] = anno
-    context.user_data['fase_elimina'] = 'rapporto'
     
     await update.message.reply_text(
         f"📅 Anno selezionato: {anno}\n\n"
         "Inserisci il numero del rapporto Como da eliminare:"
     )
 
+@handler_misurato
 async def gestisci_rapporto_elimina(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rapporto = update.message.text.strip()
     
@@ -3735,8 +5919,9 @@ async def gestisci_rapporto_elimina(update: Update, context: ContextTypes.DEFAUL
         return
     
     anno = context.user_data['elimina_intervento']['anno']
+    if not await macchina_fasi.passa(update, context, 'elimina_progressivo'):
+        return
     context.user_data['elimina_intervento']['rapporto'] = rapporto
-    context.user_data['fase_elimina'] = 'progressivo'
     
     await update.message.reply_text(
         f"📄 Rapporto: {rapporto}\n"
@@ -3744,6 +5929,7 @@ async def gestisci_rapporto_elimina(update: Update, context: ContextTypes.DEFAUL
         "Inserisci il progressivo dell'intervento da eliminare (es: 01, 02):"
     )
 
+@handler_misurato
 async def gestisci_progressivo_elimina(update: Update, context: ContextTypes.DEFAULT_TYPE):
     progressivo = update.message.text.strip().zfill(2)
     
@@ -3772,9 +5958,7 @@ async def gestisci_progressivo_elimina(update: Update, context: ContextTypes.DEF
             f"❌ Intervento R{rapporto}/{progressivo} per l'anno {anno} non trovato.\n"
             f"Verifica i dati e riprova."
         )
-        for key in ['elimina_intervento', 'fase_elimina']:
-            if key in context.user_data:
-                del context.user_data[key]
+        macchina_fasi.termina(context, 'elimina')
         return
     
     context.user_data['elimina_intervento']['progressivo'] = progressivo
@@ -3782,6 +5966,7 @@ async def gestisci_progressivo_elimina(update: Update, context: ContextTypes.DEF
     
     await mostra_conferma_eliminazione(update, context)
 
+@handler_misurato
 async def mostra_conferma_eliminazione(update, context):
     intervento = context.user_data['elimina_intervento']['dati']
     rapporto = context.user_data['elimina_intervento']['rapporto']
@@ -3793,7 +5978,7 @@ async def mostra_conferma_eliminazione(update, context):
         
         # Recupera i partecipanti
         partecipanti_nomi = []
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = connetti_db()
         c = conn.cursor()
         c.execute('''SELECT v.nome, v.cognome 
                      FROM partecipanti p 
@@ -3836,13 +6021,9 @@ async def mostra_conferma_eliminazione(update, context):
         
         await update.message.reply_text(messaggio, reply_markup=reply_markup)
 
+@handler_misurato
 async def conferma_eliminazione_intervento(update: Update, context: ContextTypes.DEFAULT_TYPE, rapporto: str, progressivo: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     try:
         if elimina_intervento_db(rapporto, progressivo):
@@ -3862,25 +6043,18 @@ async def conferma_eliminazione_intervento(update: Update, context: ContextTypes
         await query.edit_message_text(f"❌ Errore durante l'eliminazione: {str(e)}")
     
     # Pulisci lo stato
-    for key in ['elimina_intervento', 'fase_elimina']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'elimina')
 
+@handler_misurato
 async def annulla_eliminazione(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
     await query.edit_message_text("❌ Eliminazione intervento annullata.")
     
     # Pulisci lo stato
-    for key in ['elimina_intervento', 'fase_elimina']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'elimina')
 # === STATISTICHE ===
+@handler_misurato
 async def mostra_statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE):
     anni = get_anni_disponibili()
     
@@ -3902,19 +6076,14 @@ async def mostra_statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=reply_markup
     )
 
-async def gestisci_statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data: str):
+@handler_misurato
+async def gestisci_statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE, anno: str):
     query = update.callback_query
-    try:
-        await query.answer()
-    except BadRequest as e:
-        if "Query is too old" in str(e):
-            return
     
-    if callback_data == "stats_tutti":
+    if anno == "tutti":
         stats = get_statistiche_anno()
         titolo = "TUTTI GLI ANNI"
     else:
-        anno = callback_data.replace('stats_', '')
         stats = get_statistiche_anno(anno)
         titolo = anno
     
@@ -3970,6 +6139,7 @@ async def gestisci_statistiche(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.edit_message_text(messaggio)
 
 # === ULTIMI INTERVENTI ===
+@handler_misurato
 async def ultimi_interventi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     interventi = get_ultimi_interventi_attivi()
     
@@ -3986,7 +6156,7 @@ async def ultimi_interventi(update: Update, context: ContextTypes.DEFAULT_TYPE):
         data_rientro_fmt = datetime.strptime(data_rientro, '%Y-%m-%d %H:%M:%S').strftime('%d/%m %H:%M') if data_rientro else "In corso"
         
         # Recupera altri dettagli dell'intervento
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = connetti_db()
         c = conn.cursor()
         c.execute('''SELECT mezzo_targa, mezzo_tipo, capopartenza, autista, tipologia 
                      FROM interventi WHERE id = ?''', (id_int,))
@@ -4012,15 +6182,18 @@ async def ultimi_interventi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(messaggio)
 
 # === CERCA RAPPORTO ===
+@handler_misurato
 async def cerca_rapporto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['cerca_rapporto'] = {}
-    context.user_data['fase_cerca'] = 'anno'
+    if not await macchina_fasi.passa(update, context, 'cerca_anno'):
+        return
     
     await update.message.reply_text(
         "🔍 **CERCA RAPPORTO**\n\n"
         "Inserisci l'ANNO del rapporto Como da cercare (es: 2024):"
     )
 
+@handler_misurato
 async def gestisci_anno_cerca(update: Update, context: ContextTypes.DEFAULT_TYPE):
     anno = update.message.text.strip()
     
@@ -4028,14 +6201,16 @@ async def gestisci_anno_cerca(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Anno non valido! Inserisci 4 cifre (es: 2024):")
         return
     
+    if not await macchina_fasi.passa(update, context, 'cerca_rapporto'):
+        return
     context.user_data['cerca_rapporto']['anno'] = anno
-    context.user_data['fase_cerca'] = 'rapporto'
     
     await update.message.reply_text(
         f"📅 Anno selezionato: {anno}\n\n"
         "Inserisci il numero del rapporto Como da cercare:"
     )
 
+@handler_misurato
 async def gestisci_rapporto_cerca(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rapporto = update.message.text.strip()
     
@@ -4064,9 +6239,7 @@ async def gestisci_rapporto_cerca(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text(
             f"❌ Nessun intervento trovato per il rapporto R{rapporto}."
         )
-        for key in ['cerca_rapporto', 'fase_cerca']:
-            if key in context.user_data:
-                del context.user_data[key]
+        macchina_fasi.termina(context, 'cerca')
         return
     
     messaggio = messaggio_titolo
@@ -4077,7 +6250,7 @@ async def gestisci_rapporto_cerca(update: Update, context: ContextTypes.DEFAULT_
             
             # Recupera i partecipanti
             partecipanti_nomi = []
-            conn = sqlite3.connect(DATABASE_NAME)
+            conn = connetti_db()
             c = conn.cursor()
             c.execute('''SELECT v.nome, v.cognome 
                          FROM partecipanti p 
@@ -4122,10 +6295,114 @@ async def gestisci_rapporto_cerca(update: Update, context: ContextTypes.DEFAULT_
     else:
         await update.message.reply_text(messaggio)
     
-    for key in ['cerca_rapporto', 'fase_cerca']:
-        if key in context.user_data:
-            del context.user_data[key]
+    macchina_fasi.termina(context, 'cerca')
+# === METRICHE DI SISTEMA (ADMIN) ===
+@handler_misurato
+async def comando_sistema(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono vedere le metriche.")
+        return
+    await update.message.reply_text(get_system_metrics())
+
+@handler_misurato
+async def comando_lag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Blocchi dell'event loop più lunghi registrati dall'avvio"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono vedere le metriche.")
+        return
+    peggiori = monitor_lag.elenco()
+    if not peggiori:
+        await update.message.reply_text(f"✅ Nessun blocco del loop oltre {LAG_SOGLIA_SECONDI}s dall'avvio.")
+        return
+    messaggio = f"🐢 **BLOCCHI EVENT LOOP** (soglia {LAG_SOGLIA_SECONDI}s, totale {monitor_lag.totale_blocchi})\n\n"
+    for blocco in peggiori[:10]:
+        ultima_riga = blocco['stack'].strip().splitlines()[-2:] if blocco['stack'] else []
+        messaggio += f"• {blocco['durata_secondi']:.2f}s - {blocco['handler'] or blocco['task'] or '-'}"
+        if blocco['callback_data']:
+            messaggio += f" ({blocco['callback_data']})"
+        messaggio += f" - {blocco['inizio']}\n"
+        if ultima_riga:
+            messaggio += f"  {ultima_riga[0].strip()}\n"
+    await update.message.reply_text(messaggio)
+
+@handler_misurato
+async def comando_latenze(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler più lenti nell'ultima ora (default) o nell'ultimo giorno: /latenze giorno"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono vedere le metriche.")
+        return
+    giorno = bool(context.args) and context.args[0].lower() in ('giorno', '24h', 'day')
+    finestra, etichetta = (86400, "ultime 24 ore") if giorno else (3600, "ultima ora")
+    righe = latenze_handler.riepilogo(finestra)
+    if not righe:
+        await update.message.reply_text(f"ℹ️ Nessun handler eseguito nell'{etichetta}.")
+        return
+    messaggio = f"⏱️ **HANDLER PIÙ LENTI** ({etichetta})\n\n"
+    for riga in righe[:12]:
+        messaggio += (f"• {riga['handler']}: p50 {riga['p50'] * 1000:.0f}ms, p95 {riga['p95'] * 1000:.0f}ms, "
+                      f"p99 {riga['p99'] * 1000:.0f}ms ({riga['conteggio']}x)\n")
+    await update.message.reply_text(messaggio)
+
+@handler_misurato
+async def comando_sql(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Query che pesano di più sul tempo totale del database"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono vedere le metriche.")
+        return
+    righe = traccia_sql.classifica(limite=8)
+    if not righe:
+        await update.message.reply_text("ℹ️ Nessuna query registrata.")
+        return
+    messaggio = f"🗄️ **QUERY PIÙ COSTOSE** (lente: {len(traccia_sql.lente)})\n\n"
+    for riga in righe:
+        messaggio += (f"• {riga['totale_secondi'] * 1000:.0f}ms totali, {riga['conteggio']}x, "
+                      f"max {riga['massimo_ms']:.0f}ms\n  {riga['sql'][:120]}\n")
+    await update.message.reply_text(messaggio)
+
+async def job_fine_profilazione(context: ContextTypes.DEFAULT_TYPE):
+    """Chiude la finestra a tempo anche se non arrivano altri update"""
+    profilatore.job_scadenza = None
+    await profilatore.concludi_e_invia(context.bot)
+
+@handler_misurato
+async def comando_profila(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profila [minuti] | /profila <N>u (N update) | /profila stop"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono avviare la profilazione.")
+        return
+    argomento = context.args[0].lower() if context.args else '5'
+    
+    if argomento == 'stop':
+        if not profilatore.attivo:
+            await update.message.reply_text("ℹ️ Nessuna profilazione in corso.")
+            return
+        await profilatore.concludi_e_invia(context.bot)
+        return
+    
+    if profilatore.attivo:
+        await update.message.reply_text("⚠️ Profilazione già in corso. Usa /profila stop per chiuderla.")
+        return
+    
+    try:
+        if argomento.endswith('u'):
+            numero = min(int(argomento[:-1]), PROFILO_MAX_UPDATE)
+            minuti, quanti = PROFILO_MAX_MINUTI, numero
+            descrizione = f"i prossimi {numero} update (max {PROFILO_MAX_MINUTI} minuti)"
+        else:
+            minuti, quanti = min(int(argomento), PROFILO_MAX_MINUTI), None
+            descrizione = f"i prossimi {minuti} minuti"
+        if minuti <= 0 or (quanti is not None and quanti <= 0):
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❌ Uso: /profila [minuti] oppure /profila 20u oppure /profila stop")
+        return
+    
+    profilatore.avvia(update.effective_chat.id, minuti=minuti, update=quanti)
+    profilatore.job_scadenza = context.job_queue.run_once(job_fine_profilazione, when=minuti * 60, name='fine_profilazione')
+    await update.message.reply_text(f"🔬 Profilazione attiva per {descrizione}. Il report arriverà in questa chat.")
+
 # === HELP ===
+@handler_misurato
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     is_admin_user = is_admin(user_id)
@@ -4143,7 +6420,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         messaggio += "⚙️ **COMANDI AMMINISTRATORE:**\n"
         messaggio += "• 👥 Gestisci Richieste - Gestisci richieste accesso\n"
         messaggio += "• ⚙️ Gestione - Menu amministrativo\n"
-        messaggio += "• 📥 Importa CSV - Carica dati da file CSV\n\n"
+        messaggio += "• 📥 Importa CSV - Carica dati da file CSV\n"
+        messaggio += "• /sistema - Metriche di sistema del bot\n"
+        messaggio += "• /lag - Blocchi più lunghi dell'event loop\n"
+        messaggio += "• /latenze [giorno] - Handler più lenti (ultima ora o giorno)\n"
+        messaggio += "• /sql - Query più costose sul database\n"
+        messaggio += "• /profila [minuti|Nu|stop] - Profilazione cProfile degli update\n\n"
     
     messaggio += "💡 **SUGGERIMENTI:**\n"
     messaggio += "• Usa la tastiera fisica per navigare velocemente\n"
@@ -4152,7 +6434,240 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(messaggio)
 
+# === FASI DI INSERIMENTO TESTO ===
+# Vecchie chiavi di user_data (una per flusso) ancora presenti nelle conversazioni salvate
+FASI_PRECEDENTI = {
+    'fase_modifica': {
+        'anno': 'modifica_anno', 'rapporto': 'modifica_rapporto', 'progressivo': 'modifica_progressivo',
+        'modifica_tipologia': 'modifica_tipologia', 'modifica_indirizzo': 'modifica_indirizzo',
+        'modifica_orari': 'modifica_orari', 'inserisci_valore': 'modifica_valore',
+        'inserisci_tipologia_modifica': 'modifica_tipologia_personalizzata',
+    },
+    'fase_elimina': {'anno': 'elimina_anno', 'rapporto': 'elimina_rapporto', 'progressivo': 'elimina_progressivo'},
+    'fase_cerca': {'anno': 'cerca_anno', 'rapporto': 'cerca_rapporto'},
+}
+
+MESSAGGIO_FASE_SCADUTA = "⌛ L'operazione in corso è scaduta per inattività. Riparti dal menu."
+MESSAGGIO_FASE_NON_VALIDA = "⚠️ Questo passaggio non è più disponibile: continua dall'ultimo messaggio o riparti dal menu."
+
+class MacchinaFasi:
+    """Fasi dei flussi a più passaggi (nuovo intervento, modifica, eliminazione, ricerca).
+
+    Ogni utente ha al più una fase, in user_data['fase'] come (nome, istante
+    dell'ultima attività): due flussi non possono essere attivi insieme.
+    Ogni fase dichiara il suo handler dei messaggi di testo (None se attende
+    un bottone) e le fasi successive ammesse; il flusso dichiara la fase
+    iniziale, le chiavi di user_data da eliminare alla fine e la scadenza.
+    """
+    
+    def __init__(self):
+        self.flussi = {}
+        self.fasi = {}
+    
+    def flusso(self, nome, iniziale, dati=(), scadenza_minuti=FASE_SCADENZA_MINUTI):
+        self.flussi[nome] = {'iniziale': iniziale, 'dati': tuple(dati), 'scadenza': scadenza_minuti * 60}
+    
+    def fase(self, nome, flusso, gestore=None, successive=()):
+        if nome in self.fasi:
+            raise ValueError(f"Fase già dichiarata: {nome}")
+        self.fasi[nome] = {'flusso': flusso, 'gestore': gestore, 'successive': frozenset(successive)}
+    
+    def _leggi(self, dati):
+        """(nome, istante) della fase dell'utente, convertendo il formato precedente"""
+        fase = dati.get('fase')
+        if isinstance(fase, tuple) and fase[0] in self.fasi:
+            return fase
+        nome = fase if isinstance(fase, str) else None
+        for chiave, nomi in FASI_PRECEDENTI.items():
+            valore = dati.pop(chiave, None)
+            if nome is None and valore is not None:
+                nome = nomi.get(valore)
+        if nome not in self.fasi:
+            dati.pop('fase', None)
+            return None
+        dati['fase'] = (nome, time.time())
+        return dati['fase']
+    
+    def _scaduta(self, fase):
+        nome, istante = fase
+        return time.time() - istante > self.flussi[self.fasi[nome]['flusso']]['scadenza']
+    
+    def _chiudi(self, dati, flusso):
+        dati.pop('fase', None)
+        for chiave in self.flussi[flusso]['dati']:
+            dati.pop(chiave, None)
+    
+    def corrente(self, context):
+        """Nome della fase attiva dell'utente, None se assente o scaduta"""
+        fase = self._leggi(context.user_data)
+        if fase is None:
+            return None
+        if self._scaduta(fase):
+            self.scadi(context.user_data, fase)
+            return None
+        return fase[0]
+    
+    def scadi(self, dati, fase):
+        flusso = self.fasi[fase[0]]['flusso']
+        self._chiudi(dati, flusso)
+        metriche.incrementa('bot_fasi_scadute_totale', flusso=flusso)
+    
+    def imposta(self, context, nome):
+        """Passa alla fase `nome`; False se la transizione non è dichiarata (fase invariata)"""
+        dati = context.user_data
+        flusso = self.fasi[nome]['flusso']
+        attuale = self._leggi(dati)
+        nome_attuale = attuale[0] if attuale else None
+        ammessa = (
+            nome == self.flussi[flusso]['iniziale']
+            or nome == nome_attuale
+            or (nome_attuale is not None and nome in self.fasi[nome_attuale]['successive'])
+        )
+        if not ammessa:
+            metriche.incrementa('bot_fasi_transizioni_rifiutate_totale', flusso=flusso)
+            print(f"⚠️ Transizione di fase non ammessa: {nome_attuale} → {nome}")
+            return False
+        if nome_attuale is not None and self.fasi[nome_attuale]['flusso'] != flusso:
+            # Un nuovo flusso sostituisce quello lasciato a metà
+            self._chiudi(dati, self.fasi[nome_attuale]['flusso'])
+        dati['fase'] = (nome, time.time())
+        return True
+    
+    async def passa(self, update, context, nome):
+        """imposta() dagli handler: se la transizione è rifiutata avvisa l'utente; False = non proseguire"""
+        if self.imposta(context, nome):
+            return True
+        await update.effective_message.reply_text(MESSAGGIO_FASE_NON_VALIDA)
+        return False
+    
+    async def verifica_bottone(self, update, context, flussi):
+        """Bottone di uno dei flussi: valido solo se il flusso è ancora attivo (rinnova l'attività)"""
+        dati = context.user_data
+        fase = self._leggi(dati)
+        messaggio = MESSAGGIO_FASE_NON_VALIDA
+        if fase is not None and self._scaduta(fase):
+            self.scadi(dati, fase)
+            fase, messaggio = None, MESSAGGIO_FASE_SCADUTA
+        if fase is None or self.fasi[fase[0]]['flusso'] not in flussi:
+            # Il testo sostituisce anche la tastiera ormai inutilizzabile
+            try:
+                await update.callback_query.edit_message_text(messaggio)
+            except BadRequest:
+                await update.effective_message.reply_text(messaggio)
+            return False
+        dati['fase'] = (fase[0], time.time())
+        return True
+    
+    def termina(self, context, flusso):
+        """Fine del flusso: elimina i suoi dati e la fase, se appartiene al flusso"""
+        dati = context.user_data
+        fase = self._leggi(dati)
+        if fase is not None and self.fasi[fase[0]]['flusso'] == flusso:
+            dati.pop('fase', None)
+        for chiave in self.flussi[flusso]['dati']:
+            dati.pop(chiave, None)
+    
+    async def gestisci_testo(self, update, context):
+        """Passa il messaggio all'handler della fase attiva; False se non c'è una fase"""
+        dati = context.user_data
+        fase = self._leggi(dati)
+        if fase is None:
+            return False
+        if self._scaduta(fase):
+            self.scadi(dati, fase)
+            await update.message.reply_text(MESSAGGIO_FASE_SCADUTA)
+            return False
+        nome = fase[0]
+        dati['fase'] = (nome, time.time())
+        gestore = self.fasi[nome]['gestore']
+        if gestore:
+            await gestore(update, context)
+        return True
+    
+    def pulisci(self, tutti_user_data):
+        """Elimina le fasi scadute di tutti gli utenti; restituisce gli id modificati"""
+        modificati = []
+        for user_id, dati in tutti_user_data.items():
+            fase = self._leggi(dati)
+            if fase is not None and self._scaduta(fase):
+                self.scadi(dati, fase)
+                modificati.append(user_id)
+        return modificati
+
+# Istanza globale della macchina a stati
+macchina_fasi = MacchinaFasi()
+
+async def pulisci_fasi_scadute(context: ContextTypes.DEFAULT_TYPE):
+    """Job periodico: libera i flussi abbandonati anche se l'utente non scrive più"""
+    scadute = macchina_fasi.pulisci(context.application.user_data)
+    if scadute:
+        context.application.mark_data_for_update_persistence(user_ids=scadute)
+        print(f"⌛ Fasi scadute eliminate per {len(scadute)} utenti")
+
+@handler_misurato
+async def gestisci_tipologia_personalizzata_modifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tipologia = update.message.text.strip()
+    rapporto = context.user_data['modifica_intervento']['rapporto']
+    progressivo = context.user_data['modifica_intervento']['progressivo']
+    
+    aggiorna_intervento(rapporto, progressivo, 'tipologia', tipologia)
+    
+    await update.message.reply_text(
+        f"✅ **TIPOLOGIA AGGIORNATA!**\n\n"
+        f"Rapporto: R{rapporto}/{progressivo}\n"
+        f"Nuova tipologia: {tipologia}"
+    )
+    
+    macchina_fasi.termina(context, 'modifica')
+
+# Nuovo intervento
+macchina_fasi.flusso('nuovo', 'scelta_tipo',
+                     dati=('nuovo_intervento', 'vigili_da_selezionare', 'vigili_selezionati', 'vigili_disponibili'))
+macchina_fasi.fase('scelta_tipo', 'nuovo', successive=('inserisci_rapporto', 'data_uscita'))
+macchina_fasi.fase('inserisci_rapporto', 'nuovo', gestisci_rapporto_como, ('data_uscita',))
+macchina_fasi.fase('data_uscita', 'nuovo', successive=('ora_uscita',))
+macchina_fasi.fase('ora_uscita', 'nuovo', gestisci_ora_uscita, ('data_rientro',))
+macchina_fasi.fase('data_rientro', 'nuovo', successive=('ora_rientro',))
+macchina_fasi.fase('ora_rientro', 'nuovo', gestisci_ora_rientro, ('selezione_mezzo',))
+macchina_fasi.fase('selezione_mezzo', 'nuovo', successive=('cambio_personale', 'selezione_capopartenza'))
+macchina_fasi.fase('cambio_personale', 'nuovo', successive=('selezione_capopartenza',))
+macchina_fasi.fase('selezione_capopartenza', 'nuovo', successive=('selezione_autista',))
+macchina_fasi.fase('selezione_autista', 'nuovo', successive=('selezione_vigili_multipla',))
+macchina_fasi.fase('selezione_vigili_multipla', 'nuovo', successive=('selezione_vigili', 'inserisci_comune'))
+macchina_fasi.fase('selezione_vigili', 'nuovo', successive=('inserisci_comune',))
+macchina_fasi.fase('inserisci_comune', 'nuovo', gestisci_comune, ('inserisci_via',))
+macchina_fasi.fase('inserisci_via', 'nuovo', gestisci_via, ('tipologia_intervento',))
+macchina_fasi.fase('tipologia_intervento', 'nuovo', successive=('inserisci_tipologia_personalizzata', 'km_finali'))
+macchina_fasi.fase('inserisci_tipologia_personalizzata', 'nuovo', gestisci_tipologia_personalizzata, ('km_finali',))
+macchina_fasi.fase('km_finali', 'nuovo', gestisci_km_finali, ('litri_riforniti',))
+macchina_fasi.fase('litri_riforniti', 'nuovo', gestisci_litri_riforniti, ('conferma',))
+macchina_fasi.fase('conferma', 'nuovo')
+
+# Modifica intervento
+macchina_fasi.flusso('modifica', 'modifica_anno', dati=('modifica_intervento', 'sottofase_indirizzo', 'tipo_orario'))
+macchina_fasi.fase('modifica_anno', 'modifica', gestisci_anno_modifica, ('modifica_rapporto',))
+macchina_fasi.fase('modifica_rapporto', 'modifica', gestisci_rapporto_modifica, ('modifica_progressivo',))
+macchina_fasi.fase('modifica_progressivo', 'modifica', gestisci_progressivo_modifica,
+                   ('modifica_tipologia', 'modifica_indirizzo', 'modifica_orari', 'modifica_valore'))
+macchina_fasi.fase('modifica_tipologia', 'modifica', successive=('modifica_tipologia_personalizzata',))
+macchina_fasi.fase('modifica_tipologia_personalizzata', 'modifica', gestisci_tipologia_personalizzata_modifica)
+macchina_fasi.fase('modifica_indirizzo', 'modifica', gestisci_modifica_indirizzo)
+macchina_fasi.fase('modifica_orari', 'modifica', gestisci_modifica_orari)
+macchina_fasi.fase('modifica_valore', 'modifica', gestisci_valore_modifica)
+
+# Eliminazione intervento
+macchina_fasi.flusso('elimina', 'elimina_anno', dati=('elimina_intervento',))
+macchina_fasi.fase('elimina_anno', 'elimina', gestisci_anno_elimina, ('elimina_rapporto',))
+macchina_fasi.fase('elimina_rapporto', 'elimina', gestisci_rapporto_elimina, ('elimina_progressivo',))
+macchina_fasi.fase('elimina_progressivo', 'elimina', gestisci_progressivo_elimina)
+
+# Ricerca rapporto
+macchina_fasi.flusso('cerca', 'cerca_anno', dati=('cerca_rapporto',))
+macchina_fasi.fase('cerca_anno', 'cerca', gestisci_anno_cerca, ('cerca_rapporto',))
+macchina_fasi.fase('cerca_rapporto', 'cerca', gestisci_rapporto_cerca)
+
 # === GESTIONE MESSAGGI DI TESTO ===
+@handler_misurato
 async def gestisci_messaggio_testo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     testo = update.message.text
@@ -4162,288 +6677,307 @@ async def gestisci_messaggio_testo(update: Update, context: ContextTypes.DEFAULT
             await start(update, context)
         return
     
-    # Controlla se siamo in un flusso attivo
-    if 'fase' in context.user_data:
-        fase = context.user_data['fase']
-        
-        if fase == 'inserisci_rapporto':
-            await gestisci_rapporto_como(update, context)
-        elif fase == 'ora_uscita':
-            await gestisci_ora_uscita(update, context)
-        elif fase == 'ora_rientro':
-            await gestisci_ora_rientro(update, context)
-        elif fase == 'inserisci_comune':
-            await gestisci_comune(update, context)
-        elif fase == 'inserisci_via':
-            await gestisci_via(update, context)
-        elif fase == 'inserisci_tipologia_personalizzata':
-            await gestisci_tipologia_personalizzata(update, context)
-        elif fase == 'km_finali':
-            await gestisci_km_finali(update, context)
-        elif fase == 'litri_riforniti':
-            await gestisci_litri_riforniti(update, context)
-    
-    elif 'fase_modifica' in context.user_data:
-        fase_modifica = context.user_data['fase_modifica']
-        
-        if fase_modifica == 'anno':
-            await gestisci_anno_modifica(update, context)
-        elif fase_modifica == 'rapporto':
-            await gestisci_rapporto_modifica(update, context)
-        elif fase_modifica == 'progressivo':
-            await gestisci_progressivo_modifica(update, context)
-        elif fase_modifica == 'inserisci_tipologia_modifica':
-            # Gestione tipologia personalizzata in modifica
-            tipologia = update.message.text.strip()
-            rapporto = context.user_data['modifica_intervento']['rapporto']
-            progressivo = context.user_data['modifica_intervento']['progressivo']
-            
-            aggiorna_intervento(rapporto, progressivo, 'tipologia', tipologia)
-            
-            await update.message.reply_text(
-                f"✅ **TIPOLOGIA AGGIORNATA!**\n\n"
-                f"Rapporto: R{rapporto}/{progressivo}\n"
-                f"Nuova tipologia: {tipologia}"
-            )
-            
-            for key in ['modifica_intervento', 'fase_modifica']:
-                if key in context.user_data:
-                    del context.user_data[key]
-        
-        elif fase_modifica == 'modifica_indirizzo':
-            await gestisci_modifica_indirizzo(update, context)
-        elif fase_modifica == 'modifica_orari':
-            await gestisci_modifica_orari(update, context)
-        elif fase_modifica == 'inserisci_valore':
-            await gestisci_valore_modifica(update, context)
-    elif 'fase_elimina' in context.user_data:
-        fase_elimina = context.user_data['fase_elimina']
-    
-        if fase_elimina == 'anno':
-          await gestisci_anno_elimina(update, context)
-        elif fase_elimina == 'rapporto':
-          await gestisci_rapporto_elimina(update, context)
-        elif fase_elimina == 'progressivo':
-          await gestisci_progressivo_elimina(update, context)
-    elif 'fase_cerca' in context.user_data:
-        fase_cerca = context.user_data['fase_cerca']
-        
-        if fase_cerca == 'anno':
-            await gestisci_anno_cerca(update, context)
-        elif fase_cerca == 'rapporto':
-            await gestisci_rapporto_cerca(update, context)
+    # Flusso attivo: il testo va all'handler della fase
+    if await macchina_fasi.gestisci_testo(update, context):
+        return
     
-    else:
-        # Gestione comandi dalla tastiera fisica
-        if testo == "➕ Nuovo Intervento":
-            await avvia_nuovo_intervento(update, context)
-        elif testo == "📋 Ultimi Interventi":
-            await ultimi_interventi(update, context)
-        elif testo == "📊 Statistiche":
-            await mostra_statistiche(update, context)
-        elif testo == "🔍 Cerca Rapporto":
-            await cerca_rapporto(update, context)
-        elif testo == "📤 Estrazione Dati":
-            await estrazione_dati(update, context)
-        elif testo == "👥 Gestisci Richieste" and is_admin(user_id):
-            await gestisci_richieste(update, context)
-        elif testo == "⚙️ Gestione" and is_admin(user_id):
-            await gestione_admin(update, context)
-        elif testo == "/start 🔄":
-            await start(update, context)
-        elif testo == "🆘 Help":
-            await help_command(update, context)
+    # Gestione comandi dalla tastiera fisica
+    if testo == "➕ Nuovo Intervento":
+        await avvia_nuovo_intervento(update, context)
+    elif testo == "📋 Ultimi Interventi":
+        await ultimi_interventi(update, context)
+    elif testo == "📊 Statistiche":
+        await mostra_statistiche(update, context)
+    elif testo == "🔍 Cerca Rapporto":
+        await cerca_rapporto(update, context)
+    elif testo == "📤 Estrazione Dati":
+        await estrazione_dati(update, context)
+    elif testo == "👥 Gestisci Richieste" and is_admin(user_id):
+        await gestisci_richieste(update, context)
+    elif testo == "⚙️ Gestione" and is_admin(user_id):
+        await gestione_admin(update, context)
+    elif testo == "/start 🔄":
+        await start(update, context)
+    elif testo == "🆘 Help":
+        await help_command(update, context)
 
 # === GESTIONE CALLBACK QUERY ===
+class RouterCallback:
+    """Instradamento delle callback_data verso gli handler registrati.
+
+    Le callback fisse stanno in un dizionario, quelle con parametro
+    (capo_<id>, export_anno_<anno>, ...) in un trie di prefissi: il costo
+    dipende dalla lunghezza della callback_data, non dal numero di rotte.
+    Le rotte dei bottoni di un flusso a più passaggi dichiarano i flussi
+    in cui valgono: fuori da questi il bottone è scaduto.
+    """
+    
+    def __init__(self):
+        self.esatte = {}
+        self.trie = {}
+    
+    def esatta(self, gestore, *valori, flussi=()):
+        """gestore(update, context, callback_data) per ciascuno dei valori"""
+        for valore in valori:
+            if valore in self.esatte:
+                raise ValueError(f"Callback già registrata: {valore}")
+            self.esatte[valore] = (gestore, frozenset(flussi))
+    
+    def prefisso(self, prefisso, gestore, tipo=str, flussi=()):
+        """gestore(update, context, argomento): l'argomento è il resto convertito con tipo"""
+        nodo = self.trie
+        for carattere in prefisso:
+            nodo = nodo.setdefault(carattere, {})
+        if None in nodo:
+            raise ValueError(f"Prefisso già registrato: {prefisso}")
+        nodo[None] = (len(prefisso), gestore, tipo, frozenset(flussi))
+    
+    def risolvi(self, callback_data):
+        """(gestore, argomento, flussi) per la callback_data; None se nessuna rotta la accetta.
+
+        Vince la callback esatta, poi il prefisso più lungo. ValueError se il
+        parametro non è convertibile.
+        """
+        esatta = self.esatte.get(callback_data)
+        if esatta is not None:
+            gestore, flussi = esatta
+            return gestore, callback_data, flussi
+        nodo, rotta = self.trie, None
+        for carattere in callback_data:
+            nodo = nodo.get(carattere)
+            if nodo is None:
+                break
+            rotta = nodo.get(None, rotta)
+        if rotta is None:
+            return None
+        lunghezza, gestore, tipo, flussi = rotta
+        return gestore, tipo(callback_data[lunghezza:]), flussi
+
+def rapporto_e_progressivo(testo):
+    """'123_01' -> ('123', '01')"""
+    parti = testo.split('_')
+    if len(parti) != 2:
+        raise ValueError(f"Atteso rapporto_progressivo, ricevuto {testo!r}")
+    return tuple(parti)
+
+async def scegli_tipologia(update, context, callback_data):
+    # La stessa tastiera serve sia al nuovo intervento sia alla modifica
+    if macchina_fasi.corrente(context) == 'modifica_tipologia':
+        await gestisci_tipologia_modifica(update, context, callback_data)
+    else:
+        await gestisci_tipologia_intervento(update, context, callback_data)
+
+async def sfoglia_tipologie(update, context, pagina):
+    await mostra_selezione_tipologia_paginata(update.callback_query, context, pagina)
+
+async def approva_richiesta(update, context, user_id_approvare):
+    approva_utente(user_id_approvare)
+    await update.callback_query.edit_message_text(f"✅ Utente {user_id_approvare} approvato!")
+
+async def rifiuta_richiesta(update, context, user_id_rifiutare):
+    rimuovi_utente(user_id_rifiutare)
+    await update.callback_query.edit_message_text(f"❌ Richiesta di {user_id_rifiutare} rifiutata!")
+
+async def annulla_rimozione(update, context, _):
+    await update.callback_query.edit_message_text("❌ Rimozione annullata.")
+
+async def modifica_con_vigile(update, context, campo, vigile_id):
+    vigile = get_vigile_by_id(vigile_id)
+    if vigile:
+        nome_completo = f"{vigile[1]} {vigile[2]}"
+        await gestisci_valore_modifica_bottoni(update, context, campo, nome_completo)
+
+def senza_dati(gestore):
+    """Adatta un handler (update, context) a una rotta esatta"""
+    return lambda update, context, _: gestore(update, context)
+
+router_callback = RouterCallback()
+
+# Nuovo intervento (la tastiera tipologie serve anche alla modifica)
+router_callback.prefisso("tipopage_", sfoglia_tipologie, int, flussi=('nuovo', 'modifica'))
+router_callback.esatta(scegli_tipologia, "tipologia_altro", *TIPOLOGIE_MAPPING, flussi=('nuovo', 'modifica'))
+router_callback.esatta(gestisci_scelta_tipo, "tipo_nuovo", "tipo_collegato", flussi=('nuovo',))
+router_callback.prefisso("collega_", gestisci_collega_intervento, int, flussi=('nuovo',))
+router_callback.esatta(gestisci_data_uscita, "data_oggi", "data_ieri", flussi=('nuovo',))
+router_callback.esatta(gestisci_data_rientro, "rientro_oggi", "rientro_ieri", flussi=('nuovo',))
+router_callback.prefisso("mezzo_", gestisci_selezione_mezzo, flussi=('nuovo',))
+router_callback.esatta(gestisci_cambio_personale, "cambio_si", "cambio_no", flussi=('nuovo',))
+router_callback.prefisso("capo_", gestisci_selezione_capopartenza, int, flussi=('nuovo',))
+router_callback.prefisso("autista_", gestisci_selezione_autista, int, flussi=('nuovo',))
+router_callback.prefisso("toggle_vigile_", commuta_vigile, int, flussi=('nuovo',))
+router_callback.esatta(gestisci_selezione_vigile_multipla,
+                       "seleziona_tutti", "deseleziona_tutti", "conferma_partecipanti", "annulla_selezione",
+                       flussi=('nuovo',))
+router_callback.esatta(conferma_intervento, "conferma_si", "conferma_no", flussi=('nuovo',))
+
+# Richieste di accesso
+router_callback.esatta(senza_dati(mostra_richieste_attesa), "richieste_attesa")
+router_callback.esatta(senza_dati(mostra_utenti_approvati), "utenti_approvati")
+router_callback.prefisso("approva_", approva_richiesta, int)
+router_callback.prefisso("rifiuta_", rifiuta_richiesta, int)
+router_callback.prefisso("rimuovi_", conferma_rimozione_utente, int)
+router_callback.prefisso("conferma_rimozione_", esegui_rimozione_utente, int)
+router_callback.esatta(annulla_rimozione, "annulla_rimozione")
+
+# Amministrazione
+router_callback.esatta(senza_dati(gestione_vigili_admin), "admin_vigili")
+router_callback.esatta(senza_dati(gestione_mezzi_admin), "admin_mezzi")
+router_callback.esatta(senza_dati(avvia_modifica_intervento), "modifica_intervento")
+router_callback.esatta(senza_dati(avvia_elimina_intervento), "elimina_intervento")
+router_callback.esatta(senza_dati(invia_csv_admin_manual), "invia_csv_admin")
+router_callback.esatta(senza_dati(mostra_lista_vigili), "lista_vigili")
+router_callback.esatta(senza_dati(mostra_lista_mezzi), "lista_mezzi")
+router_callback.esatta(senza_dati(importa_vigili_csv), "importa_vigili")
+router_callback.esatta(senza_dati(importa_mezzi_info), "importa_mezzi_info")
+
+# Modifica ed eliminazione intervento
+router_callback.prefisso("campo_", gestisci_selezione_campo, flussi=('modifica',))
+router_callback.prefisso("modmezzo_", lambda update, context, targa:
+                         gestisci_valore_modifica_bottoni(update, context, 'mezzo', targa), flussi=('modifica',))
+router_callback.prefisso("modcapo_", lambda update, context, vigile_id:
+                         modifica_con_vigile(update, context, 'capopartenza', vigile_id), int, flussi=('modifica',))
+router_callback.prefisso("modautista_", lambda update, context, vigile_id:
+                         modifica_con_vigile(update, context, 'autista', vigile_id), int, flussi=('modifica',))
+router_callback.prefisso("conferma_elimina_", lambda update, context, chiave:
+                         conferma_eliminazione_intervento(update, context, *chiave), rapporto_e_progressivo)
+router_callback.esatta(senza_dati(annulla_eliminazione), "annulla_elimina")
+
+# Statistiche ed esportazione dati
+router_callback.prefisso("stats_", gestisci_statistiche)
+router_callback.esatta(senza_dati(esegui_export_interventi), "export_interventi")
+router_callback.esatta(senza_dati(mostra_scelta_anno_export), "export_anno_scelta")
+router_callback.prefisso("export_anno_", esegui_export_interventi_anno)
+router_callback.esatta(senza_dati(esegui_export_vigili), "export_vigili")
+router_callback.esatta(senza_dati(esegui_export_mezzi), "export_mezzi")
+router_callback.esatta(senza_dati(esegui_export_utenti), "export_utenti")
+
+@handler_misurato
 async def gestisci_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    callback_data = query.data
+    callback_data = query.data or ''
+    metriche.incrementa('bot_callback_totale', prefisso=prefisso_callback(callback_data))
     
+    # Unica risposta alla query: i singoli handler non chiamano query.answer()
     try:
         await query.answer()
     except BadRequest as e:
         if "Query is too old" in str(e):
             return
     
-    # Gestione tipologie (pagine)
-    if callback_data.startswith("tipopage_"):
-        if 'fase_modifica' in context.user_data and context.user_data['fase_modifica'] == 'modifica_tipologia':
-            await gestisci_tipologia_modifica(update, context, callback_data)
-        else:
-            await gestisci_tipologia_intervento(update, context, callback_data)
-    
-    # Gestione nuovo intervento
-    elif callback_data in ["tipo_nuovo", "tipo_collegato"]:
-        await gestisci_scelta_tipo(update, context, callback_data)
-    elif callback_data.startswith("collega_"):
-        intervento_id = int(callback_data.replace('collega_', ''))
-        await gestisci_collega_intervento(update, context, intervento_id)
-    elif callback_data in ["data_oggi", "data_ieri"]:
-        await gestisci_data_uscita(update, context, callback_data)
-    elif callback_data in ["rientro_oggi", "rientro_ieri"]:
-        await gestisci_data_rientro(update, context, callback_data)
-    elif callback_data.startswith("mezzo_"):
-        await gestisci_selezione_mezzo(update, context, callback_data)
-    elif callback_data in ["cambio_si", "cambio_no"]:
-        await gestisci_cambio_personale(update, context, callback_data)
-    elif callback_data.startswith("capo_"):
-        await gestisci_selezione_capopartenza(update, context, callback_data)
-    elif callback_data.startswith("autista_"):
-        await gestisci_selezione_autista(update, context, callback_data)
-    # === MODIFICA: SOSTITUZIONE GESTIONE SELEZIONE VIGILI ===
-    elif (callback_data.startswith("toggle_vigile_") or 
-          callback_data in ["seleziona_tutti", "deseleziona_tutti", "conferma_partecipanti", "annulla_selezione"]):
-        await gestisci_selezione_vigile_multipla(update, context, callback_data)
-    elif callback_data == "tipologia_altro":
-        if 'fase_modifica' in context.user_data and context.user_data['fase_modifica'] == 'modifica_tipologia':
-            await gestisci_tipologia_modifica(update, context, callback_data)
-        else:
-            await gestisci_tipologia_intervento(update, context, callback_data)
-    elif callback_data in TIPOLOGIE_MAPPING:
-        if 'fase_modifica' in context.user_data and context.user_data['fase_modifica'] == 'modifica_tipologia':
-            await gestisci_tipologia_modifica(update, context, callback_data)
-        else:
-            await gestisci_tipologia_intervento(update, context, callback_data)
-    elif callback_data in ["conferma_si", "conferma_no"]:
-        await conferma_intervento(update, context, callback_data)
-    
-    # Gestione richieste accesso
-    elif callback_data == "richieste_attesa":
-        await mostra_richieste_attesa(update, context)
-    elif callback_data == "utenti_approvati":
-        await mostra_utenti_approvati(update, context)
-    elif callback_data.startswith("approva_"):
-        user_id_approvare = int(callback_data.replace('approva_', ''))
-        approva_utente(user_id_approvare)
-        await query.edit_message_text(f"✅ Utente {user_id_approvare} approvato!")
-    elif callback_data.startswith("rifiuta_"):
-        user_id_rifiutare = int(callback_data.replace('rifiuta_', ''))
-        rimuovi_utente(user_id_rifiutare)
-        await query.edit_message_text(f"❌ Richiesta di {user_id_rifiutare} rifiutata!")
-    elif callback_data.startswith("rimuovi_"):
-        user_id_rimuovere = int(callback_data.replace('rimuovi_', ''))
-        await conferma_rimozione_utente(update, context, user_id_rimuovere)
-    elif callback_data.startswith("conferma_rimozione_"):
-        user_id_rimuovere = int(callback_data.replace('conferma_rimozione_', ''))
-        await esegui_rimozione_utente(update, context, user_id_rimuovere)
-    elif callback_data == "annulla_rimozione":
-        await query.edit_message_text("❌ Rimozione annullata.")
-    
-    # Gestione amministrativa
-    elif callback_data == "admin_vigili":
-        await gestione_vigili_admin(update, context)
-    elif callback_data == "admin_mezzi":
-        await gestione_mezzi_admin(update, context)
-    elif callback_data == "modifica_intervento":
-        await avvia_modifica_intervento(update, context)
-    elif callback_data == "elimina_intervento":  # NUOVO
-        await avvia_elimina_intervento(update, context)
-    elif callback_data == "invia_csv_admin":
-        await invia_csv_admin_manual(update, context)
-    elif callback_data == "lista_vigili":
-        await mostra_lista_vigili(update, context)
-    elif callback_data == "lista_mezzi":
-        await mostra_lista_mezzi(update, context)
-    elif callback_data == "importa_vigili":
-        await importa_vigili_csv(update, context)
-    elif callback_data == "importa_mezzi_info":
-        await importa_mezzi_info(update, context)
-    
-    # Gestione modifica intervento
-    elif callback_data.startswith("campo_"):
-        campo = callback_data.replace('campo_', '')
-        await gestisci_selezione_campo(update, context, campo)
-    elif callback_data.startswith("modmezzo_"):
-        targa = callback_data.replace('modmezzo_', '')
-        await gestisci_valore_modifica_bottoni(update, context, 'mezzo', targa)
-    elif callback_data.startswith("modcapo_"):
-        vigile_id = callback_data.replace('modcapo_', '')
-        vigile = get_vigile_by_id(int(vigile_id))
-        if vigile:
-            nome_completo = f"{vigile[1]} {vigile[2]}"
-            await gestisci_valore_modifica_bottoni(update, context, 'capopartenza', nome_completo)
-    elif callback_data.startswith("modautista_"):
-        vigile_id = callback_data.replace('modautista_', '')
-        vigile = get_vigile_by_id(int(vigile_id))
-        if vigile:
-            nome_completo = f"{vigile[1]} {vigile[2]}"
-            await gestisci_valore_modifica_bottoni(update, context, 'autista', nome_completo)
-    
-    # Gestione statistiche
-    elif callback_data.startswith("stats_"):
-        await gestisci_statistiche(update, context, callback_data)
-    # Gestione eliminazione intervento
-    elif callback_data.startswith("conferma_elimina_"):
-    # Estrai rapporto e progressivo dal callback data
-        parts = callback_data.replace('conferma_elimina_', '').split('_')
-        if len(parts) == 2:
-            rapporto = parts[0]
-            progressivo = parts[1]
-            await conferma_eliminazione_intervento(update, context, rapporto, progressivo)
-    elif callback_data == "annulla_elimina":
-        await annulla_eliminazione(update, context)
-    # Gestione esportazione dati
-    elif callback_data == "export_interventi":
-        await esegui_export_interventi(update, context)
-    elif callback_data == "export_anno_scelta":
-        await mostra_scelta_anno_export(update, context)
-    elif callback_data.startswith("export_anno_"):
-        anno = callback_data.replace('export_anno_', '')
-        await esegui_export_interventi_anno(update, context, anno)
-    elif callback_data == "export_vigili":
-        await esegui_export_vigili(update, context)
-    elif callback_data == "export_mezzi":
-        await esegui_export_mezzi(update, context)
-    elif callback_data == "export_utenti":
-        await esegui_export_utenti(update, context)
+    try:
+        rotta = router_callback.risolvi(callback_data)
+    except ValueError as e:
+        print(f"⚠️ Callback non valida '{callback_data}': {e}")
+        return
+    if rotta is None:
+        print(f"⚠️ Callback senza gestore: '{callback_data}'")
+        return
+    gestore, argomento, flussi = rotta
+    # Bottone di un flusso scaduto o già concluso: i dati del flusso non ci sono più
+    if flussi and not await macchina_fasi.verifica_bottone(update, context, flussi):
+        return
+    await gestore(update, context, argomento)
+
+# === GESTIONE ERRORI TELEGRAM ===
+async def gestisci_errore_bot(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Errori sollevati da handler e job: traceback nei log, conteggio per tipo dei soli errori Telegram"""
+    errore = context.error
+    # Gli altri errori degli handler sono già contati in bot_handler_errori_totale
+    if isinstance(errore, TelegramError):
+        metriche.incrementa('bot_errori_telegram_totale', tipo=type(errore).__name__)
+    print(f"❌ Errore bot ({type(errore).__name__}): {errore}")
+    traceback.print_exception(type(errore), errore, errore.__traceback__)
 
 # === MAIN STABILIZZATO E ROBUSTO ===
 def main():
     print("🚀 Avvio Bot Interventi VVF - VERSIONE ROBUSTA...")
     
-    # Fase 1: Ripristino database all'avvio
-    print("🔄 Fase 1: Ripristino database...")
-    if not enhanced_restore_on_startup():
-        print("🔄 Database non ripristinato - uso database locale")
-    
-    # Fase 2: Verifica integrità finale
-    print("🔍 Fase 2: Verifica integrità finale...")
-    if not sistema_robustezza.verifica_integrita_database():
-        print("❌ Integrità database non verificata - rigenerazione...")
-        sistema_robustezza.rigenera_database_se_necessario()
+    # Un solo event loop: bot, job e servizi di background
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     
-    # Fase 3: Avvio servizi in thread separati
-    print("🔧 Fase 3: Avvio servizi di supporto...")
-    
-    # Avvia server Flask in thread separato
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
+    # Fase 1: Server HTTP subito disponibile, con stato di prontezza "restoring"
+    # Il server Flask è bloccante per tutta la vita del processo: thread dedicato, fuori dal pool
+    print("🔧 Fase 1: Avvio server HTTP...")
+    flask_thread = threading.Thread(target=run_flask, name='flask', daemon=True)
     flask_thread.start()
     print("✅ Server Flask avviato")
     
-    # Keep-alive aggressivo
-    keep_alive_thread = threading.Thread(target=keep_alive_aggressivo, daemon=True)
-    keep_alive_thread.start()
-    print("✅ Sistema keep-alive OGNI 5 MINUTI avviato")
-    
-    # Auto-riavvio programmato ogni 12 ore
-    restart_thread = threading.Thread(target=auto_restart_sicuro, daemon=True)
-    restart_thread.start()
-    print("✅ Auto-restart programmato (12 ore) avviato")
-    
-    # Scheduler CSV
-    try:
-        csv_thread = threading.Thread(target=scheduler_csv_migliorato, daemon=True)
-        csv_thread.start()
-        print("✅ Scheduler CSV giornaliero avviato (23:55)")
-    except Exception as e:
-        print(f"❌ Errore avvio scheduler CSV: {e}")
-    
-    # Fase 4: Avvio bot con sistema di auto-restart
+    # Fase 2: Ripristino database in parallelo all'inizializzazione del bot
+    # Fase 3: Servizi di supporto (keep-alive, auto-restart, backup)
+    print("🔧 Registrazione servizi di background...")
+    supervisore.registra('restore', servizio_restore, riavvio='mai')
+    supervisore.registra('keep_alive', keep_alive_aggressivo, riavvio='sempre')
+    supervisore.registra('watchdog', watchdog_risorse, riavvio='sempre')
+    supervisore.registra('backup', backup_scheduler, riavvio='sempre')
+    supervisore.registra('riepilogo', aggiorna_riepilogo_servizio, riavvio='sempre')
+    supervisore.registra('campionatore', campiona_sistema, riavvio='sempre')
+    supervisore.avvia(loop)
+    
+    # Fase 4: Avvio bot con sistema di auto-restart (il polling attende il restore)
     print("🤖 Fase 4: Avvio bot Telegram con auto-restart...")
     avvia_bot_con_restart_automatico()
 
+async def attendi_restore_prima_del_polling(application):
+    """post_init: il bot è inizializzato, il polling parte solo a restore completato"""
+    stato_avvio.termina_fase('init_bot')
+    with stato_avvio.fase('attesa_restore'):
+        await supervisore.attendi_evento(stato_avvio.restore_completato)
+    # Ruoli letti dal database ripristinato, prima del primo update
+    ruoli = await supervisore.in_thread(ruoli_utenti.carica)
+    print(f"👥 Cache ruoli caricata: {len(ruoli)} utenti")
+    # Catalogo e tastiere pronti prima del primo update
+    tastiere = await supervisore.in_thread(tastiere_anagrafiche.attuali)
+    print(f"⌨️ Tastiere vigili e mezzi pronte: {len(tastiere['vigili_attivi'])} vigili attivi")
+    stato_avvio.imposta_stato('ready')
+    stato_avvio.stampa_report()
+
+def crea_applicazione(token=BOT_TOKEN, base_url=None, post_init=attendi_restore_prima_del_polling, job_csv=True):
+    """Application con tutti gli handler del bot.
+
+    base_url punta a un Bot API diverso da quello di Telegram (es. il server
+    finto di tools/ per i test di carico); job_csv=False salta gli invii programmati.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .persistence(PersistenzaSQLite())
+        .concurrent_updates(BOT_UPDATE_CONCORRENTI)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if post_init:
+        builder = builder.post_init(post_init)
+    if registratore_update.attivo:
+        builder = builder.post_stop(chiudi_registrazione_update)
+    application = builder.build()
+    
+    # Aggiungi handler
+    if registratore_update.attivo:
+        application.add_handler(TypeHandler(Update, registra_update), group=-2)
+    application.add_handler(TypeHandler(Update, registra_attivita), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("sistema", comando_sistema))
+    application.add_handler(CommandHandler("lag", comando_lag))
+    application.add_handler(CommandHandler("latenze", comando_latenze))
+    application.add_handler(CommandHandler("sql", comando_sql))
+    application.add_handler(CommandHandler("profila", comando_profila))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, gestisci_messaggio_testo))
+    application.add_handler(MessageHandler(filters.Document.ALL, gestisci_file_csv))
+    application.add_handler(CallbackQueryHandler(gestisci_callback))
+    application.add_error_handler(gestisci_errore_bot)
+    
+    application.job_queue.run_repeating(pulisci_fasi_scadute, interval=FASE_PULIZIA_INTERVALLO_SECONDI,
+                                        first=FASE_PULIZIA_INTERVALLO_SECONDI, name='pulizia_fasi')
+    
+    # Invii CSV programmati sull'event loop del bot
+    if job_csv:
+        registra_job_csv(application.job_queue)
+    return application
+
 def avvia_bot_con_restart_automatico():
     """Avvia il bot con sistema di restart automatico in caso di crash"""
+    global applicazione_bot
     restart_count = 0
     max_restarts = 10
     restart_delay = 60  # secondi
@@ -4451,13 +6985,10 @@ def avvia_bot_con_restart_automatico():
     while restart_count < max_restarts:
         try:
             print(f"🔄 Tentativo di avvio bot #{restart_count + 1}")
-            application = Application.builder().token(BOT_TOKEN).build()
+            stato_avvio.inizia_fase('init_bot')
+            application = crea_applicazione()
             
-            # Aggiungi handler
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, gestisci_messaggio_testo))
-            application.add_handler(MessageHandler(filters.Document.ALL, gestisci_file_csv))
-            application.add_handler(CallbackQueryHandler(gestisci_callback))
+            applicazione_bot = application
             
             print("✅ Bot avviato correttamente! Inizio polling...")
             
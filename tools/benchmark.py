@@ -0,0 +1,223 @@
+"""Benchmark dei percorsi caldi del livello dati su un dataset sintetico.
+
+Uso:
+    python tools/genera_dataset.py --dir /tmp/bench
+    python tools/benchmark.py --dir /tmp/bench --output risultati.json
+    python tools/benchmark.py --dir /tmp/bench --baseline risultati.json
+
+Con --baseline il processo esce con codice 1 se il tempo minimo di una
+misura peggiora oltre la tolleranza relativa e di almeno --soglia-minima-ms:
+le misure di pochi centesimi di millisecondo oscillano più della tolleranza
+anche a codice invariato.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+from datetime import datetime
+from io import StringIO
+
+from comune import importa_bot
+
+
+def misura(funzione, ripetizioni, prepara=None):
+    """Esegue `funzione` più volte (dopo un giro di riscaldamento) e restituisce i tempi in millisecondi"""
+    if prepara:
+        prepara()
+    funzione()
+    tempi = []
+    risultato = None
+    for _ in range(ripetizioni):
+        if prepara:
+            prepara()
+        inizio = time.perf_counter()
+        risultato = funzione()
+        tempi.append((time.perf_counter() - inizio) * 1000)
+    return {
+        'mediana_ms': round(statistics.median(tempi), 3),
+        'min_ms': round(min(tempi), 3),
+        'max_ms': round(max(tempi), 3),
+        'ripetizioni': ripetizioni,
+    }, risultato
+
+
+def righe_csv(contenuto, limite=None):
+    """Righe di un CSV esportato, senza intestazione, come le legge /import"""
+    reader = csv.reader(StringIO(contenuto.decode('utf-8')))
+    next(reader)
+    righe = list(reader)
+    return righe[:limite] if limite else righe
+
+
+class DatabaseRipristinabile:
+    """Riporta il database allo stato iniziale tra una misura di import e l'altra"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.copia = bot.DATABASE_NAME + '.bench'
+        bot.crea_snapshot_database(self.copia)
+
+    def ripristina(self, svuota=()):
+        shutil.copyfile(self.copia, self.bot.DATABASE_NAME)
+        self.bot.invalida_cache_database()
+        if svuota:
+            conn = self.bot.connetti_db()
+            for tabella in svuota:
+                conn.execute(f"DELETE FROM {tabella}")
+            conn.commit()
+            conn.close()
+
+    def chiudi(self):
+        self.ripristina()
+        os.remove(self.copia)
+
+
+def esegui_benchmark(bot, args):
+    rng = random.Random(args.seed)
+    ripetizioni = args.ripetizioni
+    risultati = {}
+
+    def registra(nome, funzione, ripetizioni=ripetizioni, prepara=None, dettagli=None):
+        statistica, risultato = misura(funzione, ripetizioni, prepara)
+        if dettagli:
+            statistica.update(dettagli(risultato))
+        risultati[nome] = statistica
+        print(f"⏱️ {nome:<36} mediana {statistica['mediana_ms']:>10.2f} ms "
+              f"(min {statistica['min_ms']:.2f}, max {statistica['max_ms']:.2f})")
+        return risultato
+
+    # Statistiche e liste
+    anno = str(datetime.now().year)
+    registra('statistiche_anno_corrente', lambda: bot.get_statistiche_anno(anno))
+    registra('statistiche_totali', lambda: bot.get_statistiche_anno(None))
+    registra('ultimi_interventi_10', lambda: bot.get_ultimi_interventi(10))
+    interventi = registra('ultimi_interventi_10000', lambda: bot.get_ultimi_interventi(10000),
+                          dettagli=lambda r: {'righe': len(r)})
+
+    # Export CSV: gli stessi helper usati dai comandi di export e dall'invio automatico
+    vigili = bot.get_tutti_vigili()
+    mezzi = bot.get_tutti_mezzi()
+    utenti = bot.get_utenti_approvati()
+    csv_interventi = registra('export_csv_interventi', lambda: bot.genera_csv_interventi(interventi),
+                              dettagli=lambda r: {'byte': len(r)})
+    csv_vigili = registra('export_csv_vigili', lambda: bot.genera_csv_vigili(vigili))
+    csv_mezzi = registra('export_csv_mezzi', lambda: bot.genera_csv_mezzi(mezzi))
+    csv_utenti = registra('export_csv_utenti', lambda: bot.genera_csv_utenti(utenti))
+
+    # Ricerca per rapporto: campione fisso di rapporti esistenti
+    conn = bot.connetti_db()
+    campione = conn.execute('''SELECT rapporto_como, progressivo_como, strftime('%Y', data_uscita)
+                               FROM interventi''').fetchall()
+    conn.close()
+    campione = rng.sample(campione, min(args.ricerche, len(campione)))
+    registra('ricerca_rapporto_anno',
+             lambda: [bot.get_interventi_per_rapporto(r, a) for r, _, a in campione],
+             dettagli=lambda _: {'ricerche': len(campione)})
+    registra('ricerca_rapporto_progressivo',
+             lambda: [bot.get_intervento_by_rapporto(r, p) for r, p, _ in campione],
+             dettagli=lambda _: {'ricerche': len(campione)})
+
+    # Snapshot di backup e verifica di integrità
+    snapshot = bot.DATABASE_NAME + '.snapshot'
+    registra('backup_snapshot', lambda: bot.crea_snapshot_database(snapshot))
+    registra('backup_analisi', lambda: bot.analizza_database(snapshot))
+    os.remove(snapshot)
+
+    # Import CSV: ogni ripetizione riparte dal database generato con la tabella svuotata
+    database = DatabaseRipristinabile(bot)
+    try:
+        import_da_misurare = [
+            ('import_csv_interventi', bot.importa_righe_interventi, csv_interventi,
+             ('partecipanti', 'interventi'), args.righe_import),
+            ('import_csv_vigili', bot.importa_righe_vigili, csv_vigili, ('vigili',), None),
+            ('import_csv_mezzi', bot.importa_righe_mezzi, csv_mezzi, ('mezzi',), None),
+            ('import_csv_utenti', bot.importa_righe_utenti, csv_utenti, ('utenti',), None),
+        ]
+        for nome, importa, contenuto, svuota, limite in import_da_misurare:
+            righe = righe_csv(contenuto, limite)
+            registra(nome, lambda: importa(iter(righe)), ripetizioni=args.ripetizioni_import,
+                     prepara=lambda: database.ripristina(svuota),
+                     dettagli=lambda esito: {'righe': len(righe), 'errori': esito['errori']})
+    finally:
+        database.chiudi()
+
+    return risultati
+
+
+def confronta_con_baseline(risultati, baseline, tolleranza, soglia_minima_ms):
+    """Elenco delle misure peggiorate oltre la tolleranza rispetto alla baseline.
+
+    Si confronta il tempo minimo, il meno sensibile al rumore della macchina;
+    un peggioramento conta solo se supera anche soglia_minima_ms in assoluto.
+    """
+    regressioni = []
+    for nome, attuale in risultati.items():
+        riferimento = baseline.get(nome)
+        if not riferimento:
+            continue
+        prima = riferimento['min_ms']
+        dopo = attuale['min_ms']
+        variazione = (dopo - prima) / prima if prima else 0.0
+        peggiorata = variazione > tolleranza and dopo - prima > soglia_minima_ms
+        segno = "⚠️" if peggiorata else "✅"
+        print(f"{segno} {nome:<36} {prima:>10.2f} → {dopo:>10.2f} ms ({variazione:+.0%})")
+        if peggiorata:
+            regressioni.append(nome)
+    return regressioni
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del livello dati del bot")
+    parser.add_argument('--dir', default='bench_dati', help="Directory con il dataset generato")
+    parser.add_argument('--ripetizioni', type=int, default=15)
+    parser.add_argument('--ripetizioni-import', type=int, default=5)
+    parser.add_argument('--righe-import', type=int, default=5000,
+                        help="Righe di interventi reimportate per ripetizione (0 = tutte)")
+    parser.add_argument('--ricerche', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="File JSON in cui salvare i risultati")
+    parser.add_argument('--baseline', help="File JSON di riferimento con cui confrontare")
+    parser.add_argument('--tolleranza', type=float, default=0.2,
+                        help="Peggioramento relativo tollerato sul tempo minimo (0.2 = 20%%)")
+    parser.add_argument('--soglia-minima-ms', type=float, default=1.0,
+                        help="Peggioramento assoluto sotto il quale una misura non è mai una regressione")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(os.path.abspath(args.baseline)) as f:
+            baseline = json.load(f)['risultati']
+    output = os.path.abspath(args.output) if args.output else None
+
+    bot = importa_bot(args.dir)
+    if not os.path.exists(bot.DATABASE_NAME):
+        sys.exit(f"❌ Nessun dataset in {os.getcwd()}: eseguire prima tools/genera_dataset.py")
+
+    risultati = esegui_benchmark(bot, args)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'eseguito': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'sqlite': bot.sqlite3.sqlite_version,
+                'risultati': risultati,
+            }, f, indent=2)
+        print(f"💾 Risultati salvati in {output}")
+
+    if baseline is not None:
+        regressioni = confronta_con_baseline(risultati, baseline, args.tolleranza, args.soglia_minima_ms)
+        if regressioni:
+            print(f"❌ Regressioni oltre il {args.tolleranza:.0%} e {args.soglia_minima_ms} ms: {', '.join(regressioni)}")
+            sys.exit(1)
+        print("✅ Nessuna regressione rispetto alla baseline")
+
+
+if __name__ == '__main__':
+    main()
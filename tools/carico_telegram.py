@@ -0,0 +1,272 @@
+"""Test di carico end-to-end degli handler contro il Bot API finto.
+
+N vigili simulati percorrono in parallelo il flusso completo di nuovo
+intervento (più statistiche ed export) sul bot vero, puntato al server
+di tools/finto_telegram.py: nessuna rete, solo i limiti del bot.
+
+Uso:
+    python tools/genera_dataset.py --dir /tmp/carico --interventi 5000
+    python tools/carico_telegram.py --dir /tmp/carico --vigili 20 --cicli 5 --concorrenza 8
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from comune import importa_bot
+from finto_telegram import ServerTelegramFinto, TOKEN_FINTO
+
+PRIMO_USER_ID = 700000000
+TIMEOUT_PASSO = 60.0
+
+
+class PassoFallito(Exception):
+    pass
+
+
+class VigileSimulato:
+    """Un utente che usa il bot come da tastiera, attendendo ogni risposta prima del passo successivo"""
+
+    def __init__(self, server, user_id, indice, risultati, args, contatore_km):
+        self.server = server
+        self.user_id = user_id
+        self.indice = indice
+        self.risultati = risultati
+        self.args = args
+        self.contatore_km = contatore_km
+        self.rng = random.Random(args.seed + indice)
+        self.cursore = 0
+        self.ultimo = None
+
+    def _attendi(self, passo, inizio, predicato=None):
+        self.cursore, evento = self.server.attendi(self.user_id, self.cursore, predicato, TIMEOUT_PASSO)
+        if evento is None:
+            raise PassoFallito(f"nessuna risposta a '{passo}' entro {TIMEOUT_PASSO:.0f}s")
+        self.risultati.registra(passo, evento.istante - inizio)
+        self.ultimo = evento
+        if self.args.pausa:
+            time.sleep(self.rng.uniform(0, self.args.pausa))
+        return evento
+
+    def testo(self, passo, testo, predicato=None):
+        self.cursore = self.server.indice_eventi(self.user_id)
+        inizio = time.perf_counter()
+        self.server.invia_testo(self.user_id, testo)
+        return self._attendi(passo, inizio, predicato)
+
+    def bottone(self, passo, scelta, predicato=None):
+        """Preme il bottone dell'ultimo messaggio scelto da `scelta` (prefisso o funzione)"""
+        bottoni = self.ultimo.bottoni if self.ultimo else []
+        if callable(scelta):
+            candidati = [b for b in bottoni if scelta(b)]
+        else:
+            candidati = [b for b in bottoni if b.startswith(scelta)]
+        if not candidati:
+            raise PassoFallito(f"nessun bottone '{passo}' nel messaggio: {self.ultimo.testo[:60]!r}")
+        self.cursore = self.server.indice_eventi(self.user_id)
+        inizio = time.perf_counter()
+        self.server.premi_bottone(self.user_id, self.ultimo.messaggio['message_id'], self.rng.choice(candidati))
+        return self._attendi(passo, inizio, predicato)
+
+    def nuovo_intervento(self, ciclo):
+        self.testo('menu_nuovo', "➕ Nuovo Intervento")
+        self.bottone('tipo_nuovo', 'tipo_nuovo')
+        self.testo('rapporto', str(900000 + self.indice * 1000 + ciclo))
+        self.bottone('data_uscita', 'data_oggi')
+        self.testo('ora_uscita', "0005")
+        self.bottone('data_rientro', 'rientro_oggi')
+        self.testo('ora_rientro', "0010")
+        self.bottone('mezzo', 'mezzo_')
+        self.bottone('capo', 'capo_')
+        self.bottone('autista', 'autista_')
+        for _ in range(self.rng.randint(1, 6)):
+            self.bottone('toggle_vigile', 'toggle_vigile_')
+        self.bottone('conferma_partecipanti', 'conferma_partecipanti')
+        self.testo('comune', "Erba")
+        self.testo('via', f"Via Carico {self.indice}")
+        self.bottone('tipologia', lambda b: not b.startswith('tipopage_') and b != 'tipologia_altro')
+        # I km devono crescere per mezzo: un contatore condiviso, ripetendo se un altro vigile ci ha superato
+        while 'inferiori' in self.testo('km', str(next(self.contatore_km))).testo:
+            pass
+        self.testo('litri', str(self.rng.randint(0, 80)))
+        evento = self.bottone('conferma', 'conferma_si')
+        if 'REGISTRATO' not in evento.testo:
+            raise PassoFallito(f"salvataggio non riuscito: {evento.testo[:80]!r}")
+
+    def statistiche(self):
+        self.testo('menu_statistiche', "📊 Statistiche")
+        self.bottone('statistiche', 'stats_')
+
+    def export(self):
+        self.testo('menu_export', "📤 Estrazione Dati")
+        tipo = self.rng.choice(self.args.export)
+        self.bottone(f"export_{tipo}", f"export_{tipo}", predicato=lambda e: e.metodo == 'sendDocument')
+
+    def esegui(self, barriera):
+        barriera.wait()
+        for ciclo in range(self.args.cicli):
+            for nome, azione in (('flusso_intervento', lambda: self.nuovo_intervento(ciclo)),
+                                 ('flusso_statistiche', self.statistiche),
+                                 ('flusso_export', self.export)):
+                if nome == 'flusso_export' and not self.args.export:
+                    continue
+                inizio = time.perf_counter()
+                try:
+                    azione()
+                    self.risultati.registra(nome, time.perf_counter() - inizio)
+                except PassoFallito as e:
+                    self.risultati.errore(nome, str(e))
+                    self.ultimo = None
+
+
+class RisultatiCarico:
+    """Latenze per passo e flusso raccolte dai thread dei vigili simulati"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latenze = defaultdict(list)
+        self.errori = defaultdict(list)
+
+    def registra(self, nome, secondi):
+        with self._lock:
+            self.latenze[nome].append(secondi)
+
+    def errore(self, nome, dettaglio):
+        with self._lock:
+            self.errori[nome].append(dettaglio)
+
+    def riepilogo(self, durata):
+        voci = {}
+        for nome, valori in sorted(self.latenze.items()):
+            ordinati = sorted(valori)
+            voci[nome] = {
+                'conteggio': len(ordinati),
+                'p50_ms': round(statistics.median(ordinati) * 1000, 2),
+                'p95_ms': round(ordinati[min(len(ordinati) - 1, int(len(ordinati) * 0.95))] * 1000, 2),
+                'max_ms': round(ordinati[-1] * 1000, 2),
+                'al_secondo': round(len(ordinati) / durata, 2),
+            }
+        return voci
+
+
+def prepara_utenti(bot, quanti):
+    conn = bot.connetti_db()
+    conn.executemany('''INSERT OR REPLACE INTO utenti (user_id, username, nome, ruolo, data_approvazione)
+                        VALUES (?, ?, ?, 'user', CURRENT_TIMESTAMP)''',
+                     [(PRIMO_USER_ID + i, f"carico{i}", f"Vigile Carico {i}") for i in range(quanti)])
+    # Ogni esecuzione parte senza conversazioni lasciate a metà da quella precedente
+    conn.execute("DELETE FROM persistenza_bot WHERE chiave BETWEEN ? AND ?",
+                 (PRIMO_USER_ID, PRIMO_USER_ID + quanti - 1))
+    conn.commit()
+    conn.close()
+    # Scritture dirette sul database: le copie in memoria del bot vanno rilette
+    bot.invalida_cache_database()
+
+
+async def esegui_bot(application, fine):
+    """Bot in polling sul server finto finché i vigili simulati non hanno terminato"""
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=5, drop_pending_updates=True)
+        await asyncio.get_running_loop().run_in_executor(None, fine.wait)
+        await application.updater.stop()
+        await application.stop()
+        # run_polling chiamerebbe post_stop (es. chiusura della registrazione update)
+        if application.post_stop:
+            await application.post_stop(application)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico degli handler contro un Bot API finto")
+    parser.add_argument('--dir', default='bench_dati', help="Directory con il dataset generato")
+    parser.add_argument('--vigili', type=int, default=10, help="Utenti simulati in parallelo")
+    parser.add_argument('--cicli', type=int, default=3, help="Flussi completi per utente")
+    parser.add_argument('--concorrenza', type=int, help="BOT_UPDATE_CONCORRENTI per questa esecuzione")
+    parser.add_argument('--export', nargs='*', default=['vigili', 'mezzi'],
+                        choices=['interventi', 'vigili', 'mezzi'], help="Export da includere nel ciclo")
+    parser.add_argument('--pausa', type=float, default=0.0, help="Pausa massima tra un passo e l'altro (s)")
+    parser.add_argument('--ritardo-api', type=float, default=0.0, help="Latenza simulata del Bot API (s)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="File JSON in cui salvare i risultati")
+    args = parser.parse_args()
+
+    if args.concorrenza:
+        os.environ['BOT_UPDATE_CONCORRENTI'] = str(args.concorrenza)
+    output = os.path.abspath(args.output) if args.output else None
+
+    bot = importa_bot(args.dir)
+    if not os.path.exists(bot.DATABASE_NAME):
+        sys.exit(f"❌ Nessun dataset in {os.getcwd()}: eseguire prima tools/genera_dataset.py")
+    # Nessun restore da attendere: il database è quello generato localmente
+    bot.stato_avvio.restore_completato.set()
+    # Una riga di log per ogni chiamata HTTP falserebbe le misure
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    prepara_utenti(bot, args.vigili)
+
+    server = ServerTelegramFinto(ritardo_api=args.ritardo_api).avvia()
+    application = bot.crea_applicazione(TOKEN_FINTO, base_url=server.base_url, post_init=None, job_csv=False)
+
+    risultati = RisultatiCarico()
+    contatore_km = itertools.count(10_000_000)
+    barriera = threading.Barrier(args.vigili + 1)
+    vigili = [VigileSimulato(server, PRIMO_USER_ID + i, i, risultati, args, contatore_km) for i in range(args.vigili)]
+    thread = [threading.Thread(target=v.esegui, args=(barriera,), daemon=True) for v in vigili]
+    for t in thread:
+        t.start()
+
+    fine = threading.Event()
+    inizio = {}
+
+    def coordina():
+        barriera.wait()
+        inizio['t'] = time.perf_counter()
+        for t in thread:
+            t.join()
+        inizio['durata'] = time.perf_counter() - inizio['t']
+        fine.set()
+
+    threading.Thread(target=coordina, daemon=True).start()
+    print(f"🚒 {args.vigili} vigili simulati × {args.cicli} cicli, "
+          f"update concorrenti: {bot.BOT_UPDATE_CONCORRENTI}, Bot API: {server.base_url}")
+    asyncio.run(esegui_bot(application, fine))
+    server.ferma()
+
+    durata = inizio['durata']
+    voci = risultati.riepilogo(durata)
+    for nome, voce in voci.items():
+        print(f"⏱️ {nome:<24} n={voce['conteggio']:<5} p50 {voce['p50_ms']:>9.1f} ms  "
+              f"p95 {voce['p95_ms']:>9.1f} ms  max {voce['max_ms']:>9.1f} ms  {voce['al_secondo']:>7.2f}/s")
+    update_totali = server.update_generati
+    print(f"📈 {update_totali} update in {durata:.1f}s → {update_totali / durata:.1f} update/s")
+    for nome, dettagli in risultati.errori.items():
+        print(f"❌ {nome}: {len(dettagli)} errori (es. {dettagli[0]})")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'eseguito': datetime.now().isoformat(timespec='seconds'),
+                'vigili': args.vigili,
+                'cicli': args.cicli,
+                'update_concorrenti': bot.BOT_UPDATE_CONCORRENTI,
+                'ritardo_api_s': args.ritardo_api,
+                'durata_s': round(durata, 3),
+                'update_al_secondo': round(update_totali / durata, 2),
+                'latenze': voci,
+                'errori': {nome: len(d) for nome, d in risultati.errori.items()},
+                'chiamate_api': dict(server.chiamate),
+            }, f, indent=2)
+        print(f"💾 Risultati salvati in {output}")
+    sys.exit(1 if risultati.errori else 0)
+
+
+if __name__ == '__main__':
+    main()
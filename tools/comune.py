@@ -0,0 +1,22 @@
+"""Utilità condivise dagli strumenti di sviluppo (dataset e benchmark)"""
+import os
+import sys
+
+RADICE_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importa_bot(directory):
+    """Importa bot.py lavorando nella directory indicata.
+
+    DATABASE_NAME è relativo, quindi il database del benchmark finisce
+    in `directory` e non tocca quello di produzione.
+    """
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    if RADICE_REPO not in sys.path:
+        sys.path.insert(0, RADICE_REPO)
+    import bot
+    # Il gestore globale del bot attende e riavvia: qui un errore deve solo fermare lo strumento
+    sys.excepthook = sys.__excepthook__
+    return bot
@@ -0,0 +1,258 @@
+"""Server locale che imita il Bot API di Telegram per i test di carico.
+
+L'Application del bot lo usa al posto di api.telegram.org tramite
+base_url: gli update vengono generati dal driver di carico e tutte le
+risposte del bot restano in memoria, senza rete.
+"""
+import itertools
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+TOKEN_FINTO = '123456:FINTO'
+BOT_FINTO = {'id': 123456, 'is_bot': True, 'first_name': 'Bot Interventi', 'username': 'bot_interventi_finto',
+             'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+# Chiamate che producono qualcosa di visibile in chat: sono quelle che il driver attende
+METODI_VISIBILI = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument'}
+
+
+class EventoChat:
+    """Una chiamata del bot verso una chat, con l'istante di arrivo"""
+
+    __slots__ = ('metodo', 'parametri', 'messaggio', 'istante')
+
+    def __init__(self, metodo, parametri, messaggio):
+        self.metodo = metodo
+        self.parametri = parametri
+        self.messaggio = messaggio
+        self.istante = time.perf_counter()
+
+    @property
+    def testo(self):
+        return self.parametri.get('text') or self.parametri.get('caption') or ''
+
+    @property
+    def bottoni(self):
+        """callback_data di tutti i bottoni inline del messaggio"""
+        tastiera = (self.parametri.get('reply_markup') or {}).get('inline_keyboard', [])
+        return [b['callback_data'] for riga in tastiera for b in riga if 'callback_data' in b]
+
+
+class ServerTelegramFinto:
+    """Bot API finto: coda di update per getUpdates e registro delle risposte per chat"""
+
+    def __init__(self, host='127.0.0.1', porta=0, ritardo_api=0.0):
+        self.ritardo_api = ritardo_api
+        self._condizione = threading.Condition()
+        self._update = []
+        self._id_update = itertools.count(1)
+        self._id_messaggio = itertools.count(1)
+        self._id_callback = itertools.count(1)
+        self.messaggi = {}
+        self.eventi = defaultdict(list)
+        self.chiamate = Counter()
+        self.update_generati = 0
+        self.httpd = ThreadingHTTPServer((host, porta), _GestoreRichieste)
+        self.httpd.daemon_threads = True
+        self.httpd.finto = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, porta = self.httpd.server_address[:2]
+        return f"http://{host}:{porta}/bot"
+
+    def avvia(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='telegram-finto', daemon=True)
+        self._thread.start()
+        return self
+
+    def ferma(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # --- lato utente: update generati dal driver ---
+
+    def _utente(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Vigile{user_id}", 'username': f"vigile{user_id}"}
+
+    def _accoda(self, contenuto):
+        with self._condizione:
+            update_id = next(self._id_update)
+            self.update_generati += 1
+            self._update.append({'update_id': update_id, **contenuto})
+            self._condizione.notify_all()
+        return update_id
+
+    def invia_testo(self, user_id, testo):
+        messaggio = {
+            'message_id': next(self._id_messaggio), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._utente(user_id), 'text': testo,
+        }
+        if testo.startswith('/'):
+            comando = testo.split()[0]
+            messaggio['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(comando)}]
+        return self._accoda({'message': messaggio})
+
+    def premi_bottone(self, user_id, message_id, callback_data):
+        with self._condizione:
+            messaggio = self.messaggi.get(message_id)
+        if messaggio is None:
+            # Bottone di un messaggio mai visto (es. update registrati): basta che esista
+            messaggio = self._messaggio_bot(user_id, message_id or next(self._id_messaggio), text='')
+        return self._accoda({'callback_query': {
+            'id': str(next(self._id_callback)), 'from': self._utente(user_id),
+            'chat_instance': str(user_id), 'data': callback_data, 'message': messaggio,
+        }})
+
+    def indice_eventi(self, chat_id):
+        with self._condizione:
+            return len(self.eventi[chat_id])
+
+    def attendi(self, chat_id, dopo, predicato=None, timeout=30.0):
+        """Primo evento visibile della chat successivo all'indice `dopo` che soddisfa il predicato"""
+        scadenza = time.monotonic() + timeout
+        with self._condizione:
+            while True:
+                eventi = self.eventi[chat_id]
+                for indice in range(dopo, len(eventi)):
+                    evento = eventi[indice]
+                    if evento.metodo in METODI_VISIBILI and (predicato is None or predicato(evento)):
+                        return indice + 1, evento
+                rimanente = scadenza - time.monotonic()
+                if rimanente <= 0:
+                    return len(eventi), None
+                self._condizione.wait(rimanente)
+
+    # --- lato bot: chiamate al Bot API ---
+
+    def _registra(self, chat_id, metodo, parametri, messaggio):
+        with self._condizione:
+            if messaggio:
+                self.messaggi[messaggio['message_id']] = messaggio
+            self.eventi[chat_id].append(EventoChat(metodo, parametri, messaggio))
+            self._condizione.notify_all()
+
+    def _messaggio_bot(self, chat_id, message_id=None, **campi):
+        return {'message_id': message_id or next(self._id_messaggio), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_FINTO, **campi}
+
+    def _get_updates(self, parametri):
+        offset = int(parametri.get('offset') or 0)
+        limite = int(parametri.get('limit') or 100)
+        attesa = float(parametri.get('timeout') or 0)
+        scadenza = time.monotonic() + attesa
+        with self._condizione:
+            self._update = [u for u in self._update if u['update_id'] >= offset]
+            while not self._update:
+                rimanente = scadenza - time.monotonic()
+                if rimanente <= 0:
+                    break
+                self._condizione.wait(rimanente)
+            return self._update[:limite]
+
+    def esegui(self, metodo, parametri):
+        """Risultato della chiamata `metodo` come la restituirebbe Telegram"""
+        with self._condizione:
+            self.chiamate[metodo] += 1
+        if metodo == 'getUpdates':
+            return self._get_updates(parametri)
+        if self.ritardo_api:
+            time.sleep(self.ritardo_api)
+        if metodo == 'getMe':
+            return BOT_FINTO
+        chat_id = int(parametri['chat_id']) if 'chat_id' in parametri else None
+        if metodo == 'sendMessage':
+            messaggio = self._messaggio_bot(chat_id, text=parametri.get('text', ''))
+            if parametri.get('reply_markup'):
+                messaggio['reply_markup'] = parametri['reply_markup']
+            self._registra(chat_id, metodo, parametri, messaggio)
+            return messaggio
+        if metodo in ('editMessageText', 'editMessageReplyMarkup'):
+            message_id = int(parametri['message_id'])
+            with self._condizione:
+                precedente = self.messaggi.get(message_id, {})
+            messaggio = self._messaggio_bot(chat_id, message_id,
+                                            text=parametri.get('text', precedente.get('text', '')))
+            if parametri.get('reply_markup'):
+                messaggio['reply_markup'] = parametri['reply_markup']
+            self._registra(chat_id, metodo, parametri, messaggio)
+            return messaggio
+        if metodo == 'sendDocument':
+            documento = parametri.get('document') or b''
+            numero = next(self._id_messaggio)
+            messaggio = self._messaggio_bot(chat_id, numero, document={
+                'file_id': f"doc{numero}", 'file_unique_id': f"u{numero}",
+                'file_name': parametri.get('_nome_file', 'file.csv'), 'file_size': len(documento)})
+            self._registra(chat_id, metodo, parametri, messaggio)
+            return messaggio
+        # answerCallbackQuery, deleteWebhook, setMyCommands, sendChatAction, deleteMessage, ...
+        if chat_id is not None:
+            self._registra(chat_id, metodo, parametri, None)
+        return True
+
+
+def _decodifica_valore(valore):
+    if isinstance(valore, str) and valore[:1] in ('{', '['):
+        try:
+            return json.loads(valore)
+        except ValueError:
+            return valore
+    return valore
+
+
+class _GestoreRichieste(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Intestazioni e corpo partono in due write: senza TCP_NODELAY ogni chiamata attende l'ACK ritardato
+    disable_nagle_algorithm = True
+
+    def log_message(self, formato, *args):
+        pass
+
+    def _parametri(self):
+        lunghezza = int(self.headers.get('Content-Length') or 0)
+        corpo = self.rfile.read(lunghezza) if lunghezza else b''
+        tipo = self.headers.get('Content-Type', '')
+        if tipo.startswith('multipart/form-data'):
+            # PTB usa multipart solo quando invia file (sendDocument)
+            messaggio = BytesParser().parsebytes(b"Content-Type: " + tipo.encode() + b"\r\n\r\n" + corpo)
+            parametri = {}
+            for parte in messaggio.get_payload():
+                nome = parte.get_param('name', header='content-disposition')
+                contenuto = parte.get_payload(decode=True)
+                if parte.get_filename():
+                    parametri[nome] = contenuto
+                    parametri['_nome_file'] = parte.get_filename()
+                else:
+                    parametri[nome] = _decodifica_valore(contenuto.decode('utf-8'))
+            return parametri
+        if tipo.startswith('application/json'):
+            return json.loads(corpo or b'{}')
+        return {chiave: _decodifica_valore(valore) for chiave, valore in parse_qsl(corpo.decode('utf-8'))}
+
+    def do_POST(self):
+        # Percorso: /bot<token>/<metodo>
+        metodo = self.path.rsplit('/', 1)[-1]
+        try:
+            risposta = {'ok': True, 'result': self.server.finto.esegui(metodo, self._parametri())}
+            stato = 200
+        except Exception as e:
+            risposta = {'ok': False, 'error_code': 400, 'description': f"Bad Request: {e}"}
+            stato = 400
+        corpo = json.dumps(risposta).encode('utf-8')
+        self.send_response(stato)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        try:
+            self.end_headers()
+            self.wfile.write(corpo)
+        except (BrokenPipeError, ConnectionResetError):
+            # Il bot chiude il long polling di getUpdates quando si ferma
+            self.close_connection = True
+
+    do_GET = do_POST
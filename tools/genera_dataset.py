@@ -0,0 +1,165 @@
+"""Genera un database sintetico realistico per i benchmark del livello dati.
+
+Uso:
+    python tools/genera_dataset.py --dir /tmp/bench --anni 10 --interventi 50000
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from comune import importa_bot
+
+NOMI = ["Marco", "Luca", "Andrea", "Paolo", "Simone", "Davide", "Matteo", "Stefano",
+        "Giuseppe", "Alessandro", "Francesco", "Roberto", "Giorgio", "Fabio", "Mauro",
+        "Gabriele", "Rudi", "Elena", "Sara", "Chiara"]
+COGNOMI = ["Rossi", "Bianchi", "Colombo", "Ferrari", "Brambilla", "Sala", "Galli",
+           "Fumagalli", "Riva", "Villa", "Cattaneo", "Longhi", "Redaelli", "Zappa",
+           "Mauri", "Molteni", "Pozzoli", "Corti", "Ratti", "Tagliabue"]
+COMUNI = ["Erba", "Albavilla", "Longone al Segrino", "Eupilio", "Pusiano", "Merone",
+          "Monguzzo", "Lurago d'Erba", "Proserpio", "Caslino d'Erba", "Ponte Lambro",
+          "Castelmarte", "Canzo", "Asso"]
+VIE = ["Via Roma", "Via Milano", "Via Como", "Via Garibaldi", "Via Mazzini",
+       "Via Dante", "Corso XXV Aprile", "Via Volta", "Via Manzoni", "Piazza Mercato"]
+QUALIFICHE = ["VV", "CSV", "CS", "CR"]
+
+
+def genera_vigili(rng, quanti, gradi):
+    vigili = []
+    for i in range(quanti):
+        nome = rng.choice(NOMI)
+        # Il suffisso evita omonimie: gli import deduplicano su nome+cognome
+        cognome = f"{rng.choice(COGNOMI)}{i:03d}"
+        vigili.append((nome, cognome, rng.choice(QUALIFICHE), rng.choice(gradi),
+                       int(rng.random() < 0.2), int(rng.random() < 0.3),
+                       int(rng.random() < 0.5), int(rng.random() < 0.4),
+                       int(rng.random() < 0.9)))
+    return vigili
+
+
+def genera_mezzi(rng, quanti, tipi):
+    return [(f"{10000 + i * 37:05d}", tipi[i % len(tipi)], int(rng.random() < 0.9))
+            for i in range(quanti)]
+
+
+def genera_utenti(rng, quanti):
+    utenti = []
+    adesso = datetime.now()
+    for i in range(quanti):
+        ruolo = rng.choices(['user', 'admin', 'in_attesa'], weights=[85, 5, 10])[0]
+        richiesta = adesso - timedelta(days=rng.randint(1, 2000))
+        approvazione = (richiesta + timedelta(hours=rng.randint(1, 72))) if ruolo != 'in_attesa' else None
+        utenti.append((900000000 + i, f"utente{i}", f"{rng.choice(NOMI)} {rng.choice(COGNOMI)}",
+                       f"+39 3{rng.randint(10, 99)} {rng.randint(1000000, 9999999)}", ruolo,
+                       richiesta.strftime('%Y-%m-%d %H:%M:%S'),
+                       approvazione.strftime('%Y-%m-%d %H:%M:%S') if approvazione else None))
+    return utenti
+
+
+def genera_interventi(rng, quanti, anni, tipologie, mezzi, vigili_ids, nomi_vigili):
+    """Interventi distribuiti su `anni` anni con 3-8 partecipanti ciascuno.
+
+    Più uscite dello stesso rapporto condividono il numero e differiscono
+    per progressivo, come accade con più mezzi sulla stessa chiamata.
+    """
+    fine = datetime.now().replace(microsecond=0)
+    inizio = fine - timedelta(days=365 * anni)
+    secondi_totali = int((fine - inizio).total_seconds())
+    istanti = sorted(rng.randrange(secondi_totali) for _ in range(quanti))
+
+    interventi = []
+    partecipanti = []
+    anno_corrente, rapporto, numero_erba = None, 0, 0
+    progressivo = 1
+    for indice, offset in enumerate(istanti, start=1):
+        uscita = inizio + timedelta(seconds=offset)
+        if uscita.year != anno_corrente:
+            anno_corrente, rapporto = uscita.year, 0
+        if rapporto == 0 or rng.random() > 0.15:
+            rapporto += 1
+            progressivo = 1
+        else:
+            progressivo += 1
+        numero_erba += 1
+        rientro = uscita + timedelta(minutes=rng.randint(20, 360))
+        targa, tipo, _ = rng.choice(mezzi)
+        squadra = rng.sample(vigili_ids, rng.randint(3, 8))
+        comune = rng.choice(COMUNI)
+        via = rng.choice(VIE)
+        interventi.append((
+            str(rapporto), f"{progressivo:02d}", numero_erba,
+            uscita.strftime('%Y-%m-%d %H:%M:%S'), rientro.strftime('%Y-%m-%d %H:%M:%S'),
+            targa, tipo, nomi_vigili[squadra[0]], nomi_vigili[squadra[1]],
+            comune, via, f"{via} {rng.randint(1, 120)}, {comune}",
+            rng.choice(tipologie), int(rng.random() < 0.05),
+            rng.randint(1000, 250000) if rng.random() < 0.7 else None,
+            rng.randint(10, 200) if rng.random() < 0.3 else None,
+            uscita.strftime('%Y-%m-%d %H:%M:%S')))
+        partecipanti.extend((indice, vigile_id) for vigile_id in squadra)
+    return interventi, partecipanti
+
+
+def popola_database(bot, args):
+    rng = random.Random(args.seed)
+    conn = bot.connetti_db()
+    c = conn.cursor()
+    for tabella in ('partecipanti', 'interventi', 'vigili', 'mezzi', 'utenti'):
+        c.execute(f"DELETE FROM {tabella}")
+    c.execute("DELETE FROM sqlite_sequence WHERE name IN ('interventi', 'vigili', 'mezzi', 'partecipanti')")
+
+    vigili = genera_vigili(rng, args.vigili, bot.GRADI_PATENTE)
+    c.executemany('''INSERT INTO vigili (nome, cognome, qualifica, grado_patente_terrestre,
+                     patente_nautica, saf, tpss, atp, attivo) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', vigili)
+    c.execute("SELECT id, nome, cognome FROM vigili ORDER BY id")
+    righe_vigili = c.fetchall()
+    vigili_ids = [id_v for id_v, _, _ in righe_vigili]
+    nomi_vigili = {id_v: f"{nome} {cognome}" for id_v, nome, cognome in righe_vigili}
+
+    mezzi = genera_mezzi(rng, args.mezzi, bot.TIPI_MEZZO_PREDEFINITI)
+    c.executemany("INSERT INTO mezzi (targa, tipo, attivo) VALUES (?, ?, ?)", mezzi)
+
+    c.executemany('''INSERT INTO utenti (user_id, username, nome, telefono, ruolo, data_richiesta,
+                     data_approvazione) VALUES (?, ?, ?, ?, ?, ?, ?)''', genera_utenti(rng, args.utenti))
+
+    interventi, partecipanti = genera_interventi(rng, args.interventi, args.anni, bot.TIPOLOGIE_INTERVENTO,
+                                                 mezzi, vigili_ids, nomi_vigili)
+    c.executemany('''INSERT INTO interventi (rapporto_como, progressivo_como, numero_erba, data_uscita,
+                     data_rientro, mezzo_targa, mezzo_tipo, capopartenza, autista, comune, via, indirizzo,
+                     tipologia, cambio_personale, km_finali, litri_riforniti, created_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', interventi)
+    c.executemany("INSERT INTO partecipanti (intervento_id, vigile_id) VALUES (?, ?)", partecipanti)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return len(interventi), len(partecipanti)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera un database sintetico per i benchmark")
+    parser.add_argument('--dir', default='bench_dati', help="Directory di lavoro del database")
+    parser.add_argument('--anni', type=int, default=10)
+    parser.add_argument('--interventi', type=int, default=50000)
+    parser.add_argument('--vigili', type=int, default=200)
+    parser.add_argument('--mezzi', type=int, default=20)
+    parser.add_argument('--utenti', type=int, default=150)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Database nuovo ad ogni generazione: lo schema lo crea l'import di bot.py
+    os.makedirs(args.dir, exist_ok=True)
+    for suffisso in ('', '-wal', '-shm'):
+        percorso = os.path.join(args.dir, 'interventi_vvf.db' + suffisso)
+        if os.path.exists(percorso):
+            os.remove(percorso)
+
+    inizio = time.perf_counter()
+    bot = importa_bot(args.dir)
+    n_interventi, n_partecipanti = popola_database(bot, args)
+    print(f"✅ Dataset generato in {time.perf_counter() - inizio:.1f}s: {n_interventi} interventi, "
+          f"{n_partecipanti} partecipanti, {args.vigili} vigili, {args.mezzi} mezzi, {args.utenti} utenti "
+          f"→ {os.path.abspath(bot.DATABASE_NAME)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Riproduce una registrazione di update sul bot, partendo dalla copia del database.
+
+La registrazione nasce impostando REGISTRA_UPDATE_DIR sul bot: ogni file
+update_*.jsonl ha accanto lo snapshot update_*.db dello stato iniziale.
+Gli update passano dagli handler veri (gestisci_messaggio_testo,
+gestisci_callback, ...) con il Bot API finto di tools/finto_telegram.py.
+
+Uso:
+    python tools/riproduci_update.py registrazioni/update_20260101_120000.jsonl --velocita 0
+    python tools/riproduci_update.py registrazione.jsonl --velocita 10 --ripetizioni 2 --output esito.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from comune import importa_bot
+from finto_telegram import ServerTelegramFinto, TOKEN_FINTO
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+
+def carica_registrazione(percorso):
+    """(intestazione, update, stato finale o None) dal file JSONL"""
+    with open(percorso, encoding='utf-8') as f:
+        righe = [json.loads(riga) for riga in f if riga.strip()]
+    intestazione, voci = righe[0], righe[1:]
+    stato = next((v['stato'] for v in reversed(voci) if v.get('k') == 'stato'), None)
+    return intestazione, [v for v in voci if v.get('k') != 'stato'], stato
+
+
+def categoria(bot, voce):
+    if voce['k'] == 'callback':
+        return f"callback:{bot.prefisso_callback(voce['x'] or '')}"
+    return voce['k']
+
+
+def prepara_utenti(bot, voci):
+    """Gli pseudonimi della registrazione diventano utenti con il ruolo che avevano allora"""
+    ruoli = {}
+    for voce in voci:
+        if voce.get('r'):
+            ruoli[voce['u']] = voce['r']
+    conn = bot.connetti_db()
+    conn.executemany('''INSERT OR REPLACE INTO utenti (user_id, username, nome, ruolo, data_approvazione)
+                        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+                     [(u, f"anonimo{u}", f"Utente {u}", ruolo) for u, ruolo in ruoli.items()])
+    conn.commit()
+    conn.close()
+    # Scritture dirette sul database: le copie in memoria del bot vanno rilette
+    bot.invalida_cache_database()
+
+
+async def esegui_bot(application, fine):
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=5)
+        await asyncio.get_running_loop().run_in_executor(None, fine.wait)
+        await application.updater.stop()
+        await application.stop()
+        # run_polling chiamerebbe post_stop (es. chiusura della registrazione update)
+        if application.post_stop:
+            await application.post_stop(application)
+
+
+def riproduci(bot, voci, args):
+    """Una riproduzione completa: latenze per update e impronta finale del database"""
+    server = ServerTelegramFinto().avvia()
+    application = bot.crea_applicazione(TOKEN_FINTO, base_url=server.base_url, post_init=None, job_csv=False)
+
+    partenze = {}
+    inizi = {}
+    latenze = defaultdict(list)
+    attese = []
+    lock = threading.Lock()
+    completati = threading.Event()
+    da_completare = sum(1 for v in voci if v['k'] in ('testo', 'callback'))
+    conteggio = [0]
+
+    async def segna_inizio(update, context):
+        # Primo gruppo: da qui in poi è tempo degli handler, prima è attesa in coda
+        inizi[update.update_id] = time.perf_counter()
+
+    async def segna_completato(update, context):
+        # Ultimo gruppo: gli handler del bot hanno già finito con questo update
+        fine = time.perf_counter()
+        inizio = inizi.pop(update.update_id, fine)
+        with lock:
+            partenza = partenze.pop(update.update_id, None)
+            if partenza:
+                latenze[partenza[1]].append(fine - inizio)
+                attese.append(inizio - partenza[0])
+            conteggio[0] += 1
+            if conteggio[0] >= da_completare:
+                completati.set()
+
+    application.add_handler(TypeHandler(Update, segna_inizio), group=-99)
+    application.add_handler(TypeHandler(Update, segna_completato), group=99)
+
+    fine_bot = threading.Event()
+    esito = {}
+
+    def alimenta():
+        inizio = time.perf_counter()
+        for voce in voci:
+            if args.velocita > 0:
+                attesa = voce['t'] / args.velocita - (time.perf_counter() - inizio)
+                if attesa > 0:
+                    time.sleep(attesa)
+            if voce['k'] == 'testo':
+                with lock:
+                    update_id = server.invia_testo(voce['u'], voce['x'])
+                    partenze[update_id] = (time.perf_counter(), categoria(bot, voce))
+            elif voce['k'] == 'callback':
+                with lock:
+                    update_id = server.premi_bottone(voce['u'], voce.get('m'), voce['x'])
+                    partenze[update_id] = (time.perf_counter(), categoria(bot, voce))
+        if da_completare and not completati.wait(args.timeout):
+            esito['timeout'] = True
+        esito['durata'] = time.perf_counter() - inizio
+        fine_bot.set()
+
+    threading.Thread(target=alimenta, daemon=True).start()
+    asyncio.run(esegui_bot(application, fine_bot))
+    server.ferma()
+
+    esito['latenze'] = latenze
+    esito['attese'] = attese
+    esito['completati'] = conteggio[0]
+    esito['stato'] = bot.impronta_database(bot.DATABASE_NAME)
+    return esito
+
+
+def riepilogo_latenze(latenze):
+    voci = {}
+    tutte = []
+    for nome, valori in sorted(latenze.items()):
+        tutte.extend(valori)
+        voci[nome] = descrivi(valori)
+    if tutte:
+        voci['totale'] = descrivi(tutte)
+    return voci
+
+
+def descrivi(valori):
+    ordinati = sorted(valori)
+    return {
+        'conteggio': len(ordinati),
+        'p50_ms': round(statistics.median(ordinati) * 1000, 2),
+        'p95_ms': round(ordinati[min(len(ordinati) - 1, int(len(ordinati) * 0.95))] * 1000, 2),
+        'max_ms': round(ordinati[-1] * 1000, 2),
+    }
+
+
+def divergenze(atteso, ottenuto):
+    """Tabelle il cui contenuto stabile differisce tra due impronte"""
+    return {
+        tabella: {'atteso': atteso.get(tabella), 'ottenuto': ottenuto.get(tabella)}
+        for tabella in sorted(set(atteso) | set(ottenuto))
+        if atteso.get(tabella) != ottenuto.get(tabella)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Riproduzione deterministica di update registrati")
+    parser.add_argument('registrazione', help="File update_*.jsonl prodotto con REGISTRA_UPDATE_DIR")
+    parser.add_argument('--dir', default='riproduzione', help="Directory di lavoro (copia del database)")
+    parser.add_argument('--velocita', type=float, default=0.0,
+                        help="1 = tempo reale, 10 = dieci volte più veloce, 0 = senza pause")
+    parser.add_argument('--concorrenza', type=int, help="BOT_UPDATE_CONCORRENTI per la riproduzione")
+    parser.add_argument('--ripetizioni', type=int, default=1, help="Riproduzioni da confrontare tra loro")
+    parser.add_argument('--timeout', type=float, default=300.0, help="Attesa massima degli ultimi update (s)")
+    parser.add_argument('--output', help="File JSON in cui salvare l'esito")
+    args = parser.parse_args()
+
+    percorso = os.path.abspath(args.registrazione)
+    intestazione, voci, stato_registrato = carica_registrazione(percorso)
+    snapshot = os.path.join(os.path.dirname(percorso), intestazione['database'])
+    output = os.path.abspath(args.output) if args.output else None
+    if args.concorrenza:
+        os.environ['BOT_UPDATE_CONCORRENTI'] = str(args.concorrenza)
+    # La riproduzione non deve a sua volta registrare
+    os.environ.pop('REGISTRA_UPDATE_DIR', None)
+
+    directory = os.path.abspath(args.dir)
+    os.makedirs(directory, exist_ok=True)
+    shutil.copyfile(snapshot, os.path.join(directory, 'interventi_vvf.db'))
+    bot = importa_bot(directory)
+    bot.stato_avvio.restore_completato.set()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    saltati = sum(1 for v in voci if v['k'] not in ('testo', 'callback'))
+    print(f"▶️ {len(voci)} update registrati il {intestazione['inizio']} "
+          f"({saltati} non riproducibili), velocità {args.velocita or 'massima'}")
+
+    esiti = []
+    for ripetizione in range(args.ripetizioni):
+        shutil.copyfile(snapshot, bot.DATABASE_NAME)
+        prepara_utenti(bot, voci)
+        esito = riproduci(bot, voci, args)
+        esiti.append(esito)
+        print(f"⏱️ Riproduzione {ripetizione + 1}: {esito['completati']} update in {esito['durata']:.1f}s"
+              + (" ⚠️ TIMEOUT" if esito.get('timeout') else ""))
+
+    latenze = riepilogo_latenze(esiti[-1]['latenze'])
+    attesa_coda = descrivi(esiti[-1]['attese']) if esiti[-1]['attese'] else None
+    print("⏱️ Tempo negli handler per tipo di update:")
+    for nome, voce in latenze.items():
+        print(f"   {nome:<28} n={voce['conteggio']:<6} p50 {voce['p50_ms']:>8.1f} ms  "
+              f"p95 {voce['p95_ms']:>8.1f} ms  max {voce['max_ms']:>8.1f} ms")
+    if attesa_coda:
+        print(f"⏳ Attesa in coda prima degli handler: p50 {attesa_coda['p50_ms']:.1f} ms, "
+              f"p95 {attesa_coda['p95_ms']:.1f} ms, max {attesa_coda['max_ms']:.1f} ms")
+
+    diverso = {}
+    if stato_registrato:
+        diverso['registrazione'] = divergenze(stato_registrato, esiti[0]['stato'])
+    for indice, esito in enumerate(esiti[1:], start=2):
+        diverso[f"riproduzione_{indice}"] = divergenze(esiti[0]['stato'], esito['stato'])
+    for confronto, tabelle in diverso.items():
+        if tabelle:
+            for tabella, valori in tabelle.items():
+                print(f"❌ Divergenza ({confronto}) in {tabella}: {valori['atteso']} → {valori['ottenuto']}")
+        else:
+            print(f"✅ Stato del database identico ({confronto})")
+    if not stato_registrato:
+        print("ℹ️ La registrazione non contiene lo stato finale: confronto solo tra riproduzioni")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'eseguito': datetime.now().isoformat(timespec='seconds'),
+                'registrazione': percorso,
+                'update': len(voci),
+                'non_riproducibili': saltati,
+                'velocita': args.velocita,
+                'update_concorrenti': bot.BOT_UPDATE_CONCORRENTI,
+                'durate_s': [round(e['durata'], 3) for e in esiti],
+                'latenze': latenze,
+                'attesa_coda': attesa_coda,
+                'stato': esiti[-1]['stato'],
+                'divergenze': diverso,
+            }, f, indent=2)
+        print(f"💾 Esito salvato in {output}")
+
+    fallita = any(diverso.values()) or any(e.get('timeout') for e in esiti)
+    sys.exit(1 if fallita else 0)
+
+
+if __name__ == '__main__':
+    main()